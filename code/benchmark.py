@@ -0,0 +1,347 @@
+"""
+Off-rig benchmarks.
+
+    python benchmark.py sequence --rows 4 --cols 16 --time-scale 50
+
+runs a spin set against the simulated controller the same way ControlUI drives the real one
+and reports the throughput.
+
+    python benchmark.py capture --shots 10 --move-time 2 [--pipelined]
+
+captures from the fake camera and writes the images, moving on either after each image is
+written or, with --pipelined, through the capture pipeline as soon as the shutter closes.
+
+    python benchmark.py payload --shots 5
+
+compares CPU time and peak memory per image of copying the payload out of the receive buffer
+against writing it to disk straight from there.
+
+    python benchmark.py protocol
+
+compares the size and parse cost of status replies in the ASCII and binary framings.
+
+    python benchmark.py preview --shots 5 --image-mb 150
+
+compares the latency of a preview and a thumbnail taken from the preview embedded in an
+IIQ-sized file against reading the whole file, which any full decode has to do at least. Where
+the OS allows it, the files are dropped from the page cache before every read.
+
+    python benchmark.py liveview --frames 300
+
+compares CPU time per live view frame of receiving every frame into new buffers, as the viewer
+used to, against receiving it into a LiveViewRing, up to the pixmap the viewer shows.
+"""
+
+import argparse
+import threading
+import timeit
+import tracemalloc
+import os
+import tempfile
+import time
+import numpy as np
+
+from capture_plan import CapturePlan
+from simulator import SimulatedController
+from camera import FakeCamera, LiveViewRing
+from capture_pipeline import CapturePipeline
+from image_writer import ImageWriter
+import path_planner
+import motion
+import protocol
+import integrity
+import embedded_preview
+import preview_cache
+from serial_worker import parse_line
+
+
+def wait_for_replies(controller, prefix, count, arrival_times=None):
+    replies = []
+    while len(replies) < count:
+        line = controller.readline().decode().strip()
+        if line.startswith(prefix):
+            replies.append(line)
+            if arrival_times is not None:
+                arrival_times.append(controller.now())
+    return replies
+
+
+def read_status(controller):
+    """Send a P request and return (is_running, steps) for all axes."""
+    controller.write(b"P\n")
+    while True:
+        line = controller.readline().decode().split()
+        if line and line[0] == "P":
+            is_running = [int(line[axis * 2 + 1]) for axis in range(3)]
+            steps = [int(line[axis * 2 + 2]) for axis in range(3)]
+            return is_running, steps
+
+
+def run_sequence(args):
+    controller = SimulatedController(time_scale=args.time_scale)
+    controller.timeout = 1.0
+
+    for axis in range(3):
+        controller.write(f"H{axis}\n".encode())
+    # Homing ends with an H reply and then a C reply for the axis
+    wait_for_replies(controller, "C", 3)
+    _, start_steps = read_status(controller)
+
+    row_values = [[phi, args.height] for phi in np.linspace(0, 90, num=args.rows, endpoint=False)]
+    col_values = np.linspace(0, 360, num=args.cols, endpoint=False)
+    plan = CapturePlan.from_spin_set(row_values, col_values, start_steps, motion.DEFAULT_MAX_SPEEDS, motion.DEFAULT_ACCELERATIONS,
+                                     coordinated=args.coordinated)
+    path_planner.optimize_order(plan, start_steps, motion.DEFAULT_MAX_SPEEDS, motion.DEFAULT_ACCELERATIONS, method=args.order,
+                                coordinated=args.coordinated)
+    plan.validate()
+
+    session_start = controller.now()
+    wall_start = time.perf_counter()
+    steps = start_steps
+    arrival_spreads = []
+    for target in plan.steps:
+        if list(target) != steps:
+            for axis in range(3):
+                sign = "+" if target[axis] >= 0 else "-"
+                command = "T" if args.coordinated else "M"
+                controller.write(f"{command}{axis}{sign}{abs(int(target[axis]))}\n".encode())
+            if args.coordinated:
+                controller.write(b"G\n")
+            # Every axis reports with a C reply when it has arrived
+            arrival_times = []
+            replies = wait_for_replies(controller, "C", 3, arrival_times)
+            # Axes that don't have to move report right away
+            moved_arrivals = [t for line, t in zip(replies, arrival_times) if steps[int(line.split()[1])] != target[int(line.split()[1])]]
+            arrival_spreads.append(max(moved_arrivals) - min(moved_arrivals))
+            steps = [int(position) for _, position in sorted(line.split()[1:] for line in replies)]
+        time.sleep(args.capture_time / args.time_scale)
+    session_time = controller.now() - session_start
+    wall_time = time.perf_counter() - wall_start
+
+    motion_time = plan.durations.sum()
+    capture_time = args.capture_time * len(plan)
+    print(f"shots:                  {len(plan)}")
+    print(f"simulated session time: {session_time:.1f} s ({3600 * len(plan) / session_time:.0f} shots/hour)")
+    print(f"predicted motion time:  {motion_time:.1f} s")
+    print(f"capture time:           {capture_time:.1f} s")
+    print(f"unaccounted overhead:   {session_time - motion_time - capture_time:.1f} s")
+    print(f"axis arrival spread:    {np.mean(arrival_spreads):.2f} s mean, {np.max(arrival_spreads):.2f} s max")
+    print(f"wall clock time:        {wall_time:.1f} s")
+
+
+def run_capture(args):
+    fake_camera = FakeCamera(image_size=int(args.image_mb * 1024 * 1024), capture_latency=args.capture_latency,
+                             transfer_rate=args.transfer_mb_per_s * 1024 * 1024)
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        shot_times = []
+        start = time.perf_counter()
+        if args.pipelined:
+            exposed = threading.Semaphore(0)
+            writer = ImageWriter(memory_budget=int(args.memory_budget_mb * 1024 * 1024), fsync=args.fsync,
+                                 checksum_algorithm=None if args.checksum == "none" else args.checksum)
+            pipeline = CapturePipeline(fake_camera, writer=writer, on_exposed=lambda job: exposed.release())
+            for i in range(args.shots):
+                shot_start = time.perf_counter()
+                pipeline.submit(os.path.join(directory, f"{i:05d}.iiq"))
+                exposed.acquire()
+                time.sleep(args.move_time)
+                shot_times.append(time.perf_counter() - shot_start)
+            pipeline.close()
+            print(f"image writer:       {writer.metrics()}")
+        else:
+            for i in range(args.shots):
+                shot_start = time.perf_counter()
+                fake_camera.trigger_capture()
+                image = fake_camera.wait_for_image()
+                with open(os.path.join(directory, f"{i:05d}.iiq"), "wb") as f:
+                    image.write_to(f)
+                image.release()
+                time.sleep(args.move_time)
+                shot_times.append(time.perf_counter() - shot_start)
+        total = time.perf_counter() - start
+
+    shot_times = np.array(shot_times)
+    megabytes = args.shots * args.image_mb
+    print(f"shots:              {args.shots}")
+    print(f"per shot:           {shot_times.mean():.3f} s mean, {shot_times.max():.3f} s max")
+    print(f"throughput:         {megabytes / total:.0f} MB/s, {3600 * args.shots / total:.0f} shots/hour")
+
+
+def run_payload(args):
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        for zero_copy in (False, True):
+            # Instant transfers, so only the work on the PC is measured
+            fake_camera = FakeCamera(image_size=int(args.image_mb * 1024 * 1024), capture_latency=0.0,
+                                     transfer_rate=float("inf"), zero_copy=zero_copy)
+            tracemalloc.start()
+            cpu_start = time.process_time()
+            for i in range(args.shots):
+                fake_camera.trigger_capture()
+                image = fake_camera.wait_for_image()
+                with open(os.path.join(directory, f"{i:05d}.iiq"), "wb") as f:
+                    image.write_to(f)
+                image.release()
+                del image
+            cpu_time = (time.process_time() - cpu_start) / args.shots
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            name = "zero copy:" if zero_copy else "copy:"
+            print(f"{name:11} {1000 * cpu_time:6.1f} ms CPU per image, peak {peak / 1024 / 1024:6.0f} MB allocated")
+
+
+def run_protocol(args):
+    status = [1, 125000, 0, 31234, 1, -4096]
+    needs_homing = [0, 0, 0]
+    ascii_bytes = ("P " + " ".join(str(f) for f in status) + "\r\nD " + " ".join(str(f) for f in needs_homing) + "\r\n").encode()
+    binary_bytes = protocol.encode_reply("P", status + needs_homing, 0)
+
+    def parse_ascii():
+        for line in ascii_bytes.decode().splitlines():
+            code, fields = parse_line(line)
+            [int(f) for f in fields]
+
+    decoder = protocol.FrameDecoder()
+
+    def parse_binary():
+        for frame_type, _, payload in decoder.feed(binary_bytes):
+            protocol.decode_reply(frame_type, payload)
+
+    for name, data, parse in (("ASCII", ascii_bytes, parse_ascii), ("binary", binary_bytes, parse_binary)):
+        seconds = timeit.timeit(parse, number=args.count) / args.count
+        # 10 bits per byte on the wire with the start and stop bits
+        wire_time = len(data) * 10 / args.baud
+        print(f"{name + ':':8} {len(data):3d} bytes per status, {1e6 * seconds:5.1f} µs to parse, "
+              f"at most {1 / wire_time:.0f} status replies/s at {args.baud} baud")
+
+
+def drop_from_page_cache(path):
+    if hasattr(os, "posix_fadvise"):
+        with open(path, "rb") as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def run_preview(args):
+    template = embedded_preview.make_test_file(int(args.image_mb * 1024 * 1024))
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        paths = []
+        for i in range(args.shots):
+            template[8:16] = i.to_bytes(8, "little")
+            paths.append(os.path.join(directory, f"{i:05d}.iiq"))
+            with open(paths[-1], "wb") as f:
+                f.write(template)
+                f.flush()
+                os.fsync(f.fileno())
+
+        def measure(read):
+            times = []
+            for path in paths:
+                drop_from_page_cache(path)
+                start = time.perf_counter()
+                read(path)
+                times.append(time.perf_counter() - start)
+            return np.array(times)
+
+        def read_whole_file(path):
+            buffer = bytearray(16 * 1024 * 1024)
+            with open(path, "rb", buffering=0) as f:
+                while f.readinto(buffer):
+                    pass
+
+        for name, read in ((f"preview {args.size} px:", lambda path: preview_cache.decode_capture(path, args.size)),
+                           (f"thumbnail {preview_cache.THUMBNAIL_SIZE} px:", lambda path: preview_cache.decode_capture(path, preview_cache.THUMBNAIL_SIZE)),
+                           ("whole file read:", read_whole_file)):
+            times = measure(read)
+            print(f"{name:20} {1000 * times.mean():7.1f} ms mean, {1000 * times.max():7.1f} ms max")
+
+
+def run_liveview(args):
+    from PyQt5.QtGui import QGuiApplication, QImage, QPixmap
+    app = QGuiApplication.instance() or QGuiApplication(["benchmark"])
+    fake_camera = FakeCamera(live_view_size=(args.width, args.height), live_view_fps=float("inf"))
+    fake_camera.set_live_view_enabled(True)
+
+    def copied():
+        frame = fake_camera.wait_for_live_view(1000)
+        image = QImage(frame.data, frame.width, frame.height, QImage.Format_RGB888).copy()
+        QPixmap.fromImage(image)
+
+    ring = LiveViewRing(args.width, args.height)
+
+    def ringed():
+        slot, buffer = ring.acquire_write()
+        fake_camera.wait_for_live_view(1000, out=buffer)
+        ring.publish(slot)
+        buffer, _ = ring.acquire_read()
+        QPixmap.fromImage(QImage(buffer, ring.width, ring.height, ring.stride, QImage.Format_RGB888))
+        ring.release_read()
+
+    for name, read_frame in (("copies:", copied), ("ring:", ringed)):
+        tracemalloc.start()
+        cpu_start = time.process_time()
+        for _ in range(args.frames):
+            read_frame()
+        cpu_time = (time.process_time() - cpu_start) / args.frames
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:8} {1000 * cpu_time:5.2f} ms CPU per frame, at most {1 / cpu_time:4.0f} frames/s, "
+              f"peak {peak / 1024 / 1024:5.1f} MB allocated")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sequence = subparsers.add_parser("sequence", help="run a spin set against the simulated controller")
+    sequence.add_argument("--rows", type=int, default=4)
+    sequence.add_argument("--cols", type=int, default=16)
+    sequence.add_argument("--height", type=float, default=700.0, help="h of every row, in mm")
+    sequence.add_argument("--order", choices=["shortest", "serpentine", "file"], default="shortest")
+    sequence.add_argument("--time-scale", type=float, default=50.0, help="how much faster than real time to simulate")
+    sequence.add_argument("--capture-time", type=float, default=1.0, help="simulated seconds spent capturing each shot")
+    sequence.add_argument("--coordinated", action="store_true", help="move all axes together with the T and G commands")
+    sequence.set_defaults(run=run_sequence)
+
+    capture = subparsers.add_parser("capture", help="capture and write images from the fake camera")
+    capture.add_argument("--shots", type=int, default=10)
+    capture.add_argument("--image-mb", type=float, default=120.0)
+    capture.add_argument("--capture-latency", type=float, default=0.5, help="seconds from trigger until the shutter closes")
+    capture.add_argument("--transfer-mb-per-s", type=float, default=200.0)
+    capture.add_argument("--directory", default=None, help="where to write the images, defaults to the system temp directory")
+    capture.add_argument("--move-time", type=float, default=0.0, help="seconds the rig spends moving between shots")
+    capture.add_argument("--pipelined", action="store_true", help="move on as soon as the shutter closes")
+    capture.add_argument("--memory-budget-mb", type=float, default=512.0, help="memory for images waiting to be written, pipelined only")
+    capture.add_argument("--fsync", action="store_true", help="flush every image to the disk, pipelined only")
+    capture.add_argument("--checksum", choices=integrity.available_algorithms() + ["none"], default=integrity.DEFAULT_ALGORITHM,
+                         help="hash images while writing them, pipelined only")
+    capture.set_defaults(run=run_capture)
+
+    payload = subparsers.add_parser("payload", help="compare copying image payloads against writing them in place")
+    payload.add_argument("--shots", type=int, default=5)
+    payload.add_argument("--image-mb", type=float, default=120.0)
+    payload.add_argument("--directory", default=None, help="where to write the images, defaults to the system temp directory")
+    payload.set_defaults(run=run_payload)
+
+    protocol_parser = subparsers.add_parser("protocol", help="compare the ASCII and binary framing of status replies")
+    protocol_parser.add_argument("--count", type=int, default=100000)
+    protocol_parser.add_argument("--baud", type=int, default=115200)
+    protocol_parser.set_defaults(run=run_protocol)
+
+    preview = subparsers.add_parser("preview", help="time previews from embedded images against reading the whole file")
+    preview.add_argument("--shots", type=int, default=5)
+    preview.add_argument("--image-mb", type=float, default=150.0)
+    preview.add_argument("--size", type=int, default=preview_cache.PreviewCache.MAX_SIZE, help="long edge of the preview, in pixels")
+    preview.add_argument("--directory", default=None, help="where to write the files, defaults to the system temp directory")
+    preview.set_defaults(run=run_preview)
+
+    liveview = subparsers.add_parser("liveview", help="compare live view frames copied into new buffers against a frame ring")
+    liveview.add_argument("--frames", type=int, default=300)
+    liveview.add_argument("--width", type=int, default=1280)
+    liveview.add_argument("--height", type=int, default=960)
+    liveview.set_defaults(run=run_liveview)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+Camera backends.
+
+PhaseOneCamera drives the IQ back through the Phase One CameraSdk .NET bindings (Windows only).
+FakeCamera has the same interface and produces IIQ-sized payloads and RGB888 live view frames
+locally, so the capture pipeline and live view can be run and profiled without the camera.
+
+Captured images are handed out as views of the buffer the SDK received them into, so the 100+ MB
+payload goes from there to the file without being copied. Live view frames can be received into
+a buffer of a LiveViewRing instead of a new one each, which costs a single copy per frame.
+"""
+
+import ctypes
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+import embedded_preview
+
+
+class CapturedImage:
+    # Large writes go straight from the buffer to the OS, the chunks just keep each call bounded
+    WRITE_CHUNK_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, data, owner=None):
+        self.data = memoryview(data).cast("B")
+        self.owner = owner # keeps the memory behind data alive
+
+    def __len__(self):
+        return self.data.nbytes
+
+    def write_to(self, f, chunk_size=WRITE_CHUNK_SIZE, hasher=None):
+        """Write the image to a file, feeding each chunk to hasher too while it is still in the cache."""
+        for offset in range(0, len(self), chunk_size):
+            chunk = self.data[offset:offset + chunk_size]
+            f.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+
+    def release(self):
+        """Hand the buffer back, the image can't be used afterwards."""
+        self.data.release()
+        dispose = getattr(self.owner, "Dispose", None)
+        if dispose is not None:
+            dispose()
+        self.owner = None
+
+
+def sdk_image(frame):
+    """CapturedImage viewing the unmanaged memory behind an SDK image frame."""
+    data = frame.Data
+    if not hasattr(data, "Pointer"):
+        # Managed buffer, copy it out
+        return CapturedImage(bytes(data.ToArray()))
+    pointer = data.Pointer
+    address = pointer.ToInt64() if hasattr(pointer, "ToInt64") else int(pointer)
+    buffer = (ctypes.c_ubyte * int(data.Length)).from_address(address)
+    return CapturedImage(buffer, owner=frame)
+
+
+class LiveViewFrame:
+    def __init__(self, data, width, height):
+        self.data = data
+        self.width = width
+        self.height = height
+
+
+class LiveViewSizeChanged(Exception):
+    """A live view frame isn't the size of the buffer it was to be received into."""
+
+
+def check_live_view_size(out, length):
+    if len(out) != length:
+        raise LiveViewSizeChanged(f"live view frame of {length} bytes doesn't fit a {len(out)} byte buffer")
+
+
+class LiveViewRing:
+    """Preallocated RGB888 frame buffers for live view. The worker fills them in turn and publishes
+    each frame once it is complete; the viewer reads the latest one. The buffer being read and
+    the latest one are never handed out for writing, so neither changes under the viewer."""
+
+    def __init__(self, width, height, slots=4, stride=None):
+        self.width = width
+        self.height = height
+        self.stride = 3 * width if stride is None else stride # bytes per row, rows may be padded
+        self.frame_size = self.stride * height
+        self.buffers = [bytearray(self.frame_size) for _ in range(slots)]
+        self.lock = threading.Lock()
+        self.latest = None # slot of the newest complete frame
+        self.reading = None # slot the viewer is reading
+        self.sequence = 0 # frames published so far
+        self.next_slot = 0
+
+    def fits(self, width, height):
+        return (width, height) == (self.width, self.height)
+
+    def acquire_write(self):
+        """Slot and buffer for the next frame."""
+        with self.lock:
+            while self.next_slot in (self.latest, self.reading):
+                self.next_slot = (self.next_slot + 1) % len(self.buffers)
+            slot = self.next_slot
+            self.next_slot = (slot + 1) % len(self.buffers)
+        return slot, self.buffers[slot]
+
+    def publish(self, slot):
+        with self.lock:
+            self.latest = slot
+            self.sequence += 1
+
+    def acquire_read(self):
+        """(buffer, sequence) of the latest frame, or (None, 0) before the first one. Call
+        release_read() when done with the buffer."""
+        with self.lock:
+            if self.latest is None:
+                return None, 0
+            self.reading = self.latest
+            return self.buffers[self.reading], self.sequence
+
+    def release_read(self):
+        with self.lock:
+            self.reading = None
+
+
+class PhaseOneCamera:
+    # Recorded with every shot of a sequence, by their SDK property names
+    RECORDED_PROPERTIES = ("Iso", "ShutterSpeed", "Aperture", "WhiteBalance")
+
+    def __init__(self):
+        # The SDK is only available on the capture PC, so it is loaded when a camera is opened
+        import clr
+        clr.AddReference(r"CameraSdkCs")
+        from P1.CameraSdk import Camera, ErrorCode, SdkException
+
+        self.sdk_exception = SdkException
+        self.timeout_error_code = ErrorCode.kErrorImageReceiverTimeout
+        self.camera = Camera.OpenUsbCamera()
+        self.camera.EnableImageReceiving(True)
+        self.image_lock = threading.Lock()
+        self.received_images = deque()
+
+    def set_host_storage_capacity(self, megabytes):
+        self.camera.SetHostStorageCapacity(megabytes)
+
+    def settings(self):
+        """Current values of the recorded properties, as text. Ones this camera doesn't have are left out."""
+        values = {}
+        try:
+            from P1.CameraSdk import PropertyId
+        except ImportError:
+            return values
+        for name in self.RECORDED_PROPERTIES:
+            try:
+                values[name] = str(self.camera.GetProperty(getattr(PropertyId, name)).ToString())
+            except Exception:
+                pass
+        return values
+
+    def trigger_capture(self):
+        self.camera.TriggerCapture()
+
+    def wait_for_exposure(self):
+        # The SDK calls used here have no shutter event, the image arriving is the first sign that
+        # the exposure is over. It is kept for the next wait_for_image() call.
+        with self.image_lock:
+            self.received_images.append(self._receive_image())
+
+    def wait_for_image(self):
+        with self.image_lock:
+            if self.received_images:
+                return self.received_images.popleft()
+            return self._receive_image()
+
+    def _receive_image(self):
+        return sdk_image(self.camera.WaitForImage())
+
+    def set_live_view_enabled(self, enabled):
+        self.camera.SetLiveViewEnable(enabled)
+
+    def wait_for_live_view(self, timeout_ms, out=None):
+        """The next live view frame, received into out if it is given. Raises LiveViewSizeChanged
+        if the frame isn't the size of out, and TimeoutError like FakeCamera if none arrives."""
+        try:
+            frame = self.camera.WaitForLiveView(timeout_ms)
+        except self.sdk_exception as e:
+            if e.ErrorCode == self.timeout_error_code:
+                raise TimeoutError("No live view frame received") from e
+            raise
+        data = frame.Data
+        if out is None:
+            return LiveViewFrame(bytes(data.ToArray()), frame.Width, frame.Height)
+        check_live_view_size(out, int(data.Length))
+        address = ctypes.addressof((ctypes.c_ubyte * len(out)).from_buffer(out))
+        if hasattr(data, "Pointer"):
+            pointer = data.Pointer
+            ctypes.memmove(address, pointer.ToInt64() if hasattr(pointer, "ToInt64") else int(pointer), len(out))
+        else:
+            # Managed buffer, copied into out by .NET rather than converted to bytes by Python
+            from System import IntPtr
+            from System.Runtime.InteropServices import Marshal
+            Marshal.Copy(data.ToArray(), 0, IntPtr(address), len(out))
+        return LiveViewFrame(out, frame.Width, frame.Height)
+
+    def close(self):
+        self.camera.Dispose()
+
+
+class FakeCamera:
+    # Roughly a 150 MP IQ back: 100+ MB raw files and a 1 MP live view
+    DEFAULT_IMAGE_SIZE = 120 * 1024 * 1024
+
+    def __init__(self, image_size=DEFAULT_IMAGE_SIZE, live_view_size=(1280, 960), live_view_fps=15.0,
+                 capture_latency=0.5, transfer_rate=200 * 1024 * 1024, zero_copy=True):
+        self.image_size = image_size
+        self.live_view_width, self.live_view_height = live_view_size
+        self.live_view_interval = 1.0 / live_view_fps
+        self.capture_latency = capture_latency # seconds from trigger until the shutter has closed
+        self.transfer_rate = transfer_rate # bytes per second over USB
+        # Without zero copy images are copied out of the receive buffer the way Data.ToArray() and bytes() did
+        self.zero_copy = zero_copy
+
+        # Laid out like an IIQ file, embedded previews followed by noise for the raw data
+        self.image_template = embedded_preview.make_test_file(image_size)
+        self.pending_captures = deque()
+        self.exposure_end_time = 0.0
+        self.captures_ready = threading.Condition()
+        self.image_count = 0
+
+        x = np.linspace(0, 255, self.live_view_width, dtype=np.float32)
+        y = np.linspace(0, 255, self.live_view_height, dtype=np.float32)
+        self.live_view_base = np.empty((self.live_view_height, self.live_view_width, 3), dtype=np.uint8)
+        self.live_view_base[..., 0] = x[None, :]
+        self.live_view_base[..., 1] = y[:, None]
+        self.live_view_base[..., 2] = 128
+        self.live_view_enabled = False
+        self.next_live_view_time = 0.0
+        self.live_view_count = 0
+
+    def set_host_storage_capacity(self, megabytes):
+        pass
+
+    def settings(self):
+        return {"Iso": "50", "ShutterSpeed": "1/60", "Aperture": "f/8"}
+
+    def trigger_capture(self):
+        now = time.monotonic()
+        with self.captures_ready:
+            # Images come off the camera one after the other
+            self.exposure_end_time = now + self.capture_latency
+            transfer_start = max(self.exposure_end_time, self.pending_captures[-1] if self.pending_captures else 0.0)
+            self.pending_captures.append(transfer_start + self.image_size / self.transfer_rate)
+            self.captures_ready.notify_all()
+
+    def wait_for_exposure(self):
+        """Block until the shutter of the last triggered capture has closed."""
+        delay = self.exposure_end_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def wait_for_image(self):
+        with self.captures_ready:
+            while not self.pending_captures:
+                self.captures_ready.wait()
+            ready_time = self.pending_captures.popleft()
+        delay = ready_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        # Every image is received into its own buffer, like the SDK does
+        receive_buffer = bytearray(self.image_template)
+        # Stamp the image number into the payload so every file is different
+        self.image_count += 1
+        receive_buffer[8:16] = self.image_count.to_bytes(8, "little")
+        if self.zero_copy:
+            return CapturedImage(receive_buffer)
+        return CapturedImage(bytes(receive_buffer[:]))
+
+    def set_live_view_enabled(self, enabled):
+        self.live_view_enabled = enabled
+        self.next_live_view_time = time.monotonic()
+
+    def wait_for_live_view(self, timeout_ms, out=None):
+        delay = self.next_live_view_time - time.monotonic()
+        if delay > timeout_ms / 1000.0:
+            raise TimeoutError("No live view frame received")
+        if delay > 0:
+            time.sleep(delay)
+        self.next_live_view_time = max(self.next_live_view_time + self.live_view_interval, time.monotonic())
+
+        # Scroll the gradient so consecutive frames differ
+        self.live_view_count += 1
+        shift = self.live_view_count * 8 % self.live_view_width
+        if out is None:
+            frame = np.roll(self.live_view_base, shift, axis=1)
+            return LiveViewFrame(frame.tobytes(), self.live_view_width, self.live_view_height)
+        check_live_view_size(out, self.live_view_base.nbytes)
+        frame = np.frombuffer(out, dtype=np.uint8).reshape(self.live_view_base.shape)
+        frame[:, :shift] = self.live_view_base[:, self.live_view_width - shift:]
+        frame[:, shift:] = self.live_view_base[:, :self.live_view_width - shift]
+        return LiveViewFrame(out, self.live_view_width, self.live_view_height)
+
+    def close(self):
+        pass
+
+
+def open_camera(simulate=False):
+    if simulate:
+        return FakeCamera()
+    return PhaseOneCamera()
@@ -0,0 +1,173 @@
+"""
+Incremental index of a capture folder.
+
+CaptureIndex keeps the name, modification time and size of every capture in a folder, so the
+latest image, a listing by time and the shots of a session are lookups instead of a scan of a
+folder that can hold thousands of files. It is kept up to date three ways: the capture path adds
+every image it writes, a filesystem watcher asks for a reconcile when something else changes the
+folder, and reconcile() is run periodically as a fallback. A reconcile is a single os.scandir()
+pass and is meant to run off the GUI thread.
+
+The index is saved as capture_index.json in the folder, so a large folder is usable right away
+after a restart while the first reconcile runs.
+"""
+
+import json
+import os
+import re
+import threading
+
+EXTENSIONS = (".iiq",)
+
+# Session ID, position index and grid cell at the start of a plan-made name
+PLAN_NAME_PATTERN = re.compile(r"^(.+?)_\d{5}_r\d+c\d+_")
+
+
+def session_id_of(name):
+    """Session a capture belongs to, from its plan-made name (see capture_plan.py). Other names,
+    e.g. manual captures, are grouped under their date."""
+    match = PLAN_NAME_PATTERN.match(name)
+    if match is not None:
+        return match.group(1)
+    return name.split("_")[0].split(".")[0]
+
+
+class CaptureIndex:
+    FILE_NAME = "capture_index.json"
+
+    def __init__(self, directory, extensions=EXTENSIONS):
+        self.directory = directory
+        self.extensions = extensions
+        self.lock = threading.Lock()
+        self.entries = {} # name -> (mtime_ns, size)
+        self.sessions = {} # session id -> set of names
+        self.latest_name = None
+        self.sorted_names = None # by modification time, rebuilt when asked for after a change
+        self.version = 0 # incremented on every change
+        self.reconciling = False
+        self._load()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def add(self, path):
+        """Record a capture that was just written. Returns True if that changed the index."""
+        name = os.path.basename(path)
+        if not name.lower().endswith(self.extensions):
+            return False
+        try:
+            status = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return False
+        entry = (status.st_mtime_ns, status.st_size)
+        with self.lock:
+            if self.entries.get(name) == entry:
+                return False
+            self._set(name, entry)
+            return True
+
+    def latest(self):
+        """Name of the newest capture, or None."""
+        with self.lock:
+            return self.latest_name
+
+    def names(self):
+        """Capture names, oldest first."""
+        with self.lock:
+            if self.sorted_names is None:
+                self.sorted_names = sorted(self.entries, key=lambda name: self.entries[name][0])
+            return self.sorted_names
+
+    def entry(self, name):
+        """(mtime_ns, size) of a capture, or None."""
+        with self.lock:
+            return self.entries.get(name)
+
+    def session_ids(self):
+        with self.lock:
+            return sorted(self.sessions)
+
+    def session_names(self, session_id):
+        with self.lock:
+            return sorted(self.sessions.get(session_id, ()))
+
+    def reconcile(self):
+        """Bring the index in line with the folder. Returns True if anything changed. Safe to call
+        from any thread; a call while another reconcile is running returns straight away."""
+        with self.lock:
+            if self.reconciling:
+                return False
+            self.reconciling = True
+        try:
+            found = {}
+            try:
+                with os.scandir(self.directory) as scan:
+                    for item in scan:
+                        if item.name.lower().endswith(self.extensions) and item.is_file():
+                            status = item.stat()
+                            found[item.name] = (status.st_mtime_ns, status.st_size)
+            except FileNotFoundError:
+                pass
+
+            with self.lock:
+                version = self.version
+                for name in self.entries.keys() - found.keys():
+                    self._remove(name)
+                for name, entry in found.items():
+                    if self.entries.get(name) != entry:
+                        self._set(name, entry)
+                changed = self.version != version
+            if changed:
+                self.save()
+            return changed
+        finally:
+            with self.lock:
+                self.reconciling = False
+
+    def save(self):
+        with self.lock:
+            data = {"entries": self.entries}
+            text = json.dumps(data)
+        path = os.path.join(self.directory, self.FILE_NAME)
+        try:
+            with open(path + ".tmp", "w") as f:
+                f.write(text)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass # the index is rebuilt by the next reconcile
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.directory, self.FILE_NAME)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            for name, entry in data.get("entries", {}).items():
+                self._set(name, tuple(entry))
+
+    def _set(self, name, entry):
+        if name not in self.entries:
+            self.sessions.setdefault(session_id_of(name), set()).add(name)
+        self.entries[name] = entry
+        if self.latest_name is None or entry[0] >= self.entries[self.latest_name][0]:
+            self.latest_name = name
+        elif name == self.latest_name:
+            self._find_latest()
+        self.sorted_names = None
+        self.version += 1
+
+    def _remove(self, name):
+        del self.entries[name]
+        session_id = session_id_of(name)
+        self.sessions[session_id].discard(name)
+        if not self.sessions[session_id]:
+            del self.sessions[session_id]
+        if name == self.latest_name:
+            self._find_latest()
+        self.sorted_names = None
+        self.version += 1
+
+    def _find_latest(self):
+        self.latest_name = max(self.entries, key=lambda name: self.entries[name][0], default=None)
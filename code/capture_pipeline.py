@@ -0,0 +1,174 @@
+"""
+Pipelined capture.
+
+Capturing a shot used to trigger the camera, wait for the transfer, write the file and decode the
+preview before the next move was sent. CapturePipeline runs those steps on worker threads:
+
+    capture thread   triggers the camera and reports when the shutter has closed
+    transfer thread  receives the images from the camera, in order
+    image writer     writes them to disk (see image_writer.py)
+    preview thread   decodes the latest written image for display, skipping any it falls behind on
+
+so the rig can move on as soon as the shutter closes and a shot costs max(move, transfer)
+instead of their sum. Before each trigger the capture thread reserves room for the image in the
+writer's memory budget, so when the disk falls behind the next shot waits instead of piling
+images up in memory.
+
+The callbacks are called from the worker threads.
+"""
+
+import queue
+import threading
+import time
+
+from image_writer import ImageWriter
+
+
+class CaptureJob:
+    def __init__(self, path, index=None, info=None, archive=None, shot=0):
+        self.path = path
+        self.index = index # position in the capture plan, if any
+        self.shot = shot # shot of the position's burst
+        self.info = info # passed back to the callbacks untouched
+        self.archive = archive # session archive the image goes into instead of its own file
+        self.size = None
+        self.checksum = None
+        self.error = None
+        self.preview_error = None # the image was saved but its preview couldn't be made
+        self.trigger_time = None
+        self.exposed_time = None
+        self.transferred_time = None
+        self.saved_time = None
+        self.reserved = 0 # bytes reserved in the writer's memory budget
+
+
+class CapturePipeline:
+    def __init__(self, camera, writer=None, on_exposed=None, on_saved=None, on_error=None,
+                 make_preview=None, on_preview=None, on_preview_error=None):
+        self.camera = camera
+        self.writer = writer if writer is not None else ImageWriter()
+        self.writer.on_written = self._on_written
+        self.on_exposed = on_exposed
+        self.on_saved = on_saved
+        self.on_error = on_error
+        self.make_preview = make_preview
+        self.on_preview = on_preview
+        self.on_preview_error = on_preview_error
+
+        self.idle = threading.Condition()
+        self.unfinished = 0
+        self.last_image_size = 0
+
+        self.capture_queue = queue.Queue()
+        self.transfer_queue = queue.Queue()
+        self.preview_queue = queue.Queue(maxsize=1)
+        self.threads = [
+            threading.Thread(target=self._capture_loop, name="capture", daemon=True),
+            threading.Thread(target=self._transfer_loop, name="transfer", daemon=True),
+        ]
+        if make_preview is not None:
+            self.threads.append(threading.Thread(target=self._preview_loop, name="preview", daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, path, index=None, info=None, archive=None, shot=0):
+        """Queue a shot. on_exposed is called once the shutter has closed (or the trigger failed)."""
+        job = CaptureJob(path, index, info, archive, shot)
+        with self.idle:
+            self.unfinished += 1
+        self.capture_queue.put(job)
+        return job
+
+    def pending(self):
+        """Number of shots that have not been written (or failed) yet."""
+        with self.idle:
+            return self.unfinished
+
+    def wait_until_idle(self, timeout=None):
+        with self.idle:
+            return self.idle.wait_for(lambda: self.unfinished == 0, timeout)
+
+    def close(self):
+        """Finish the queued shots and stop the workers."""
+        self.capture_queue.put(None)
+        for thread in self.threads[:2]:
+            thread.join()
+        self.writer.close()
+        if self.make_preview is not None:
+            self._put_preview(None)
+            self.threads[2].join()
+
+    def _capture_loop(self):
+        while (job := self.capture_queue.get()) is not None:
+            # Images are all about the same size, the transfer corrects the reservation
+            job.reserved = self.last_image_size
+            self.writer.reserve(job.reserved)
+            try:
+                job.trigger_time = time.perf_counter()
+                self.camera.trigger_capture()
+                self.camera.wait_for_exposure()
+                job.exposed_time = time.perf_counter()
+            except Exception as e:
+                job.error = e
+            self._notify(self.on_exposed, job)
+            if job.error is not None:
+                self.writer.cancel_reservation(job.reserved)
+                self._finish(job)
+            else:
+                self.transfer_queue.put(job)
+        self.transfer_queue.put(None)
+
+    def _transfer_loop(self):
+        while (job := self.transfer_queue.get()) is not None:
+            try:
+                image = self.camera.wait_for_image()
+                job.transferred_time = time.perf_counter()
+            except Exception as e:
+                job.error = e
+                self.writer.cancel_reservation(job.reserved)
+                self._finish(job)
+                continue
+            self.last_image_size = len(image)
+            self.writer.submit(job.path, image, context=job, reserved=job.reserved, archive=job.archive)
+
+    def _on_written(self, request):
+        job = request.context
+        job.error = request.error
+        job.size = request.size
+        job.checksum = request.checksum
+        job.saved_time = request.end_time
+        if job.error is None and self.make_preview is not None:
+            self._put_preview(job)
+        self._finish(job)
+
+    def _preview_loop(self):
+        while (job := self.preview_queue.get()) is not None:
+            try:
+                preview = self.make_preview(job)
+            except Exception as e:
+                job.preview_error = e
+                self._notify(self.on_preview_error, job)
+                continue
+            self._notify(self.on_preview, preview)
+
+    def _put_preview(self, job):
+        # Only the latest image is worth showing, drop one that hasn't been decoded yet
+        while True:
+            try:
+                self.preview_queue.put_nowait(job)
+                return
+            except queue.Full:
+                try:
+                    self.preview_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _finish(self, job):
+        with self.idle:
+            self.unfinished -= 1
+            self.idle.notify_all()
+        self._notify(self.on_error if job.error is not None else self.on_saved, job)
+
+    def _notify(self, callback, argument):
+        if callback is not None:
+            callback(argument)
@@ -0,0 +1,227 @@
+"""
+Array-backed capture plans.
+
+A plan is generated, converted to motor steps and bounds-checked in one go before a sequence
+starts, and saved next to the captures so an interrupted session can be resumed. The executor
+only has to walk the arrays.
+
+Every shot's filename is fixed when the plan is made, from the session ID, the index of the
+position in the plan, its grid cell and pose, and the shot number within the position's burst:
+
+    20240611_142501_00042_r03c017_t170.00_p22.50_h+0.00_s1.iiq
+
+so shots taken within the same second never collide and a shot can be found from the plan
+alone.
+
+Progress is kept per shot, as the shots that are on disk, since shots are written in the
+background and one can fail while the next succeeds. A position is done once every shot of its
+burst is written, and a resumed plan visits every position that isn't.
+"""
+
+import csv
+import os
+import time
+import numpy as np
+
+import kinematics
+import motion
+
+
+def read_spin_positions(path):
+    """Rows as (φ, h) pairs and columns as θ values from a spin_positions CSV file. The columns
+    are optional, the list is empty if the file has none. Raises a ValueError if the file is
+    malformed or holds a position out of range."""
+    rows = []
+    cols = []
+    section = None
+    with open(path, "r", newline="") as f:
+        for line in csv.reader(f):
+            if not line or line[0].startswith("#"):
+                continue
+            if line[0].startswith("rows"):
+                section = "rows"
+                continue
+            if line[0].startswith("cols"):
+                section = "cols"
+                continue
+            if section is None:
+                continue
+            try:
+                values = [float(value) for value in line[:2 if section == "rows" else 1]]
+            except ValueError as e:
+                raise ValueError("CSV file is not formatted correctly") from e
+
+            if section == "rows":
+                if len(values) < 2:
+                    raise ValueError("CSV file is not formatted correctly")
+                phi, h = values
+                if not (kinematics.PHI_MIN <= phi <= kinematics.PHI_MAX and kinematics.H_MIN <= h <= kinematics.H_MAX):
+                    raise ValueError("CSV file contains out-of-bounds phi or h positions")
+                rows.append([phi, h])
+            else:
+                theta = values[0]
+                if not kinematics.THETA_MIN <= theta <= kinematics.THETA_MAX:
+                    raise ValueError("CSV file contains out-of-bounds theta positions")
+                cols.append(theta)
+    return rows, cols
+
+
+class CapturePlan:
+    FILE_NAME = "capture_plan.npz"
+    PROGRESS_FILE_NAME = "capture_plan.progress"
+
+    def __init__(self, positions, steps, durations, filenames, grid_indices, session_id, written=None):
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.steps = np.asarray(steps, dtype=np.int64)
+        self.durations = np.asarray(durations, dtype=np.float64)
+        # One row of burst filenames per position
+        self.filenames = np.asarray(filenames, dtype=np.str_).reshape(len(self.positions), -1)
+        self.grid_indices = np.asarray(grid_indices, dtype=np.int32)
+        self.session_id = session_id
+        # Which shots of each position are on disk
+        self.written = np.zeros(self.filenames.shape, dtype=bool) if written is None else np.asarray(written, dtype=bool)
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def shots_per_position(self):
+        return self.filenames.shape[1]
+
+    @property
+    def completed(self):
+        """Number of positions with every shot written."""
+        return int(self.written.all(axis=1).sum())
+
+    def remaining(self):
+        """Indices of the positions that still need shooting, in plan order."""
+        return np.flatnonzero(~self.written.all(axis=1))
+
+    @staticmethod
+    def shot_filename(session_id, index, grid_index, position, shot=0):
+        row, col = grid_index
+        theta, phi, h = position
+        return f"{session_id}_{index:05d}_r{row:02d}c{col:03d}_t{theta:06.2f}_p{phi:05.2f}_h{h:+.2f}_s{shot + 1}.iiq"
+
+    def make_filenames(self, shots_per_position):
+        """Name every shot after its place in the plan."""
+        self.filenames = np.array([
+            [self.shot_filename(self.session_id, index, self.grid_indices[index], self.positions[index], shot)
+             for shot in range(shots_per_position)]
+            for index in range(len(self))
+        ], dtype=np.str_).reshape(len(self), shots_per_position)
+        self.written = np.zeros(self.filenames.shape, dtype=bool)
+
+    @classmethod
+    def from_spin_set(cls, row_values, col_values, start_steps, max_speeds, accelerations, session_id=None, coordinated=False,
+                      shots_per_position=1):
+        """Build a plan that visits every column of every row. row_values holds (φ, h) pairs and
+        col_values holds θ values."""
+        if session_id is None:
+            session_id = time.strftime("%Y%m%d_%H%M%S")
+        row_values = np.asarray(row_values, dtype=np.float64).reshape(-1, 2)
+        col_values = np.asarray(col_values, dtype=np.float64).reshape(-1)
+
+        rows, cols = np.meshgrid(np.arange(len(row_values)), np.arange(len(col_values)), indexing="ij")
+        grid_indices = np.column_stack((rows.ravel(), cols.ravel()))
+        positions = np.column_stack((
+            col_values[grid_indices[:, 1]],
+            row_values[grid_indices[:, 0], 0],
+            row_values[grid_indices[:, 0], 1],
+        ))
+
+        steps = kinematics.positions_to_steps(positions, start_steps[0])
+        durations = motion.move_durations(steps, start_steps, max_speeds, accelerations, coordinated)
+        plan = cls(positions, steps, durations, np.empty((len(positions), 0)), grid_indices, session_id)
+        plan.make_filenames(shots_per_position)
+        return plan
+
+    def validate(self):
+        """Raise a ValueError if any target is outside the reachable step range."""
+        if len(self) == 0:
+            raise ValueError("Capture plan is empty")
+        out_of_bounds = kinematics.steps_out_of_bounds(self.steps)
+        if out_of_bounds.any():
+            first = int(np.argmax(out_of_bounds))
+            theta, phi, h = self.positions[first]
+            raise ValueError(f"{out_of_bounds.sum()} of {len(self)} capture positions are out of reach "
+                             f"(first at θ={theta:.3f}, φ={phi:.3f}, h={h:.3f})")
+
+    def remaining_duration(self):
+        return float(self.durations[self.remaining()].sum())
+
+    def is_complete(self):
+        return bool(self.written.all())
+
+    def resume_from(self, current_stage_steps):
+        """Recompute the remaining stage targets from where the stage is now, since it may have
+        been homed or moved by hand since the plan was made."""
+        remaining = self.remaining()
+        if len(remaining):
+            self.steps[remaining, 0] = kinematics.positions_to_steps(self.positions[remaining], current_stage_steps)[:, 0]
+
+    def reorder(self, order, start_steps, max_speeds, accelerations, coordinated=False):
+        """Visit the points in a new order. The stage targets and move durations are recomputed
+        since both depend on the point before, and the files are renamed after their new index."""
+        self.positions = self.positions[order]
+        self.grid_indices = self.grid_indices[order]
+        self.make_filenames(self.shots_per_position)
+        self.steps = kinematics.positions_to_steps(self.positions, start_steps[0])
+        self.durations = motion.move_durations(self.steps, start_steps, max_speeds, accelerations, coordinated)
+
+    def save(self, directory):
+        path = os.path.join(directory, self.FILE_NAME)
+        np.savez(
+            path,
+            positions=self.positions,
+            steps=self.steps,
+            durations=self.durations,
+            filenames=self.filenames,
+            grid_indices=self.grid_indices,
+            session_id=np.str_(self.session_id),
+        )
+        self.save_progress(directory)
+        return path
+
+    def save_progress(self, directory):
+        # One "index shot" line per written shot. Write to a temporary file first so a crash never
+        # leaves a truncated progress file
+        path = os.path.join(directory, self.PROGRESS_FILE_NAME)
+        with open(path + ".tmp", "w") as f:
+            f.writelines(f"{index} {shot}\n" for index, shot in np.argwhere(self.written))
+        os.replace(path + ".tmp", path)
+
+    def mark_written(self, index, shot, directory):
+        """Record a shot that is on disk. The line is appended, a crash can only cut the last one
+        short and that is ignored on load."""
+        self.written[index, shot] = True
+        with open(os.path.join(directory, self.PROGRESS_FILE_NAME), "a") as f:
+            f.write(f"{index} {shot}\n")
+
+    @classmethod
+    def load(cls, directory):
+        """Load the plan saved in a capture directory, or return None if there isn't one."""
+        path = os.path.join(directory, cls.FILE_NAME)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            plan = cls(
+                data["positions"],
+                data["steps"],
+                data["durations"],
+                data["filenames"],
+                data["grid_indices"],
+                str(data["session_id"]),
+            )
+        try:
+            with open(os.path.join(directory, cls.PROGRESS_FILE_NAME)) as f:
+                for line in f:
+                    fields = line.split()
+                    if line.endswith("\n") and len(fields) == 2:
+                        try:
+                            plan.written[int(fields[0]), int(fields[1])] = True
+                        except (ValueError, IndexError):
+                            pass
+        except OSError:
+            pass
+        return plan
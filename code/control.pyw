@@ -2,14 +2,13 @@ import serial
 import time
 import sys
 import os
-import math
 import glob
-import csv
+import sqlite3
+import threading
 import multiprocessing as mp
 import numpy as np
-from pathlib import Path
 
-from PyQt5.QtCore import QObject, QSize, Qt, QTimer, QEventLoop, pyqtSignal, QCoreApplication, QThread, pyqtSlot
+from PyQt5.QtCore import QObject, QSize, Qt, QTimer, QEventLoop, pyqtSignal, QCoreApplication, QThread, QThreadPool, pyqtSlot, QFileSystemWatcher
 from PyQt5.QtGui import QPalette, QColor, QFont, QIntValidator, QKeyEvent, QImage, QPixmap
 from PyQt5.QtWidgets import (
     QApplication,
@@ -41,62 +40,145 @@ from PyQt5.QtWidgets import (
     QSizePolicy
 )
 
-from PIL import Image
+import camera
+import kinematics
+from capture_plan import CapturePlan, read_spin_positions
+from capture_pipeline import CapturePipeline
+from image_writer import ImageWriter
+from session_index import SessionIndex, ShotRecord
+from session_archive import ArchiveWriter
+from preview_cache import PreviewCache
+from capture_index import CaptureIndex
+from gallery import GalleryView
+from offload import Replicator
+import path_planner
+import motion
+import preflight
+from simulator import SimulatedController
+from serial_worker import SerialWorker
 
 # Add Windows-specific imports for dark title bar
 import ctypes
 from ctypes import wintypes
 
-# Add reference to the C# SDK DLL
-import clr
-clr.AddReference(r"CameraSdkCs")
-clr.AddReference(r"ImageSdkCs")
-from P1.CameraSdk import Camera
-from P1.ImageSdk import *
-import System
 
 
 class AspectRatioLabel(QLabel):
+    """Shows an image scaled to fit. The image is kept as a pyramid of halved copies, built off
+    the GUI thread, and scaled from the nearest level that is still large enough: quickly while
+    the label is being resized and smoothly once resizing settles."""
+
+    # Levels are halved down to this size along the long edge
+    MIN_LEVEL_SIZE = 256
+    # Resizing counts as settled after this many milliseconds without a resize
+    SMOOTH_DELAY = 150
+
+    pyramid_ready = pyqtSignal(int, list)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.original_pixmap = QPixmap()
+        self.levels = [] # largest first
+        self.image_count = 0
         self.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
         self.setAlignment(Qt.AlignCenter)
+        self.smooth_timer = QTimer(self)
+        self.smooth_timer.setSingleShot(True)
+        self.smooth_timer.setInterval(self.SMOOTH_DELAY)
+        self.smooth_timer.timeout.connect(lambda: self.resize_pixmap(Qt.TransformationMode.SmoothTransformation))
+        self.pyramid_ready.connect(self.on_pyramid_ready)
+        # Not the global pool, QImage's smooth scaling hands work to that one and waits for it
+        self.pyramid_pool = QThreadPool(self)
+        self.pyramid_pool.setMaxThreadCount(1)
 
     def setPixmap(self, pixmap):
-        self.original_pixmap = pixmap
-        self.resize_pixmap()
+        self.set_image(pixmap.toImage())
+
+    def set_image(self, image):
+        self.image_count += 1
+        self.levels = [image]
+        self.resize_pixmap(Qt.TransformationMode.FastTransformation)
+        if not image.isNull():
+            image_count = self.image_count
+            self.pyramid_pool.start(lambda: self.build_pyramid(image_count, image))
+
+    def build_pyramid(self, image_count, image):
+        levels = [image]
+        while max(image.width(), image.height()) // 2 >= self.MIN_LEVEL_SIZE:
+            image = image.scaled(image.width() // 2, image.height() // 2,
+                                 Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.SmoothTransformation)
+            levels.append(image)
+        self.pyramid_ready.emit(image_count, levels)
+
+    def on_pyramid_ready(self, image_count, levels):
+        if image_count == self.image_count: # not replaced in the meantime
+            self.levels = levels
+            self.resize_pixmap(Qt.TransformationMode.SmoothTransformation)
 
     def resizeEvent(self, event):
-        self.resize_pixmap()
+        self.resize_pixmap(Qt.TransformationMode.FastTransformation)
+        self.smooth_timer.start()
         super().resizeEvent(event)
 
-    def resize_pixmap(self):
-        if not self.original_pixmap.isNull():
-            scaled_pixmap = self.original_pixmap.scaled(
-                self.size(),
-                Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation
-            )
-            super().setPixmap(scaled_pixmap)
+    def resize_pixmap(self, transformation):
+        if not self.levels or self.levels[0].isNull():
+            return
+        size = self.levels[0].size().scaled(self.size(), Qt.AspectRatioMode.KeepAspectRatio)
+        if size.isEmpty():
+            return
+        level = next((level for level in reversed(self.levels)
+                      if level.width() >= size.width() and level.height() >= size.height()), self.levels[0])
+        super().setPixmap(QPixmap.fromImage(level.scaled(size, Qt.AspectRatioMode.IgnoreAspectRatio, transformation)))
 
 class LiveViewWorker(QObject):
 
-    live_view_frame_ready = pyqtSignal(QImage)
+    # Emitted with the ring a frame has been published to
+    live_view_frame_ready = pyqtSignal(object)
+    # Emitted when live view stops because of an error
+    live_view_failed = pyqtSignal(str)
+
+    RING_SLOTS = 4
 
     def __init__(self, camera):
         super().__init__(None)
         self.running = False
         self.camera = camera
+        self.ring = None
 
     @pyqtSlot()
     def start(self):
+        # An exception escaping a slot would take the whole application down, so errors are
+        # reported and end live view instead
         self.running = True
         while self.running:
-            frame = self.camera.WaitForLiveView(1000)
-            data = frame.Data.ToArray()
-            image = QImage(bytes(data), frame.Width, frame.Height, QImage.Format_RGB888).copy()
-            self.live_view_frame_ready.emit(image)
+            try:
+                if self.ring is None:
+                    # The first frame sets the size, the following ones are received straight into the ring
+                    frame = self.camera.wait_for_live_view(1000)
+                    self.ring = self.make_ring(frame)
+                    slot, buffer = self.ring.acquire_write()
+                    buffer[:] = frame.data
+                else:
+                    slot, buffer = self.ring.acquire_write()
+                    try:
+                        self.camera.wait_for_live_view(1000, out=buffer)
+                    except camera.LiveViewSizeChanged:
+                        self.ring = None
+                        continue
+            except TimeoutError:
+                continue
+            except Exception as e:
+                self.running = False
+                self.live_view_failed.emit(str(e))
+                return
+            self.ring.publish(slot)
+            self.live_view_frame_ready.emit(self.ring)
+
+    def make_ring(self, frame):
+        # Rows may be padded, e.g. to 4 bytes, the padding is kept and skipped when displayed
+        stride = len(frame.data) // frame.height if frame.height else 0
+        if stride < 3 * frame.width or stride * frame.height != len(frame.data):
+            raise ValueError(f"{frame.width} x {frame.height} live view frame of {len(frame.data)} bytes isn't RGB888")
+        return camera.LiveViewRing(frame.width, frame.height, self.RING_SLOTS, stride)
     
     @pyqtSlot()
     def stop(self):
@@ -105,43 +187,69 @@ class LiveViewWorker(QObject):
 class LiveViewViewer(QLabel):
     def __init__(self, placeholder_text):
         super().__init__(placeholder_text)
+        self.shown_frame = None # (ring, sequence) on screen
     
-    @pyqtSlot(QImage)
-    def on_frame(self, image):
-        pixmap = QPixmap.fromImage(image)
-        self.setPixmap(pixmap)
+    @pyqtSlot(object)
+    def on_frame(self, ring):
+        buffer, sequence = ring.acquire_read()
+        try:
+            # Frames that arrived while the GUI was busy are skipped, the latest one is shown once
+            if buffer is None or (ring, sequence) == self.shown_frame:
+                return
+            image = QImage(buffer, ring.width, ring.height, ring.stride, QImage.Format_RGB888)
+            self.setPixmap(QPixmap.fromImage(image))
+            self.shown_frame = (ring, sequence)
+        finally:
+            ring.release_read()
+
+def preview_image(preview):
+    """QImage of a rendered preview. Safe to call from a worker thread."""
+    return QImage(preview.data, preview.width, preview.height, 3 * preview.width, QImage.Format_RGB888).copy()
 
 class ControlUI(QMainWindow):
-    # these constants were measured using limit switches
-    STAGE_STEPS_PER_REVOLUTION = 708839
-    TRACK_MAX_STEPS = 780120 - 2 * (4 * 50)
-    NOD_MAX_STEPS = 143117 - 2 * (64 * 10)
-
-    # these values were measured using a digital angle gauge
-    TRACK_MAX_DEGREES = 90.7 + 16.7
-    NOD_MAX_DEGREES = 29.9 + 27.4
-
-    STAGE_DEGREE_OFFSET = -1.17369
-    TRACK_DEGREE_OFFSET = 16.7
-    NOD_DEGREE_OFFSET = 29.9
-    H_OFFSET = 457.2 # 18 inches to mm
-
-    # these values were taken from CAD
-    L1_LENGTH = 1492.08 # in mm
-    L2_LENGTH = 105.564 # in mm
-
-    THETA_MIN = 0
-    THETA_MAX = 360
-    PHI_MIN = -80
-    PHI_MAX = 90
-    H_MIN = 0
-    H_MAX = L1_LENGTH * 0.9 + H_OFFSET
+    STAGE_STEPS_PER_REVOLUTION = kinematics.STAGE_STEPS_PER_REVOLUTION
+    TRACK_MAX_STEPS = kinematics.TRACK_MAX_STEPS
+    NOD_MAX_STEPS = kinematics.NOD_MAX_STEPS
+
+    THETA_MIN = kinematics.THETA_MIN
+    THETA_MAX = kinematics.THETA_MAX
+    PHI_MIN = kinematics.PHI_MIN
+    PHI_MAX = kinematics.PHI_MAX
+    H_MIN = kinematics.H_MIN
+    H_MAX = kinematics.H_MAX
 
     user_txt_input = pyqtSignal(str)
     all_motors_stopped = pyqtSignal()
+    # Emitted from the capture pipeline's threads
+    capture_exposed = pyqtSignal(object)
+    capture_saved = pyqtSignal(object)
+    capture_failed = pyqtSignal(object)
+    offload_copied = pyqtSignal(object)
+    offload_failed = pyqtSignal(object)
+    capture_preview_ready = pyqtSignal(QImage)
+    capture_preview_failed = pyqtSignal(object)
+    # Emitted from the preview cache's threads with the message to report
+    preview_failed = pyqtSignal(str)
+    # Emitted from the capture index's reconcile thread
+    capture_index_changed = pyqtSignal()
+    # Emitted from the estimate thread with the lines to report
+    spin_set_estimated = pyqtSignal(list)
+    # Emitted from the ordering thread with the line to report, or None
+    capture_plan_ordered = pyqtSignal(object)
 
     YELLOW_PROGRESS_COLOR = "#cd9c5c"
 
+    # Captured images waiting for the disk may hold this much memory before the sequence waits
+    IMAGE_WRITER_MEMORY_BUDGET = 1024 * 1024 * 1024
+    # Sequence progress is saved once an image is written, make sure it really is on the disk by then
+    IMAGE_WRITER_FSYNC = True
+    # Finished shots are copied to the offload folder this many at a time, at most this fast
+    OFFLOAD_WORKERS = 2
+    OFFLOAD_MAX_BYTES_PER_SECOND = 100 * 1024 * 1024
+    # The capture folder is rescanned this long after the watcher reports a change, and at least this often
+    CAPTURE_INDEX_RECONCILE_DELAY = 1000
+    CAPTURE_INDEX_RECONCILE_INTERVAL = 60 * 1000
+
     pos_line_edit_matched_style = """
         QLineEdit {
             background-color: #3a3a3a;
@@ -245,12 +353,14 @@ class ControlUI(QMainWindow):
 
     default_capture_directory = os.path.dirname(os.getcwd()) + "/captures/default"
 
-    def __init__(self):
+    def __init__(self, simulate=False):
         super().__init__()
 
+        self.simulate = simulate
         self.update_positions = True
-        self.motor_data = [{ "is_running": None, "steps": None, "speed": None, "accel": None } for axis in range(3)]
+        self.motor_data = [{ "is_running": None, "steps": None, "speed": None, "accel": None, "max_speed": None, "acceleration": None } for axis in range(3)]
         self.target_positions = [None, None, None]
+        self.moving_axes = set() # axes with a commanded move the controller hasn't reported as done yet
         self.homing = [False, False, False]
         self.wrong_direction_flag = False
         self.alarm_flag = False
@@ -264,16 +374,39 @@ class ControlUI(QMainWindow):
         self.last_command = None
         self.spin_rows = []
         self.spin_cols = []
+        self.capture_plan = None
+        self.session_index = None
+        self.session_archive = None
+        self.offload_directory = None
+        self.replicator = None
+        self.preview_cache = PreviewCache()
+        self.capture_index = None
+        self.capture_index_shown_version = None # version of the index the views were last refreshed with
+        self.displayed_path = None
+        self.manual_capture_count = 0
         self.capture_directory = self.default_capture_directory
         self.camera = None
+        self.capture_pipeline = None
         self.live_view_worker = None
         self.live_view_thread = None
+        self.serial_worker = None
+        self.serial_thread = None
 
         self.setWindowTitle("lbxcontrol")
         self.setGeometry(400, 100, 1800, 900)
         self.set_dark_theme()
         self.set_dark_title_bar()  # Add dark title bar
+        self.setup_capture_index()
         self.init_ui()
+        self.capture_saved.connect(self.on_capture_saved)
+        self.capture_failed.connect(self.on_capture_failed)
+        self.offload_copied.connect(self.on_offload_copied)
+        self.offload_failed.connect(self.on_offload_failed)
+        self.capture_preview_ready.connect(self.on_capture_preview_ready)
+        self.capture_preview_failed.connect(self.on_capture_preview_failed)
+        self.preview_failed.connect(self.output_to_terminal)
+        self.capture_index_changed.connect(self.on_capture_index_changed)
+        self.spin_set_estimated.connect(self.on_spin_set_estimated)
         self.initialize_hardware()
         self.setup_serial_polling()
         
@@ -283,6 +416,23 @@ class ControlUI(QMainWindow):
         self.keyboard_timer.timeout.connect(self.process_keyboard_commands)
         self.keyboard_timer.start(500)  # Fire every 500ms
 
+    def closeEvent(self, event):
+        self.close_capture_pipeline()
+        self.close_session_index()
+        self.close_session_archive()
+        if self.replicator is not None:
+            # Whatever is left is copied the next time a sequence runs with the same folders
+            self.replicator.stop()
+        self.preview_cache.close()
+        self.gallery.model.close()
+        if self.capture_index is not None:
+            self.capture_index.save()
+        if self.serial_worker:
+            self.serial_worker.stop()
+            self.serial_thread.quit()
+            self.serial_thread.wait()
+        super().closeEvent(event)
+
     def set_dark_theme(self):
         palette = QPalette()
         palette.setColor(QPalette.Window, QColor(30, 30, 30))
@@ -322,6 +472,8 @@ class ControlUI(QMainWindow):
         self.calibrate = QWidget()
         self.live_view = LiveViewViewer(" ")
         self.last_image = AspectRatioLabel(" ")
+        self.gallery = GalleryView()
+        self.gallery.shot_activated.connect(self.show_gallery_shot)
 
         ## Set overall layout of the UI sections
         left_tabs = QTabWidget()
@@ -343,7 +495,9 @@ class ControlUI(QMainWindow):
         center_tabs.setTabPosition(QTabWidget.North)
         center_tabs.addTab(self.last_image, "Latest Captured Image")
         center_tabs.addTab(self.live_view, "Live View")
+        center_tabs.addTab(self.gallery, "Gallery")
         center_tabs.currentChanged.connect(self.on_tab_changed)
+        self.center_tabs = center_tabs
 
         right_tabs = QTabWidget()
         right_tabs.setStyleSheet(left_tabs.styleSheet())
@@ -354,7 +508,7 @@ class ControlUI(QMainWindow):
         top_row = QWidget()
         top_layout = QHBoxLayout()
         top_layout.addWidget(left_tabs)
-        top_layout.addWidget(center_tabs, 1)
+        top_layout.addWidget(self.center_tabs, 1)
         top_layout.addWidget(right_tabs)
         top_row.setLayout(top_layout)
 
@@ -746,6 +900,51 @@ class ControlUI(QMainWindow):
         self.cols_value_label.setVisible(False)
         spin_set_cols_layout.addWidget(self.cols_value_label)
 
+        # Capture order widget
+        capture_order_widget = QWidget()
+        spin_set_layout.addWidget(capture_order_widget)
+        capture_order_layout = QHBoxLayout(capture_order_widget)
+        capture_order_layout.setContentsMargins(10, 5, 10, 5)
+
+        capture_order_label = QLabel("Capture order")
+        capture_order_label.setStyleSheet(self.standard_label_font)
+        capture_order_layout.addWidget(capture_order_label)
+
+        self.capture_order_dropdown = QComboBox()
+        capture_order_layout.addWidget(self.capture_order_dropdown, stretch=1, alignment=Qt.AlignRight)
+        self.capture_order_dropdown.setMinimumWidth(250)
+        self.capture_order_dropdown.addItems(["Shortest travel time", "Serpentine", "File order"])
+        self.capture_order_dropdown.setStyleSheet(sequence_type_dropdown.styleSheet())
+
+        # Coordinated moves widget
+        coordinated_moves_widget = QWidget()
+        spin_set_layout.addWidget(coordinated_moves_widget)
+        coordinated_moves_layout = QHBoxLayout(coordinated_moves_widget)
+        coordinated_moves_layout.setContentsMargins(10, 5, 10, 5)
+
+        coordinated_moves_label = QLabel("Move all axes together")
+        coordinated_moves_label.setStyleSheet(self.standard_label_font)
+        coordinated_moves_layout.addWidget(coordinated_moves_label)
+
+        self.coordinated_moves_checkbox = QCheckBox()
+        self.coordinated_moves_checkbox.setStyleSheet(self.standard_checkbox_style)
+        self.coordinated_moves_checkbox.setChecked(True)
+        coordinated_moves_layout.addWidget(self.coordinated_moves_checkbox, 1, Qt.AlignRight)
+
+        # Session archive widget
+        session_archive_widget = QWidget()
+        spin_set_layout.addWidget(session_archive_widget)
+        session_archive_layout = QHBoxLayout(session_archive_widget)
+        session_archive_layout.setContentsMargins(10, 5, 10, 5)
+
+        session_archive_label = QLabel("Save shots into one archive file")
+        session_archive_label.setStyleSheet(self.standard_label_font)
+        session_archive_layout.addWidget(session_archive_label)
+
+        self.session_archive_checkbox = QCheckBox()
+        self.session_archive_checkbox.setStyleSheet(self.standard_checkbox_style)
+        session_archive_layout.addWidget(self.session_archive_checkbox, 1, Qt.AlignRight)
+
         # Number of captures widget
         num_captures_widget = QWidget()
         spin_set_layout.addWidget(num_captures_widget)
@@ -797,12 +996,69 @@ class ControlUI(QMainWindow):
             if folder:
                 self.folder_path_line_edit.setText(folder)
                 self.capture_directory = folder
+                self.update_host_storage_capacity()
+                self.open_capture_index(folder)
 
         browse_folder_button = QPushButton("Browse")
         browse_folder_button.setStyleSheet(self.standard_button_style)
         browse_folder_button.clicked.connect(browse_capture_folder)
         folder_selector_layout.addWidget(browse_folder_button)
 
+        # Estimate widget
+        estimate_widget = QWidget()
+        spin_set_layout.addWidget(estimate_widget)
+        estimate_layout = QHBoxLayout(estimate_widget)
+        estimate_layout.setContentsMargins(10, 5, 10, 5)
+
+        estimate_label = QLabel("Disk space and duration")
+        estimate_label.setStyleSheet(self.standard_label_font)
+        estimate_layout.addWidget(estimate_label)
+
+        self.estimate_button = QPushButton("Estimate")
+        self.estimate_button.setStyleSheet(self.standard_button_style)
+        self.estimate_button.clicked.connect(self.estimate_spin_set)
+        estimate_layout.addWidget(self.estimate_button, 1, Qt.AlignRight)
+
+        # Offload folder widget
+        offload_selector_widget = QWidget()
+        spin_set_layout.addWidget(offload_selector_widget)
+        offload_selector_layout = QHBoxLayout(offload_selector_widget)
+        offload_selector_layout.setContentsMargins(10, 5, 10, 5)
+
+        offload_label = QLabel("Offload folder")
+        offload_label.setStyleSheet(self.standard_label_font)
+        offload_selector_layout.addWidget(offload_label)
+
+        self.offload_path_line_edit = QLineEdit()
+        self.offload_path_line_edit.setPlaceholderText("Shots are not copied")
+        self.offload_path_line_edit.setReadOnly(True)
+        self.offload_path_line_edit.setStyleSheet(self.folder_path_line_edit.styleSheet())
+        offload_selector_layout.addWidget(self.offload_path_line_edit)
+
+        def browse_offload_folder():
+            folder = QFileDialog.getExistingDirectory(
+                self,
+                "Select Offload Folder",
+                self.offload_directory or self.default_capture_directory
+            )
+            if folder:
+                self.offload_path_line_edit.setText(folder)
+                self.offload_directory = folder
+
+        def clear_offload_folder():
+            self.offload_path_line_edit.clear()
+            self.offload_directory = None
+
+        browse_offload_button = QPushButton("Browse")
+        browse_offload_button.setStyleSheet(self.standard_button_style)
+        browse_offload_button.clicked.connect(browse_offload_folder)
+        offload_selector_layout.addWidget(browse_offload_button)
+
+        clear_offload_button = QPushButton("Clear")
+        clear_offload_button.setStyleSheet(self.standard_button_style)
+        clear_offload_button.clicked.connect(clear_offload_folder)
+        offload_selector_layout.addWidget(clear_offload_button)
+
         ## Fibonacci sphere controls ##
         fibonacci_widget = QWidget()
         self.capture_sequence_stack.addWidget(fibonacci_widget)
@@ -847,21 +1103,27 @@ class ControlUI(QMainWindow):
             self.run_live_view()
         elif index == 0:
             self.run_capture_view()
+        elif index == 2:
+            self.run_gallery_view()
 
     def run_live_view(self):
-        self.camera.SetLiveViewEnable(True)
+        self.camera.set_live_view_enabled(True)
         thread = QThread()
         worker = LiveViewWorker(self.camera)
         worker.moveToThread(thread)
         thread.started.connect(worker.start)
         worker.live_view_frame_ready.connect(self.live_view.on_frame)
+        worker.live_view_failed.connect(self.on_live_view_failed)
         self.live_view_worker = worker
         self.live_view_thread = thread
         thread.start()
 
 
-    def run_capture_view(self):
+    def on_live_view_failed(self, message):
+        self.output_to_terminal(f"Live view stopped: {message}")
+        self.stop_live_view()
 
+    def stop_live_view(self):
         # Shut down live view processes, in case they are running
         if self.live_view_worker:
             self.live_view_worker.stop()
@@ -870,12 +1132,24 @@ class ControlUI(QMainWindow):
             self.live_view_worker = None
             self.live_view_thread = None
 
-        folder = Path(self.capture_directory)
-        image_exts = {".iiq"}
-        files = [f for f in folder.iterdir() if f.suffix.lower() in image_exts and f.is_file()]
-        if files:
-            newest = max(files, key=lambda f: f.stat().st_ctime)
-            self.display_image(newest)
+    def run_capture_view(self):
+        self.stop_live_view()
+        newest = self.capture_index.latest()
+        if newest is not None:
+            self.display_image(os.path.join(self.capture_index.directory, newest))
+
+    def run_gallery_view(self):
+        self.stop_live_view()
+        self.gallery.set_capture_index(self.capture_index)
+
+    def on_capture_index_changed(self):
+        self.capture_index_shown_version = self.capture_index.version
+        if self.center_tabs.currentWidget() is self.gallery:
+            self.gallery.refresh_sessions()
+
+    def show_gallery_shot(self, path, archive_path):
+        self.center_tabs.setCurrentWidget(self.last_image)
+        self.display_image(path, archive_path)
 
 
 #endregion
@@ -1060,50 +1334,15 @@ class ControlUI(QMainWindow):
             self.cols_value_label.setVisible(False)
 
     def parseCSV(self, file_path):
-        with open(file_path, 'r') as f:
-            reader = csv.reader(f)
-            data = list(reader)
-            active_section = None
+        try:
+            self.spin_rows, self.spin_cols = read_spin_positions(file_path)
+        except (OSError, ValueError) as e:
+            self.output_to_terminal(str(e))
             self.spin_rows = []
             self.spin_cols = []
-            reset = False
-            for line in data:
-                if line:
-                    if line[0].startswith("#"):
-                        continue
-                    elif line[0].startswith("rows"):
-                        active_section = "rows"
-                        continue
-                    elif line[0].startswith("cols"):
-                        active_section = "cols"
-                        continue
-                    if active_section == "rows":
-                        try:
-                            phi = float(line[0])
-                            h = float(line[1])
-                            if phi < self.PHI_MIN or phi > self.PHI_MAX or h < self.H_MIN or h > self.H_MAX:
-                                self.output_to_terminal("CSV file contains out-of-bounds phi or h positions")
-                                reset = True
-                        except ValueError:
-                            self.output_to_terminal("CSV file is not formatted correctly")
-                            reset = True
-                        self.spin_rows.append([phi, h])
-                    elif active_section == "cols":
-                        try:
-                            theta = float(line[0])
-                            if theta < self.THETA_MIN or theta > self.THETA_MAX:
-                                self.output_to_terminal("CSV file contains out-of-bounds theta positions")
-                                reset = True
-                        except ValueError:
-                            self.output_to_terminal("CSV file is not formatted correctly")
-                            reset = True
-                        self.spin_cols.append(theta)
-                    if reset:
-                        self.spin_rows = []
-                        self.spin_cols = []
-                        self.file_path_line_edit.setText(" ")
-                        return
-        
+            self.file_path_line_edit.setText(" ")
+            return
+
         self.rows_value_label.setText(str(len(self.spin_rows)))
         if self.spin_cols:
             self.cols_line_edit.setVisible(False)
@@ -1165,11 +1404,20 @@ class ControlUI(QMainWindow):
 
     def initialize_camera(self):
         try:
-            self.camera = Camera.OpenUsbCamera()
+            self.camera = camera.open_camera(self.simulate)
             self.output_to_terminal("Camera connected") #TODO add camera details
             self.camera_connect_checkbox.setChecked(True)
-            self.camera.EnableImageReceiving(True)
-            self.camera.SetHostStorageCapacity(1000000) # value in MB
+            self.update_host_storage_capacity()
+            self.capture_pipeline = CapturePipeline(
+                self.camera,
+                writer=ImageWriter(memory_budget=self.IMAGE_WRITER_MEMORY_BUDGET, fsync=self.IMAGE_WRITER_FSYNC),
+                on_exposed=self.capture_exposed.emit,
+                on_saved=self.capture_saved.emit,
+                on_error=self.capture_failed.emit,
+                make_preview=self.render_capture_preview,
+                on_preview=self.capture_preview_ready.emit,
+                on_preview_error=self.capture_preview_failed.emit,
+            )
         except Exception as e:
             self.output_to_terminal(f"Unable to connect to camera [{str(e)}]")
             self.camera = None
@@ -1180,19 +1428,28 @@ class ControlUI(QMainWindow):
             self.initialize_camera()
         else:
             if self.camera is not None:
-                self.camera.Dispose()
+                self.close_capture_pipeline()
+                self.camera.close()
                 self.camera = None
                 self.output_to_terminal("Camera disconnected")
             else:
                 print("There was no camera to disconnect")
 
+    def close_capture_pipeline(self):
+        # Images that are still on their way to the disk are finished first
+        if self.capture_pipeline is not None:
+            self.capture_pipeline.close()
+            self.capture_pipeline = None
+
     ### MACHINE RELATED FUNCTIONS ###
 
     def home_axis(self, axis):
         if axis < 3:
+            self.moving_axes.add(axis)
             self.send_command(f'H{axis}')
         elif axis == 3:
             for a in range(3):
+                self.moving_axes.add(a)
                 self.send_command(f'H{a}')
     
     def new_position_entered(self, axis, value):
@@ -1234,204 +1491,131 @@ class ControlUI(QMainWindow):
         self.update_positions = True
 
     def setup_serial_polling(self):
-        """Setup timer to poll microcontroller for serial output"""
-        self.serial_timer = QTimer()
-        self.serial_timer.timeout.connect(self.poll_serial)
-        self.serial_timer.start(100)  # Poll every 100ms, must be greater than microcontroller estop delay (50ms)
+        """Start the thread that reads and polls the microcontroller"""
+        if not self.microcontroller_connected:
+            return
+        thread = QThread()
+        worker = SerialWorker(self.serial)
+        worker.moveToThread(thread)
+        thread.started.connect(worker.start)
+        worker.status_received.connect(self.on_status_received)
+        worker.move_complete.connect(self.on_move_complete)
+        worker.rates_received.connect(self.on_rates_received)
+        worker.homing_complete.connect(self.on_homing_complete)
+        worker.needs_homing.connect(self.on_needs_homing)
+        worker.limit_switch_hit.connect(lambda switch: print("Limit switch hit: " + switch))
+        worker.wrong_direction.connect(lambda switch: print("Limit switch hit from the wrong direction: " + switch))
+        worker.estop_changed.connect(self.on_estop_changed)
+        worker.invalid_reply.connect(lambda line: print("Received invalid serial code from microcontroller: " + line))
+        worker.binary_mode_changed.connect(lambda binary: print("Controller protocol: " + ("binary" if binary else "ASCII")))
+        self.serial_worker = worker
+        self.serial_thread = thread
+        thread.start()
+        self.request_rates()
 
     def initialize_hardware(self):
         # Connect to microcontroller
         try:
-            self.serial = serial.Serial('COM3', 115200, dsrdtr=True)
+            if self.simulate:
+                self.serial = SimulatedController()
+            else:
+                self.serial = serial.Serial('COM3', 115200, dsrdtr=True)
             self.serial.write('\r\n\r\n'.encode())
             self.serial.flushInput()
             self.microcontroller_connected = True
             self.output_to_terminal("Motors connected")
         except Exception as e:
             self.output_to_terminal(f"Unable to connect to motors: {str(e)}")
-        if self.microcontroller_connected:
-            self.poll_serial()
-            self.request_rates()
 
         # Connect to camera
         self.initialize_camera()
 
-    def poll_serial(self):
-        if self.microcontroller_connected:
-            estop_signal_detected = False
-            while self.serial.in_waiting:
-                line_full = self.serial.readline().decode().strip()
-                # print(line_full)
-                line = line_full.split()
-                if line:
-                    if line[0] == "P":
-                        # print(line)
-                        for axis in range(3):
-                            is_running = int(line[axis * 2 + 1])
-                            pos_in_steps = int(line[axis * 2 + 2])
-
-                            # if this motor just stopped, update all positions in the UI 
-                            if not is_running and self.motor_data[axis]["is_running"] is not None and self.motor_data[axis]["is_running"] != is_running:
-                                print(self.target_positions, axis)
-                                self.target_positions[axis] = None
-                                self.update_positions = True
-                                # if the other motors were already stopped, emit all_motors_stopped
-                                other_axes = [i for i in range(3) if i != axis]
-                                print("~other axes: ", other_axes)
-                                if all(not self.motor_data[i]["is_running"] for i in other_axes):
-                                    self.all_motors_stopped.emit()
-                                    print("ALL MOTORS STOPPED")
-
-                            self.motor_data[axis]["is_running"] = is_running
-                            self.motor_data[axis]["steps"] = pos_in_steps
-
-                        if self.update_positions:
-                            list_of_step_values = [self.motor_data[i]["steps"] for i in range(3)]
-                            positions = self.steps_to_positions(list_of_step_values)
-                            for i in range(3):
-                                if self.target_positions[i] is None:
-                                    if not (i == 2 and self.target_positions[1] is not None): # special case to only update nod if track is done moving
-                                        self.geo[i]['pos_line_edit'].setText(f"{positions[i]:.3f}")
-                                        print("___updating position, axis: ", i, " targets: ", self.target_positions)
-                            self.update_positions = False
-                    elif line[0] == "R":
-                        for axis in range(3):
-                            speed = float(line[axis * 2 + 1])
-                            accel = float(line[axis * 2 + 2])
-                            speed_percent = self.rate_to_percentage(speed)
-                            self.motor_data[axis]["speed"] = speed_percent
-                            self.geo[axis]['speed_slider'].setValue(speed_percent)
-                            accel_percent = self.rate_to_percentage(accel)
-                            self.motor_data[axis]["accel"] = accel_percent
-                            self.geo[axis]['accel_slider'].setValue(accel_percent)
-                    elif line[0] == "N":
-                        self.needs_homing_flag = True
-                        print("NNNNNN")
-                    elif line[0] == "H":
-                        axis = int(line[1])
-                        self.homing[axis] = False
-                    elif line[0] == "E":
-                        estop_signal_detected = True
-                    elif line[0] == "D":
-                        pass
-                        # print(line_full)
-                    # elif line[0] == "A":
-                    #     self.alarm_flag = True
-                    # elif line[0] == "W":
-                    #     self.wrong_direction_flag = True
-                    else:
-                        print("Received invalid serial code from microcontroller: " + line_full)
-                
-            self.send_command('P')
-
-            if estop_signal_detected and not self.estop_pressed:
-                self.estop_pressed = True
-                self.output_to_terminal("Emergency stop button has been pressed. Please release the button to re-enable the machine.")
-                self.disable_manual_controls()
-            elif not estop_signal_detected and self.estop_pressed:
-                self.estop_pressed = False
-                self.output_to_terminal("Emergency stop button has been released")
-                self.enable_manual_controls()
-
-            self.update_position_colors()
-
-            if self.needs_homing_flag:
-                self.needs_homing()
-                self.needs_homing_flag = False
-    
+    def on_status_received(self, is_running_values, step_values):
+        for axis in range(3):
+            # A status reply can predate a move that was just sent, the move only ends with its C reply
+            self.motor_data[axis]["is_running"] = int(is_running_values[axis] or axis in self.moving_axes)
+            self.motor_data[axis]["steps"] = step_values[axis]
+        self.update_position_display()
+
+    def on_move_complete(self, axis, steps):
+        self.motor_data[axis]["is_running"] = 0
+        self.motor_data[axis]["steps"] = steps
+        self.target_positions[axis] = None
+        self.update_positions = True
+        if axis in self.moving_axes:
+            self.moving_axes.discard(axis)
+            if not self.moving_axes:
+                self.all_motors_stopped.emit()
+        self.update_position_display()
+
+    def clear_moving_axes(self):
+        if self.moving_axes:
+            self.moving_axes.clear()
+            self.all_motors_stopped.emit()
+
+    def update_position_display(self):
+        step_values = [self.motor_data[i]["steps"] for i in range(3)]
+        if self.update_positions and None not in step_values:
+            positions = self.steps_to_positions(step_values)
+            for i in range(3):
+                if self.target_positions[i] is None:
+                    if not (i == 2 and self.target_positions[1] is not None): # special case to only update nod if track is done moving
+                        self.geo[i]['pos_line_edit'].setText(f"{positions[i]:.3f}")
+            self.update_positions = False
+
+        self.update_position_colors()
+
+    def on_rates_received(self, speeds, accelerations):
+        for axis in range(3):
+            self.motor_data[axis]["max_speed"] = speeds[axis]
+            self.motor_data[axis]["acceleration"] = accelerations[axis]
+            speed_percent = self.rate_to_percentage(speeds[axis])
+            self.motor_data[axis]["speed"] = speed_percent
+            self.geo[axis]['speed_slider'].setValue(speed_percent)
+            accel_percent = self.rate_to_percentage(accelerations[axis])
+            self.motor_data[axis]["accel"] = accel_percent
+            self.geo[axis]['accel_slider'].setValue(accel_percent)
+
+    def on_needs_homing(self):
+        # Cancel before the waits on the rejected moves are released, so a sequence can't take a
+        # shot where the axes happen to be
+        if self.sequence_active_flag:
+            self.cancel_sequence()
+        self.clear_moving_axes() # rejected moves never complete
+        # Every rejected move command gets its own N reply, only report them once
+        if not self.needs_homing_flag:
+            self.needs_homing_flag = True
+            QTimer.singleShot(100, self.needs_homing)
+
+    def on_homing_complete(self, axis):
+        self.homing[axis] = False
+
+    def on_estop_changed(self, pressed):
+        if pressed and not self.estop_pressed:
+            self.estop_pressed = True
+            self.clear_moving_axes()
+            self.output_to_terminal("Emergency stop button has been pressed. Please release the button to re-enable the machine.")
+            self.disable_manual_controls()
+        elif not pressed and self.estop_pressed:
+            self.estop_pressed = False
+            self.output_to_terminal("Emergency stop button has been released")
+            self.enable_manual_controls()
+
     def request_rates(self):
         self.send_command('R')
 
     def send_command(self, command):
         if self.microcontroller_connected:
             l = command.strip() # Strip all EOL characters for consistency
-            command_nl = l + '\n'
-            self.serial.write(command_nl.encode())
+            self.serial_worker.write(l)
             if not l.endswith('P'):
-                print("Sent command to microcontroller: " + command_nl.strip())
-
-    def steps_to_degrees(self, axis, steps):
-        match axis:
-            case 0:
-                return (steps / self.STAGE_STEPS_PER_REVOLUTION) * 360.0
-            case 1:
-                return 3.44e-11 * math.pow(steps, 2) + 1.11e-4 * steps - self.TRACK_DEGREE_OFFSET
-                # return ((self.TRACK_MAX_DEGREES / self.TRACK_MAX_STEPS) * steps) - self.TRACK_DEGREE_OFFSET
-            case 2:
-                return ((self.NOD_MAX_DEGREES / self.NOD_MAX_STEPS) * steps) - self.NOD_DEGREE_OFFSET
-    
-    def degrees_to_steps(self, axis, degrees):
-        match axis:
-            case 0:
-                return int(self.STAGE_STEPS_PER_REVOLUTION * degrees / 360.0)
-            case 1:
-                return int((-1.11e-4 + math.sqrt(1.2321e-8 + 1.376e-10 * (self.TRACK_DEGREE_OFFSET + degrees))) / 6.88e-11)
-                # return int((self.TRACK_MAX_STEPS / self.TRACK_MAX_DEGREES) * (degrees + self.TRACK_DEGREE_OFFSET))
-            case 2:
-                return int((self.NOD_MAX_STEPS / self.NOD_MAX_DEGREES) * (degrees + self.NOD_DEGREE_OFFSET))
-
-    def degrees_to_positions(self, degree_values: list[float]):
-        g_k = math.radians(degree_values[2]) + math.pi - np.acos(self.L2_LENGTH / self.L1_LENGTH)
-        p_k = math.radians(degree_values[1])
-
-        # calculate theta
-        theta = degree_values[0] % 360
-
-        h = (self.L1_LENGTH * math.cos(g_k) + self.L2_LENGTH) / math.sin(p_k + g_k)# + self.H_OFFSET
-        h_with_offset = h + self.H_OFFSET
-        #h = degree_values[2]
-        #h_gem = (L1 * np.cos(t2) + L2) / np.sin(t1 + t2)
-        
-        # calculate phi prime (shifted phi so it is centered around (0, h))
-        phi_prime = degree_values[1]
-
-        return [theta, phi_prime, h_with_offset]
-
-    def positions_to_degrees(self, position_values: list[float]):
-        p = position_values
-
-        # calculate stage motor degrees
-        current_stage_motor_degrees = self.steps_to_degrees(0, self.motor_data[0]["steps"])
-        current_revs = current_stage_motor_degrees // 360
-        diff = current_stage_motor_degrees % 360 - p[0]
-        k = round(diff / 360)
-        current_revs += k
-        stage_motor_degrees = p[0] + (current_revs * 360)
-
-        # calculate track motor degrees
-        track_motor_degrees = p[1]
-
-        # calculate nod motor degrees
-        # nod_motor_degrees = p[2]
-        h = p[2] - self.H_OFFSET
-        p_k = math.radians(track_motor_degrees)
-
-        term1 = np.atan2(-(h - self.L1_LENGTH * np.sin(p_k)), self.L1_LENGTH * np.cos(p_k))
-        term2 = np.arccos(-self.L2_LENGTH / np.sqrt((self.L1_LENGTH*np.cos(p_k))**2 + (h - self.L1_LENGTH*np.sin(p_k))**2))
-        g_k = term1 + term2 - p_k
-        nod_motor_degrees = math.degrees(g_k - math.pi + np.arccos(self.L2_LENGTH / self.L1_LENGTH))  # convert back to degrees
-
-        # const_1 = math.atan2(h_off * math.cos(tmd), h_off * math.sin(tmd) - self.L1_LENGTH)
-        # const_2 = math.sqrt(math.pow(h_off * math.sin(tmd) - self.L1_LENGTH, 2) + h_off * math.pow(math.cos(tmd), 2))
-        # nod_motor_degrees = const_1 - math.acos(self.L2_LENGTH / const_2)
-
-        return [stage_motor_degrees, track_motor_degrees, nod_motor_degrees]
+                print("Sent command to microcontroller: " + l)
 
     def steps_to_positions(self, steps: list[int]):
-        print("steps_to_positions step values: ", steps)
-        degree_values = [self.steps_to_degrees(i, s) for i, s in enumerate(steps)]
-        print("steps_to_positions degree values: ", degree_values)
-        position_values = self.degrees_to_positions(degree_values)
-        print("steps_to_positions position values: ", position_values)
-        return position_values
+        return kinematics.steps_to_positions(steps)[0].tolist()
 
     def positions_to_steps(self, positions: list[float]):
-        print("positions_to_steps position values: ", positions)
-        degree_values = self.positions_to_degrees(positions)
-        print("positions_to_steps degree values: ", degree_values)
-        step_values = [self.degrees_to_steps(i, degree_values[i]) for i in range(3)]
-        print("positions_to_steps step values: ", step_values)
-        return step_values
+        return kinematics.positions_to_steps(positions, self.motor_data[0]["steps"])[0].tolist()
 
     def rate_to_percentage(self, rate):
         return int(100 * rate / 4000.0)
@@ -1455,6 +1639,7 @@ class ControlUI(QMainWindow):
                     steps = 0
 
         sign = '+' if steps >= 0 else '-'
+        self.moving_axes.add(axis)
         self.send_command("M" + str(axis) + sign + str(abs(steps)))
         return steps
 
@@ -1466,8 +1651,25 @@ class ControlUI(QMainWindow):
             return False
         
         step_values = self.positions_to_steps(position_values)
+        return self.move_to_steps(step_values)
+
+    def move_to_steps(self, step_values, coordinated=False):
+        """Move all axes. A coordinated move scales the rates of each axis so they all arrive at the same time."""
+        current_step_positions = [self.motor_data[i]['steps'] for i in range(3)]
+        if list(step_values) == current_step_positions:
+            return False
+        if not coordinated:
+            for axis in range(3):
+                self.move_to_step_position(axis, int(step_values[axis]))
+            return True
+
+        step_values = kinematics.clamp_steps(step_values)[0]
         for axis in range(3):
-            self.move_to_step_position(axis, step_values[axis])
+            steps = int(step_values[axis])
+            sign = '+' if steps >= 0 else '-'
+            self.moving_axes.add(axis)
+            self.send_command("T" + str(axis) + sign + str(abs(steps)))
+        self.send_command("G")
         return True
 
     def set_rate(self, axis, percent, type):
@@ -1494,24 +1696,29 @@ class ControlUI(QMainWindow):
         self.send_command("E" + str(axis))
 
     def needs_homing(self):
-        if self.sequence_active_flag:
-            self.cancel_sequence()
+        self.needs_homing_flag = False
         self.output_to_terminal("All axes need to be homed before continuing operation")
 
     ### CAPTURE SEQUENCE RELATED FUNCTIONS ###
-    def move_capture_wait(self, theta, phi, h):
-        print("Moving to position: ", theta, phi, h)
-        moved = self.move_to_position([theta, phi, h])
-        # self.move_to_position(0, theta)
-        # self.move_to_position(1, phi)
-        # self.move_to_position(2, h)
+    def move_capture_wait(self, step_values, filenames=(), index=None, camera_settings=None, archive=None):
+        move_start_time = time.perf_counter()
+        moved = self.move_to_steps(step_values, coordinated=self.coordinated_moves_checkbox.isChecked())
         if moved:
             self.wait_for_all_motors_stopped()
-        if self.sequence_active_flag:
-            self.capture_image()
-
-    def capture_spin_set(self):
-        self.output_to_terminal("Starting spin set capture sequence...")
+        move_time = time.perf_counter() - move_start_time if moved else None
+        for shot, filename in enumerate(filenames):
+            if not self.sequence_active_flag:
+                break
+            record = None
+            if index is not None:
+                actual_steps = [self.motor_data[i]["steps"] for i in range(3)]
+                record = ShotRecord(self.capture_plan.session_id, index, shot, filename, self.capture_plan.positions[index].tolist(),
+                                    [int(s) for s in step_values], actual_steps, camera_settings)
+                record.move_time = move_time if shot == 0 else None
+                record.archive = os.path.basename(archive.path) if archive is not None else None
+            self.capture_image(filename=filename, index=index, shot=shot, record=record, archive=archive)
+
+    def build_spin_set_plan(self):
         if self.rows_value_label.isVisible():
             row_values = self.spin_rows
         else:
@@ -1524,18 +1731,197 @@ class ControlUI(QMainWindow):
         else:
             num_cols = int(self.cols_line_edit.text())
             col_values = np.linspace(0, 360, num=num_cols, endpoint=False).tolist()
-        
-        print("??? starting main capture loop")
-        for r in row_values:
-            for c in col_values:
-                if self.cancel_sequence_flag:
-                    self.cancel_sequence_flag = False
-                    return
-                self.move_capture_wait(c, r[0], r[1])
 
+        shots_per_position = max(int(self.num_captures_line_edit.text()), 1)
+
+        return CapturePlan.from_spin_set(row_values, col_values, *self.current_motion_parameters(),
+                                         coordinated=self.coordinated_moves_checkbox.isChecked(),
+                                         shots_per_position=shots_per_position)
+
+    def current_motion_parameters(self):
+        start_steps = [self.motor_data[i]["steps"] or 0 for i in range(3)]
+        max_speeds = [self.motor_data[i]["max_speed"] or motion.DEFAULT_MAX_SPEEDS[i] for i in range(3)]
+        accelerations = [self.motor_data[i]["acceleration"] or motion.DEFAULT_ACCELERATIONS[i] for i in range(3)]
+        return start_steps, max_speeds, accelerations
+
+    def order_capture_plan(self, plan):
+        """Order a plan the way the UI is set up. Ordering a large grid takes a while, so it runs
+        on a thread and the UI keeps running until it reports back through capture_plan_ordered."""
+        order = self.capture_plan_orderer()
+        loop = QEventLoop()
+        report = None
+
+        def on_ordered(ordered_report):
+            nonlocal report
+            report = ordered_report
+            loop.quit()
+
+        def run():
+            try:
+                self.capture_plan_ordered.emit(order(plan))
+            except Exception as e:
+                self.capture_plan_ordered.emit(f"Unable to reorder the capture positions: {str(e)}")
+
+        # Connected before the thread starts so the signal can't be missed
+        self.capture_plan_ordered.connect(on_ordered)
+        threading.Thread(target=run, name="capture plan order", daemon=True).start()
+        loop.exec_()
+        self.capture_plan_ordered.disconnect(on_ordered)
+        if report is not None:
+            self.output_to_terminal(report)
+
+    def capture_plan_orderer(self):
+        """Function that orders a plan the way the UI is set up and returns what to report. The UI
+        is read here, so the function itself can run on any thread."""
+        method = ["shortest", "serpentine", "file"][self.capture_order_dropdown.currentIndex()]
+        motion_parameters = self.current_motion_parameters()
+        coordinated = self.coordinated_moves_checkbox.isChecked()
+
+        def order(plan):
+            original_duration, duration = path_planner.optimize_order(plan, *motion_parameters, method=method, coordinated=coordinated)
+            if method != "file":
+                return f"Reordered capture positions, estimated motion time {duration:.0f} s (file order: {original_duration:.0f} s)"
+            return None
+
+        return order
+
+    def capture_spin_set(self):
+        self.output_to_terminal("Starting spin set capture sequence...")
+
+        plan = CapturePlan.load(self.capture_directory)
+        if plan is not None and plan.written.any() and not plan.is_complete():
+            self.output_to_terminal(f"Found an unfinished capture plan in the capture folder ({plan.completed} of {len(plan)} positions done). " \
+            "Type 'resume' to continue it, or press ENTER to start a new one.")
+            output = self.wait_for_user_txt_input()
+            if output == "abort":
+                return
+            if output.strip().lower() == "resume":
+                plan.resume_from(self.motor_data[0]["steps"] or 0)
+            else:
+                plan = None
+        else:
+            plan = None
+
+        # Generate, convert and validate the whole plan before the first move
+        if plan is None:
+            plan = self.build_spin_set_plan()
+            self.order_capture_plan(plan)
+            if self.cancel_sequence_flag:
+                # Cancelled while the plan was being ordered
+                self.cancel_sequence_flag = False
+                return
+        try:
+            plan.validate()
+        except ValueError as e:
+            self.output_to_terminal(f"{str(e)}, cannot start capture sequence")
+            self.end_sequence()
+            return
+        if not self.check_session_estimate(plan):
+            self.end_sequence()
+            return
+        plan.save(self.capture_directory)
+        self.capture_plan = plan
+        self.open_session_index(self.capture_directory)
+        archive = None
+        if self.session_archive_checkbox.isChecked():
+            archive = self.open_session_archive(os.path.join(self.capture_directory, plan.session_id + ArchiveWriter.SUFFIX))
+            if archive is None:
+                self.end_sequence()
+                return
+        self.start_offload()
+        camera_settings = self.camera.settings() if self.camera is not None else {}
+        remaining = plan.remaining()
+        self.output_to_terminal(f"Capturing {len(remaining)} positions ({plan.shots_per_position} shots each), " \
+                                f"estimated motion time {plan.remaining_duration():.0f} s")
+
+        sequence_start_time = time.time()
+        for done, i in enumerate(remaining.tolist(), 1):
+            if self.cancel_sequence_flag:
+                self.cancel_sequence_flag = False
+                return
+            # Progress is saved by on_capture_saved once the image is on disk
+            self.move_capture_wait(plan.steps[i], plan.filenames[i], index=i, camera_settings=camera_settings, archive=archive)
+            if self.sequence_active_flag:
+                self.update_sequence_progress(plan, remaining, done, time.time() - sequence_start_time)
+
+        self.wait_for_captures_saved()
+        if self.capture_pipeline is not None:
+            self.output_to_terminal(f"Image writer: {self.capture_pipeline.writer.metrics()}")
+        self.close_session_archive()
+        if archive is not None:
+            # Archived shots aren't in the capture index, show them now that the archive has its index
+            self.on_capture_index_changed()
+        if self.replicator is not None:
+            if archive is not None:
+                self.replicator.submit(os.path.basename(archive.path))
+            self.replicator.submit(CapturePlan.FILE_NAME)
+            self.replicator.submit_index(SessionIndex.FILE_NAME)
         self.output_to_terminal("Spin set capture sequence complete")
         self.end_sequence()
 
+    def check_session_estimate(self, plan):
+        """Report what the plan will take. Returns False if it can't or shouldn't be started."""
+        self.update_host_storage_capacity()
+        try:
+            estimate = preflight.estimate_session(plan, self.capture_directory, offload_directory=self.offload_directory)
+        except OSError as e:
+            self.output_to_terminal(f"Unable to check the free disk space: {str(e)}")
+            return True
+        for line in str(estimate).splitlines():
+            self.output_to_terminal(line)
+        if not estimate.ok:
+            self.output_to_terminal("Not enough disk space, cannot start capture sequence")
+            return False
+        if estimate.warnings:
+            self.output_to_terminal("Type 'start' to capture anyway, or press ENTER to cancel.")
+            if self.wait_for_user_txt_input().strip().lower() != "start":
+                self.output_to_terminal("Spin set capture cancelled")
+                return False
+        return True
+
+    def estimate_spin_set(self):
+        """Dry run: plan the spin set and report the estimate without moving. Ordering a large
+        grid takes a while, so it runs on a thread and reports through spin_set_estimated."""
+        try:
+            plan = self.build_spin_set_plan()
+        except ValueError as e:
+            self.output_to_terminal(f"Unable to estimate the spin set: {str(e)}")
+            return
+        order = self.capture_plan_orderer()
+        directory, offload_directory = self.capture_directory, self.offload_directory
+
+        def estimate():
+            try:
+                report = order(plan)
+                plan.validate()
+                estimate = preflight.estimate_session(plan, directory, offload_directory=offload_directory)
+            except (ValueError, OSError) as e:
+                self.spin_set_estimated.emit([f"Unable to estimate the spin set: {str(e)}"])
+                return
+            self.spin_set_estimated.emit(([report] if report is not None else []) + str(estimate).splitlines())
+
+        self.estimate_button.setEnabled(False)
+        threading.Thread(target=estimate, name="spin set estimate", daemon=True).start()
+
+    def on_spin_set_estimated(self, lines):
+        self.estimate_button.setEnabled(True)
+        for line in lines:
+            self.output_to_terminal(line)
+
+    def update_host_storage_capacity(self):
+        if self.camera is not None:
+            try:
+                self.camera.set_host_storage_capacity(preflight.host_storage_megabytes(self.capture_directory))
+            except OSError as e:
+                self.output_to_terminal(f"Unable to check the free disk space: {str(e)}")
+
+    def update_sequence_progress(self, plan, positions, done, elapsed):
+        # Everything but the moves themselves (settling, capture, transfer) is measured per shot so far
+        motion_time_done = plan.durations[positions[:done]].sum()
+        overhead_per_shot = max(elapsed - motion_time_done, 0.0) / done
+        remaining = plan.durations[positions[done:]].sum() + overhead_per_shot * (len(positions) - done)
+        self.calibrate_button.setText(f"IN PROGRESS {len(plan) - len(positions) + done}/{len(plan)} ({remaining / 60:.0f} min left)")
+
     def capture_fibonacci_sequence(self):
         self.output_to_terminal("Starting Fibonacci capture sequence...")
         # TODO: Implement Fibonacci capture logic
@@ -1561,33 +1947,211 @@ class ControlUI(QMainWindow):
         self.output_to_terminal("Calibration capture sequence complete")
         self.end_sequence()
 
-    def capture_image(self, raw=True, format="IIQ", default_dest=False):
+    def capture_image(self, raw=True, format="IIQ", default_dest=False, filename=None, index=None, shot=0, record=None, archive=None):
+        """Take a shot and return once the shutter has closed. The image is transferred and
+        written in the background, see on_capture_saved."""
         if self.camera is not None:
-            try:
-                self.camera.TriggerCapture()
-                for i in range(1):
-                    frame = self.camera.WaitForImage()
-                    filename = time.strftime("%Y%m%d_%H%M%S")
-                    base_dir = self.default_capture_directory if default_dest else self.capture_directory
-                    path = base_dir + "/" + filename + ".iiq"
-                    data = bytes(frame.Data.ToArray())
-                    with open(path, "wb") as f:
-                        f.write(data)
-                    self.display_image(path)
-                    self.output_to_terminal(f"Image captured: {path}")
-            except Exception as e:
-                self.output_to_terminal(f"Failed to capture image: {str(e)}")
+            if filename is None:
+                # The counter keeps shots taken within the same second apart
+                self.manual_capture_count += 1
+                filename = time.strftime("%Y%m%d_%H%M%S") + f"_{self.manual_capture_count:04d}.iiq"
+            base_dir = self.default_capture_directory if default_dest else self.capture_directory
+            path = base_dir + "/" + filename
+
+            loop = QEventLoop()
+            job = None
+
+            def on_exposed(exposed_job):
+                if exposed_job is job:
+                    loop.quit()
+
+            # Connected before submitting so the signal can't be missed
+            self.capture_exposed.connect(on_exposed)
+            job = self.capture_pipeline.submit(path, index, info=record, archive=archive, shot=shot)
+            if job.exposed_time is None and job.error is None:
+                loop.exec_()
+            self.capture_exposed.disconnect(on_exposed)
         else:
             self.output_to_terminal("No camera connected")
 
+    def wait_for_captures_saved(self):
+        if self.capture_pipeline is None or self.capture_pipeline.pending() == 0:
+            return
+        loop = QEventLoop()
+
+        def on_capture_done(job):
+            if self.capture_pipeline is None or self.capture_pipeline.pending() == 0:
+                loop.quit()
+
+        self.capture_saved.connect(on_capture_done)
+        self.capture_failed.connect(on_capture_done)
+        if self.capture_pipeline.pending():
+            loop.exec_()
+        self.capture_saved.disconnect(on_capture_done)
+        self.capture_failed.disconnect(on_capture_done)
+
+    def on_capture_saved(self, job):
+        self.index_shot(job)
+        if job.archive is None and os.path.dirname(job.path) == self.capture_index.directory:
+            if self.capture_index.add(job.path):
+                # Views are refreshed once the shots settle, by the reconcile
+                self.capture_index_reconcile_timer.start()
+        if self.replicator is not None and job.info is not None and job.archive is None:
+            self.replicator.submit(os.path.relpath(job.path, self.capture_directory), job.checksum)
+        if job.index is not None and self.capture_plan is not None:
+            self.capture_plan.mark_written(job.index, job.shot, self.capture_directory)
+        self.output_to_terminal(f"Image captured: {job.path}")
+
+    def on_capture_failed(self, job):
+        self.index_shot(job)
+        self.output_to_terminal(f"Failed to capture image: {str(job.error)}")
+
+    def index_shot(self, job):
+        if job.info is not None and self.session_index is not None:
+            try:
+                self.session_index.add_shot(job.info, job, size=job.size, checksum=job.checksum)
+            except sqlite3.Error as e:
+                self.output_to_terminal(f"Unable to add {job.path} to the session index: {str(e)}")
 
-    def display_image(self, path):
-        with Image.open(path) as img:
-            width, height = img.size
-            data = img.tobytes()
-            image = QImage(bytes(data), width, height, QImage.Format_RGB888)
-            pxmap = QPixmap.fromImage(image)
-            self.last_image.setPixmap(pxmap)
+    def open_session_index(self, directory):
+        if self.session_index is not None and self.session_index.directory == directory:
+            return
+        self.close_session_index()
+        try:
+            self.session_index = SessionIndex(directory)
+        except sqlite3.Error as e:
+            self.output_to_terminal(f"Unable to open the session index: {str(e)}")
+
+    def close_session_index(self):
+        if self.session_index is not None:
+            self.session_index.close()
+            self.session_index = None
+
+    def setup_capture_index(self):
+        self.capture_folder_watcher = QFileSystemWatcher()
+        self.capture_folder_watcher.directoryChanged.connect(lambda: self.capture_index_reconcile_timer.start())
+        # Changes come in bursts while files are written, rescan once they settle
+        self.capture_index_reconcile_timer = QTimer()
+        self.capture_index_reconcile_timer.setSingleShot(True)
+        self.capture_index_reconcile_timer.setInterval(self.CAPTURE_INDEX_RECONCILE_DELAY)
+        self.capture_index_reconcile_timer.timeout.connect(self.reconcile_capture_index)
+        # In case the watcher misses something, e.g. on a network folder
+        self.capture_index_fallback_timer = QTimer()
+        self.capture_index_fallback_timer.timeout.connect(self.reconcile_capture_index)
+        self.capture_index_fallback_timer.start(self.CAPTURE_INDEX_RECONCILE_INTERVAL)
+        self.open_capture_index(self.capture_directory)
+
+    def open_capture_index(self, directory):
+        if self.capture_index is not None:
+            if self.capture_index.directory == directory:
+                return
+            self.capture_index.save()
+        if self.capture_folder_watcher.directories():
+            self.capture_folder_watcher.removePaths(self.capture_folder_watcher.directories())
+        # Loads the saved index, the reconcile catches up with the folder in the background
+        self.capture_index = CaptureIndex(directory)
+        if os.path.isdir(directory):
+            self.capture_folder_watcher.addPath(directory)
+        self.reconcile_capture_index()
+
+    def reconcile_capture_index(self):
+        index = self.capture_index
+        if os.path.isdir(index.directory) and index.directory not in self.capture_folder_watcher.directories():
+            # The folder is made by the first capture
+            self.capture_folder_watcher.addPath(index.directory)
+
+        def reconcile():
+            # Also report what the capture path added since the views were refreshed
+            if index.reconcile() or index.version != self.capture_index_shown_version:
+                self.capture_index_changed.emit()
+
+        threading.Thread(target=reconcile, name="capture index", daemon=True).start()
+
+    def start_offload(self):
+        """Copy the capture folder to the offload folder in the background while the sequence runs."""
+        if self.offload_directory is None:
+            return
+        source = self.capture_directory
+        if self.replicator is not None:
+            if (self.replicator.source_directory, self.replicator.target_directory) == (source, self.offload_directory):
+                return
+            # The old folders are finished in the background
+            self.replicator.finish()
+            self.replicator = None
+        try:
+            self.replicator = Replicator(
+                source,
+                self.offload_directory,
+                workers=self.OFFLOAD_WORKERS,
+                max_bytes_per_second=self.OFFLOAD_MAX_BYTES_PER_SECOND,
+                should_yield=self.image_writer_busy,
+                on_copied=self.offload_copied.emit,
+                on_error=self.offload_failed.emit,
+            )
+        except OSError as e:
+            self.output_to_terminal(f"Unable to offload to {self.offload_directory}: {str(e)}")
+            return
+        # Shots of earlier runs in this folder that didn't make it across yet
+        if self.session_index is not None:
+            for row in self.session_index.shots():
+                if row["archive"] is None:
+                    self.replicator.submit(row["path"], row["checksum"])
+
+    def image_writer_busy(self):
+        # Called from the offload threads
+        pipeline = self.capture_pipeline
+        return pipeline is not None and pipeline.writer.queue_depth() > 0
+
+    def on_offload_copied(self, item):
+        if not item.skipped:
+            self.output_to_terminal(f"Offloaded {item.name}")
+
+    def on_offload_failed(self, item):
+        self.output_to_terminal(f"Unable to offload {item.name}: {str(item.error)}")
+
+    def open_session_archive(self, path):
+        """Open the archive a sequence appends its shots to, or return None if it can't be."""
+        if self.session_archive is not None and self.session_archive.path == path:
+            return self.session_archive
+        self.close_session_archive()
+        try:
+            self.session_archive = ArchiveWriter(path)
+        except (OSError, ValueError) as e:
+            self.output_to_terminal(f"Unable to open session archive {path}: {str(e)}")
+        return self.session_archive
+
+    def close_session_archive(self):
+        if self.session_archive is not None:
+            # Shots still on their way into it are written first
+            self.wait_for_captures_saved()
+            self.session_archive.close()
+            self.session_archive = None
+
+    def on_capture_preview_ready(self, image):
+        self.last_image.set_image(image)
+
+    def on_capture_preview_failed(self, job):
+        self.output_to_terminal(f"Unable to load preview of {job.path}: {str(job.preview_error)}")
+
+    def render_capture_preview(self, job):
+        # Called from the capture pipeline's preview thread, the rendering itself happens in the cache's process
+        archive_path = job.archive.path if job.archive is not None else None
+        return preview_image(self.preview_cache.load(job.path, archive_path))
+
+    def display_image(self, path, archive_path=None):
+        # Only the last image asked for is shown, whichever preview is ready first
+        self.displayed_path = path
+
+        def on_preview(preview):
+            if self.displayed_path == path:
+                self.capture_preview_ready.emit(preview_image(preview))
+
+        self.preview_cache.request(
+            str(path),
+            archive_path,
+            callback=on_preview,
+            on_error=lambda e: self.preview_failed.emit(f"Unable to load preview of {path}: {str(e)}"),
+        )
         
         
         """
@@ -1705,7 +2269,7 @@ if __name__ == '__main__':
             border-radius: 6px;
         }
     """)
-    window = ControlUI()
+    window = ControlUI(simulate="--simulate" in sys.argv)
     window.show()
     app.exec()
 
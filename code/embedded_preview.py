@@ -0,0 +1,270 @@
+"""
+Embedded previews of IIQ files.
+
+An IIQ file is TIFF-structured: next to the raw data it carries ready-made images, a small RGB
+thumbnail and a JPEG preview, each described by an image file directory (IFD). find_previews()
+walks the IFDs of a file given as a buffer, usually a memory map or an archive entry's view, and
+returns where those images are; load_preview() decodes the one that best fits a size. Only the
+directories and the chosen image are read, never the raw data, so a preview costs the same
+whatever the size of the file.
+
+IFDs are followed through the IFD chain and SubIFDs. Anything that isn't an 8-bit RGB strip
+image or a JPEG is skipped, which is what the raw data looks like.
+
+    python embedded_preview.py <file> [--extract preview.jpg]
+"""
+
+import argparse
+import io
+import mmap
+import struct
+import sys
+
+import numpy as np
+from PIL import Image
+
+# TIFF tags used here
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+SUB_IFDS = 330
+JPEG_INTERCHANGE_FORMAT = 513
+JPEG_INTERCHANGE_FORMAT_LENGTH = 514
+
+UNCOMPRESSED = 1
+OLD_JPEG = 6
+JPEG = 7
+RGB = 2
+
+# struct formats of the integer field types: BYTE, SHORT, LONG, SBYTE, SSHORT, SLONG, IFD
+INTEGER_TYPES = {1: "B", 3: "H", 4: "I", 6: "b", 8: "h", 9: "i", 13: "I"}
+# Size in bytes of one value of every field type
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+# Corrupt files can have IFD loops or absurd counts
+MAX_IFDS = 64
+
+
+class EmbeddedPreview:
+    def __init__(self, kind, width, height, segments):
+        self.kind = kind # "jpeg" or "rgb"
+        self.width = width
+        self.height = height
+        self.segments = segments # (offset, size) of the strips, in order
+
+    @property
+    def size(self):
+        return max(self.width, self.height)
+
+    def read(self, data):
+        """Encoded bytes of the image: a JPEG file or 8-bit RGB rows."""
+        return b"".join(bytes(data[offset:offset + size]) for offset, size in self.segments)
+
+    def decode(self, data):
+        encoded = self.read(data)
+        if self.kind == "jpeg":
+            return Image.open(io.BytesIO(encoded))
+        return Image.frombytes("RGB", (self.width, self.height), encoded[:3 * self.width * self.height])
+
+
+def read_ifd(data, offset, byte_order):
+    """Integer fields of the IFD at offset as {tag: [values]}, and the offset of the next IFD."""
+    (count,) = struct.unpack_from(byte_order + "H", data, offset)
+    fields = {}
+    for entry in range(count):
+        tag, field_type, value_count = struct.unpack_from(byte_order + "HHI", data, offset + 2 + 12 * entry)
+        if field_type not in INTEGER_TYPES or value_count > len(data):
+            continue
+        value_offset = offset + 2 + 12 * entry + 8
+        if TYPE_SIZES[field_type] * value_count > 4:
+            (value_offset,) = struct.unpack_from(byte_order + "I", data, value_offset)
+        fields[tag] = list(struct.unpack_from(f"{byte_order}{value_count}{INTEGER_TYPES[field_type]}", data, value_offset))
+    (next_offset,) = struct.unpack_from(byte_order + "I", data, offset + 2 + 12 * count)
+    return fields, next_offset
+
+
+def jpeg_size(data, offset, size):
+    """(width, height) from a JPEG's frame header, or None."""
+    position, end = offset + 2, offset + size
+    while position + 9 <= end:
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        (length,) = struct.unpack_from(">H", data, position + 2)
+        # Start of frame markers, other than DHT, JPG and DAC
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack_from(">HH", data, position + 5)
+            return width, height
+        position += 2 + length
+    return None
+
+
+def preview_of(fields, data):
+    """The image an IFD describes if it is one we can show, otherwise None."""
+    def field(tag, default=None):
+        return fields[tag][0] if fields.get(tag) else default
+
+    width, height = field(IMAGE_WIDTH), field(IMAGE_LENGTH)
+    compression = field(COMPRESSION, UNCOMPRESSED)
+
+    if JPEG_INTERCHANGE_FORMAT in fields and JPEG_INTERCHANGE_FORMAT_LENGTH in fields:
+        segments = [(field(JPEG_INTERCHANGE_FORMAT), field(JPEG_INTERCHANGE_FORMAT_LENGTH))]
+    elif STRIP_OFFSETS in fields and STRIP_BYTE_COUNTS in fields:
+        segments = list(zip(fields[STRIP_OFFSETS], fields[STRIP_BYTE_COUNTS]))
+    else:
+        return None
+    if not segments or any(offset + size > len(data) for offset, size in segments):
+        return None
+
+    if compression in (OLD_JPEG, JPEG) or JPEG_INTERCHANGE_FORMAT in fields:
+        if len(segments) != 1:
+            return None
+        size = jpeg_size(data, *segments[0])
+        if size is None:
+            return None
+        return EmbeddedPreview("jpeg", *size, segments)
+
+    if (compression == UNCOMPRESSED and field(PHOTOMETRIC) == RGB and field(SAMPLES_PER_PIXEL) == 3
+            and fields.get(BITS_PER_SAMPLE, [8]) in ([8], [8, 8, 8]) and field(PLANAR_CONFIGURATION, 1) == 1
+            and width and height and sum(size for _, size in segments) >= 3 * width * height):
+        return EmbeddedPreview("rgb", width, height, segments)
+    return None
+
+
+def find_previews(data):
+    """Images embedded in a TIFF-structured file, smallest first. Empty for other files."""
+    if len(data) < 8 or bytes(data[:4]) not in (b"II*\x00", b"MM\x00*"):
+        return []
+    byte_order = "<" if bytes(data[:2]) == b"II" else ">"
+    (offset,) = struct.unpack_from(byte_order + "I", data, 4)
+
+    previews = []
+    pending, visited = [offset], set()
+    while pending and len(visited) < MAX_IFDS:
+        offset = pending.pop(0)
+        if offset in visited or not 8 <= offset < len(data) - 2:
+            continue
+        visited.add(offset)
+        try:
+            fields, next_offset = read_ifd(data, offset, byte_order)
+        except struct.error:
+            continue
+        preview = preview_of(fields, data)
+        if preview is not None:
+            previews.append(preview)
+        pending += fields.get(SUB_IFDS, []) + [next_offset]
+    return sorted(previews, key=lambda preview: preview.size)
+
+
+def choose_preview(previews, max_size):
+    """The smallest preview that covers max_size, or the largest one when none does."""
+    for preview in previews:
+        if preview.size >= max_size:
+            return preview
+    return previews[-1] if previews else None
+
+
+def load_preview(data, max_size):
+    """RGB image of the embedded preview that best fits max_size, scaled down to it, or None if
+    the file has none."""
+    preview = choose_preview(find_previews(data), max_size)
+    if preview is None:
+        return None
+    with preview.decode(data) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (max_size, max_size))
+        img.thumbnail((max_size, max_size))
+        return img.convert("RGB")
+
+
+def make_test_file(size, preview_size=(1600, 1200), thumbnail_size=(160, 120), seed=0):
+    """Bytes of a TIFF-structured file laid out like an IIQ file: a small RGB thumbnail and a JPEG
+    preview in the IFD chain, and raw data that fills the file up to size in a SubIFD. Bytes 8 to
+    16 are left free for the fake camera's image number."""
+    def gradient(width, height):
+        pixels = np.empty((height, width, 3), dtype=np.uint8)
+        pixels[..., 0] = np.linspace(0, 255, width, dtype=np.uint8)[None, :]
+        pixels[..., 1] = np.linspace(0, 255, height, dtype=np.uint8)[:, None]
+        pixels[..., 2] = 128
+        return pixels
+
+    thumbnail = gradient(*thumbnail_size).tobytes()
+    jpeg = io.BytesIO()
+    Image.fromarray(gradient(*preview_size)).save(jpeg, "JPEG", quality=85)
+    jpeg = jpeg.getvalue()
+
+    def ifd(entries, next_offset):
+        # entries of (tag, type, values), all values small enough to fit in their entry
+        packed = struct.pack("<H", len(entries))
+        for tag, field_type, values in sorted(entries):
+            value_bytes = struct.pack(f"<{len(values)}{INTEGER_TYPES[field_type]}", *values).ljust(4, b"\0")
+            packed += struct.pack("<HHI", tag, field_type, len(values)) + value_bytes
+        return packed + struct.pack("<I", next_offset)
+
+    def ifd_size(count):
+        return 2 + 12 * count + 4
+
+    thumbnail_ifd_offset = 16
+    preview_ifd_offset = thumbnail_ifd_offset + ifd_size(11)
+    raw_ifd_offset = preview_ifd_offset + ifd_size(5)
+    thumbnail_offset = raw_ifd_offset + ifd_size(8)
+    jpeg_offset = thumbnail_offset + len(thumbnail)
+    raw_offset = jpeg_offset + len(jpeg)
+    raw_size = size - raw_offset
+    if raw_size < 0:
+        raise ValueError(f"a file of {size} bytes can't hold the previews")
+    raw_width = 4096
+    raw_height = raw_size // (2 * raw_width)
+
+    header = b"II*\x00" + struct.pack("<I", thumbnail_ifd_offset) + bytes(8)
+    thumbnail_ifd = ifd([
+        (NEW_SUBFILE_TYPE, 4, [1]), (IMAGE_WIDTH, 4, [thumbnail_size[0]]), (IMAGE_LENGTH, 4, [thumbnail_size[1]]),
+        (BITS_PER_SAMPLE, 3, [8]), (COMPRESSION, 3, [UNCOMPRESSED]), (PHOTOMETRIC, 3, [RGB]),
+        (STRIP_OFFSETS, 4, [thumbnail_offset]), (SAMPLES_PER_PIXEL, 3, [3]), (ROWS_PER_STRIP, 4, [thumbnail_size[1]]),
+        (STRIP_BYTE_COUNTS, 4, [len(thumbnail)]), (SUB_IFDS, 4, [raw_ifd_offset]),
+    ], preview_ifd_offset)
+    preview_ifd = ifd([
+        (NEW_SUBFILE_TYPE, 4, [1]), (IMAGE_WIDTH, 4, [preview_size[0]]), (IMAGE_LENGTH, 4, [preview_size[1]]),
+        (JPEG_INTERCHANGE_FORMAT, 4, [jpeg_offset]), (JPEG_INTERCHANGE_FORMAT_LENGTH, 4, [len(jpeg)]),
+    ], 0)
+    # 16-bit colour filter array data, which find_previews() has to skip
+    raw_ifd = ifd([
+        (NEW_SUBFILE_TYPE, 4, [0]), (IMAGE_WIDTH, 4, [raw_width]), (IMAGE_LENGTH, 4, [raw_height]),
+        (BITS_PER_SAMPLE, 3, [16]), (COMPRESSION, 3, [UNCOMPRESSED]), (PHOTOMETRIC, 3, [32803]),
+        (STRIP_OFFSETS, 4, [raw_offset]), (STRIP_BYTE_COUNTS, 4, [raw_size]),
+    ], 0)
+    data = bytearray(header + thumbnail_ifd + preview_ifd + raw_ifd + thumbnail + jpeg)
+    data += np.random.default_rng(seed).integers(0, 256, raw_size, dtype=np.uint8).tobytes()
+    return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List the previews embedded in an IIQ or TIFF file.")
+    parser.add_argument("file")
+    parser.add_argument("--extract", metavar="PATH", help="save the largest preview")
+    parser.add_argument("--size", type=int, default=0, help="with --extract, save the preview that best fits this size instead")
+    args = parser.parse_args(argv)
+
+    with open(args.file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        previews = find_previews(data)
+        for preview in previews:
+            print(f"{preview.kind:4}  {preview.width:>5} x {preview.height:<5}  {sum(size for _, size in preview.segments):>10} bytes")
+        if not previews:
+            print("No embedded previews")
+            return 1
+        if args.extract:
+            preview = choose_preview(previews, args.size) if args.size else previews[-1]
+            with preview.decode(data) as img:
+                img.convert("RGB").save(args.extract)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
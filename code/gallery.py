@@ -0,0 +1,257 @@
+"""
+Session gallery.
+
+GalleryView lays the shots of a session out by pose, one row of the table per plan row and one
+column per plan column, as read from the plan's filenames (see capture_plan.py). Thumbnails are
+only loaded for cells the table actually paints, by a small thread pool, from the thumbnail cache
+beside the captures (see preview_cache.py). Loads still queued for cells that have been scrolled
+out of view are dropped, and only the most recently used thumbnails are kept in memory, so a
+session of any size browses at the same speed and in the same memory.
+
+Shots come from the capture folder's CaptureIndex, and from session archives in the folder.
+"""
+
+import glob
+import os
+import re
+from collections import OrderedDict
+
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, QSize, Qt, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtWidgets import QAbstractItemView, QComboBox, QHBoxLayout, QLabel, QTableView, QVBoxLayout, QWidget
+
+from capture_index import session_id_of
+from preview_cache import THUMBNAIL_SIZE, render_thumbnail
+from session_archive import ArchiveReader, ArchiveWriter
+
+POSE_PATTERN = re.compile(r"_r(\d+)c(\d+)_.*_s(\d+)\.")
+
+
+def parse_pose(name):
+    """(row, col, shot) from a plan-made name, shots counted from 0; None for other names."""
+    match = POSE_PATTERN.search(name)
+    if match is None:
+        return None
+    row, col, shot = (int(value) for value in match.groups())
+    return row, col, shot - 1
+
+
+class GalleryShot:
+    def __init__(self, name, path, archive_path=None):
+        self.name = name
+        self.path = path
+        self.archive_path = archive_path # None for a file of its own
+
+    @property
+    def key(self):
+        return (self.archive_path, self.path)
+
+
+class ThumbnailLoad:
+    def __init__(self, generation, shot):
+        self.generation = generation
+        self.shot = shot
+        self.cancelled = False # read by the worker before it starts
+
+
+class GalleryModel(QAbstractTableModel):
+    MEMORY_ITEMS = 300
+    WORKERS = 2
+
+    # Emitted from the thumbnail threads
+    thumbnail_ready = pyqtSignal(object, object) # ThumbnailLoad, QImage or None if it couldn't be loaded
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.shots = {} # (row, col) -> GalleryShot
+        self.rows = 0
+        self.cols = 0
+        self.generation = 0 # incremented whenever the session changes
+        self.memory = OrderedDict() # GalleryShot.key -> QPixmap, or None if it couldn't be loaded
+        self.pending = {} # GalleryShot.key -> (ThumbnailLoad, row, col)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(self.WORKERS)
+        self.thumbnail_ready.connect(self.on_thumbnail_ready)
+
+    def set_shots(self, shots, new_session=False):
+        """Show {(row, col): GalleryShot}. Cells of the same session are updated in place."""
+        rows = max((row for row, _ in shots), default=-1) + 1
+        cols = max((col for _, col in shots), default=-1) + 1
+        if new_session or (rows, cols) != (self.rows, self.cols):
+            self.beginResetModel()
+            if new_session:
+                self.generation += 1
+                self.cancel_loads(lambda row, col: True)
+            self.shots, self.rows, self.cols = shots, rows, cols
+            self.endResetModel()
+            return
+        old_shots, self.shots = self.shots, shots
+        for cell in old_shots.keys() | shots.keys():
+            old, new = old_shots.get(cell), shots.get(cell)
+            if (old and old.key) != (new and new.key):
+                index = self.index(*cell)
+                self.dataChanged.emit(index, index)
+
+    def shot(self, index):
+        return self.shots.get((index.row(), index.column()))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.rows
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.cols
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        return f"c{section}" if orientation == Qt.Horizontal else f"r{section}"
+
+    def data(self, index, role=Qt.DisplayRole):
+        shot = self.shot(index)
+        if shot is None:
+            return None
+        if role == Qt.ToolTipRole:
+            return shot.name
+        if role == Qt.DecorationRole:
+            if shot.key in self.memory:
+                self.memory.move_to_end(shot.key)
+                return self.memory[shot.key]
+            # Only asked for cells that are being painted
+            self.load(shot, index.row(), index.column())
+        return None
+
+    def load(self, shot, row, col):
+        if shot.key in self.pending:
+            return
+        load = ThumbnailLoad(self.generation, shot)
+        self.pending[shot.key] = (load, row, col)
+        self.pool.start(lambda: self.load_thumbnail(load))
+
+    def load_thumbnail(self, load):
+        # Runs in the pool
+        if load.cancelled:
+            return
+        try:
+            preview = render_thumbnail(load.shot.path, THUMBNAIL_SIZE, load.shot.archive_path)
+            image = QImage(preview.data, preview.width, preview.height, 3 * preview.width, QImage.Format_RGB888).copy()
+        except Exception:
+            image = None
+        self.thumbnail_ready.emit(load, image)
+
+    def cancel_loads(self, outside):
+        """Drop the loads that haven't started yet for the cells outside(row, col) is True for."""
+        for key, (load, row, col) in list(self.pending.items()):
+            if outside(row, col):
+                load.cancelled = True
+                del self.pending[key]
+
+    def on_thumbnail_ready(self, load, image):
+        key = load.shot.key
+        if self.pending.get(key, (None,))[0] is load:
+            del self.pending[key]
+        if load.generation != self.generation:
+            return
+        self.memory[key] = QPixmap.fromImage(image) if image is not None else None
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.MEMORY_ITEMS:
+            self.memory.popitem(last=False)
+        for (row, col), shot in self.shots.items():
+            if shot.key == key:
+                index = self.index(row, col)
+                self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def close(self):
+        self.cancel_loads(lambda row, col: True)
+        self.pool.waitForDone()
+
+
+class GalleryView(QWidget):
+    # Path of a double-clicked shot and the archive holding it, or None
+    shot_activated = pyqtSignal(str, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.capture_index = None
+
+        layout = QVBoxLayout(self)
+        session_layout = QHBoxLayout()
+        session_layout.addWidget(QLabel("Session"))
+        self.session_dropdown = QComboBox()
+        self.session_dropdown.currentIndexChanged.connect(lambda: self.refresh(new_session=True))
+        session_layout.addWidget(self.session_dropdown, 1)
+        layout.addLayout(session_layout)
+
+        self.model = GalleryModel(self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setIconSize(QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        self.table.horizontalHeader().setDefaultSectionSize(THUMBNAIL_SIZE + 8)
+        self.table.verticalHeader().setDefaultSectionSize(THUMBNAIL_SIZE + 8)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setHorizontalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.table.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.table.horizontalScrollBar().valueChanged.connect(self.cancel_hidden_loads)
+        self.table.verticalScrollBar().valueChanged.connect(self.cancel_hidden_loads)
+        self.table.doubleClicked.connect(self.on_double_clicked)
+        layout.addWidget(self.table)
+
+    def set_capture_index(self, capture_index):
+        self.capture_index = capture_index
+        self.refresh_sessions()
+
+    def refresh_sessions(self):
+        """Update the session list, keeping the selected session. Only sessions with shots that can
+        be laid out by pose are listed, manual captures are grouped by date and have none."""
+        if self.capture_index is None:
+            return
+        session_ids = {session_id for session_id in self.capture_index.session_ids()
+                       if any(parse_pose(name) is not None for name in self.capture_index.session_names(session_id))}
+        session_ids.update(os.path.basename(path)[:-len(ArchiveWriter.SUFFIX)]
+                           for path in glob.glob(os.path.join(self.capture_index.directory, "*" + ArchiveWriter.SUFFIX)))
+        session_ids = sorted(session_ids, reverse=True) # newest first
+        current = self.session_dropdown.currentText()
+        if session_ids != [self.session_dropdown.itemText(i) for i in range(self.session_dropdown.count())]:
+            self.session_dropdown.blockSignals(True)
+            self.session_dropdown.clear()
+            self.session_dropdown.addItems(session_ids)
+            if current in session_ids:
+                self.session_dropdown.setCurrentText(current)
+            self.session_dropdown.blockSignals(False)
+            self.refresh(new_session=self.session_dropdown.currentText() != current)
+        else:
+            self.refresh()
+
+    def refresh(self, new_session=False):
+        """Update the cells of the selected session."""
+        session_id = self.session_dropdown.currentText()
+        shots = {}
+        if self.capture_index is not None and session_id:
+            directory = self.capture_index.directory
+            archive_path = os.path.join(directory, session_id + ArchiveWriter.SUFFIX)
+            names = [(name, None) for name in self.capture_index.session_names(session_id)]
+            if os.path.isfile(archive_path):
+                try:
+                    with ArchiveReader(archive_path) as reader:
+                        names += [(name, archive_path) for name in reader.names() if session_id_of(name) == session_id]
+                except (OSError, ValueError):
+                    pass
+            for name, archive in sorted(names):
+                pose = parse_pose(name)
+                # The first shot of a burst stands for its position
+                if pose is not None and pose[2] == 0:
+                    shots[pose[:2]] = GalleryShot(name, os.path.join(directory, name), archive)
+        self.model.set_shots(shots, new_session)
+
+    def cancel_hidden_loads(self):
+        first_row = self.table.rowAt(0)
+        last_row = self.table.rowAt(self.table.viewport().height() - 1)
+        first_col = self.table.columnAt(0)
+        last_col = self.table.columnAt(self.table.viewport().width() - 1)
+        last_row = last_row if last_row >= 0 else self.model.rows - 1
+        last_col = last_col if last_col >= 0 else self.model.cols - 1
+        self.model.cancel_loads(lambda row, col: not (first_row <= row <= last_row and first_col <= col <= last_col))
+
+    def on_double_clicked(self, index):
+        shot = self.model.shot(index)
+        if shot is not None:
+            self.shot_activated.emit(shot.path, shot.archive_path)
@@ -0,0 +1,188 @@
+"""
+Background image writer.
+
+ImageWriter takes captured images and writes them to disk on its own thread, so neither the GUI
+nor the camera waits for the disk. The images waiting to be written are bounded by a memory
+budget: callers reserve room for an image before triggering the capture that produces it, and
+block while the budget is used up. That keeps a slow disk from filling the PC's memory during a
+long session and paces the sequence to what the storage can sustain instead.
+
+Images can also be appended to a session archive (see session_archive.py) instead of getting a
+file of their own. Each image is hashed as it is written (see integrity.py), so checksums don't
+cost another read of the file. metrics() reports the queue depth, the write throughput and the
+per-file latency.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+import integrity
+from camera import CapturedImage
+
+
+class WriteRequest:
+    def __init__(self, path, image, context=None, archive=None):
+        self.path = path
+        self.image = image
+        self.archive = archive # ArchiveWriter to append to, named after the file
+        self.size = len(image)
+        self.context = context # passed back to the caller untouched
+        self.error = None
+        self.checksum = None
+        self.submit_time = time.perf_counter()
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def latency(self):
+        """Seconds from submission until the file was written."""
+        return self.end_time - self.submit_time
+
+    @property
+    def write_time(self):
+        return self.end_time - self.start_time
+
+
+class WriterMetrics:
+    def __init__(self, queue_depth, queued_bytes, files_written, bytes_written, write_throughput,
+                 mean_latency, max_latency, mean_write_time):
+        self.queue_depth = queue_depth
+        self.queued_bytes = queued_bytes
+        self.files_written = files_written
+        self.bytes_written = bytes_written
+        self.write_throughput = write_throughput # bytes per second while writing
+        self.mean_latency = mean_latency
+        self.max_latency = max_latency
+        self.mean_write_time = mean_write_time
+
+    def __str__(self):
+        megabyte = 1024 * 1024
+        return (f"{self.files_written} files, {self.bytes_written / megabyte:.0f} MB written at "
+                f"{self.write_throughput / megabyte:.0f} MB/s, latency {self.mean_latency:.2f} s mean "
+                f"{self.max_latency:.2f} s max, {self.queue_depth} queued ({self.queued_bytes / megabyte:.0f} MB)")
+
+
+class ImageWriter:
+    DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+    # Latencies of this many recent files go into the metrics
+    METRICS_WINDOW = 100
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, buffering=-1, chunk_size=CapturedImage.WRITE_CHUNK_SIZE,
+                 fsync=False, checksum_algorithm=integrity.DEFAULT_ALGORITHM, on_written=None):
+        self.memory_budget = memory_budget
+        self.buffering = buffering # passed to open()
+        self.chunk_size = chunk_size
+        self.fsync = fsync # flush every file to the disk before reporting it written
+        self.checksum_algorithm = checksum_algorithm # None to skip hashing
+        self.on_written = on_written
+
+        self.lock = threading.Condition()
+        self.queue = deque()
+        self.reserved_bytes = 0 # reservations plus the images waiting or being written
+        self.busy = False
+        self.closing = False
+
+        self.files_written = 0
+        self.bytes_written = 0
+        self.total_write_time = 0.0
+        self.recent = deque(maxlen=self.METRICS_WINDOW)
+
+        self.thread = threading.Thread(target=self._write_loop, name="image writer", daemon=True)
+        self.thread.start()
+
+    def reserve(self, size):
+        """Wait until an image of this size fits in the memory budget and hold the room for it.
+        An image is always let through when nothing else is held, whatever its size."""
+        with self.lock:
+            self.lock.wait_for(lambda: self.reserved_bytes == 0 or self.reserved_bytes + size <= self.memory_budget)
+            self.reserved_bytes += size
+
+    def cancel_reservation(self, size):
+        with self.lock:
+            self.reserved_bytes -= size
+            self.lock.notify_all()
+
+    def submit(self, path, image, context=None, reserved=0, archive=None):
+        """Queue an image for writing. reserved is the room reserved for it beforehand."""
+        request = WriteRequest(path, image, context, archive)
+        with self.lock:
+            self.reserved_bytes += request.size - reserved
+            self.queue.append(request)
+            self.lock.notify_all()
+        return request
+
+    def queue_depth(self):
+        """Images waiting to be written, including the one being written."""
+        with self.lock:
+            return len(self.queue) + int(self.busy)
+
+    def wait_until_idle(self, timeout=None):
+        with self.lock:
+            return self.lock.wait_for(lambda: not self.queue and not self.busy, timeout)
+
+    def close(self):
+        """Write what is queued and stop the thread."""
+        with self.lock:
+            self.closing = True
+            self.lock.notify_all()
+        self.thread.join()
+
+    def metrics(self):
+        with self.lock:
+            latencies = [request.latency for request in self.recent]
+            write_times = [request.write_time for request in self.recent]
+            return WriterMetrics(
+                queue_depth=len(self.queue) + int(self.busy),
+                queued_bytes=sum(request.size for request in self.queue),
+                files_written=self.files_written,
+                bytes_written=self.bytes_written,
+                write_throughput=self.bytes_written / self.total_write_time if self.total_write_time else 0.0,
+                mean_latency=sum(latencies) / len(latencies) if latencies else 0.0,
+                max_latency=max(latencies, default=0.0),
+                mean_write_time=sum(write_times) / len(write_times) if write_times else 0.0,
+            )
+
+    def _write_loop(self):
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: self.queue or self.closing)
+                if not self.queue:
+                    return
+                request = self.queue.popleft()
+                self.busy = True
+
+            request.start_time = time.perf_counter()
+            try:
+                self._write(request)
+            except Exception as e:
+                request.error = e
+            request.end_time = time.perf_counter()
+            request.image.release()
+            request.image = None
+
+            with self.lock:
+                self.busy = False
+                self.reserved_bytes -= request.size
+                if request.error is None:
+                    self.files_written += 1
+                    self.bytes_written += request.size
+                    self.total_write_time += request.write_time
+                    self.recent.append(request)
+                self.lock.notify_all()
+            if self.on_written is not None:
+                self.on_written(request)
+
+    def _write(self, request):
+        hasher = integrity.new_hasher(self.checksum_algorithm) if self.checksum_algorithm is not None else None
+        if request.archive is not None:
+            request.archive.add(os.path.basename(request.path), request.image, self.chunk_size, self.fsync, hasher)
+        else:
+            with open(request.path, "wb", buffering=self.buffering) as f:
+                request.image.write_to(f, self.chunk_size, hasher)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+        if hasher is not None:
+            request.checksum = integrity.format_checksum(self.checksum_algorithm, hasher)
@@ -0,0 +1,152 @@
+"""
+Checksums of captured images.
+
+The image writer hashes every image while it writes it, so the checksum costs no extra read of
+the file. Checksums are stored as "<algorithm>:<hex digest>" in the session index. The algorithm
+is the fastest one available: xxHash (XXH3-128) or BLAKE3 when those packages are installed,
+BLAKE2b from the standard library otherwise. Naming the algorithm lets a session be verified on
+a machine that has a different set installed.
+
+    python integrity.py verify <capture directory> [--workers N]
+
+re-reads every shot in the session index in a pool of processes and compares the checksums.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from session_archive import ArchiveReader
+from session_index import SessionIndex
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def available_algorithms():
+    algorithms = []
+    if xxhash is not None:
+        algorithms.append("xxh3_128")
+    if blake3 is not None:
+        algorithms.append("blake3")
+    algorithms.append("blake2b")
+    return algorithms
+
+
+DEFAULT_ALGORITHM = available_algorithms()[0]
+
+
+def new_hasher(algorithm=DEFAULT_ALGORITHM):
+    """An object with update() and hexdigest() for the algorithm."""
+    match algorithm:
+        case "xxh3_128" if xxhash is not None:
+            return xxhash.xxh3_128()
+        case "blake3" if blake3 is not None:
+            return blake3.blake3()
+        case "blake2b":
+            return hashlib.blake2b()
+        case _:
+            raise ValueError(f"Checksum algorithm {algorithm} is not available")
+
+
+def format_checksum(algorithm, hasher):
+    return f"{algorithm}:{hasher.hexdigest()}"
+
+
+def parse_checksum(checksum):
+    algorithm, _, digest = checksum.partition(":")
+    return algorithm, digest
+
+
+def data_checksum(data, algorithm=DEFAULT_ALGORITHM):
+    """Checksum of a buffer, hashed in chunks."""
+    hasher = new_hasher(algorithm)
+    data = memoryview(data).cast("B")
+    for offset in range(0, data.nbytes, READ_CHUNK_SIZE):
+        hasher.update(data[offset:offset + READ_CHUNK_SIZE])
+    return format_checksum(algorithm, hasher)
+
+
+def file_checksum(path, algorithm=DEFAULT_ALGORITHM):
+    hasher = new_hasher(algorithm)
+    buffer = bytearray(READ_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while count := f.readinto(buffer):
+            hasher.update(view[:count])
+    return format_checksum(algorithm, hasher)
+
+
+def verify_shot(directory, path, archive, checksum):
+    """Recompute a shot's checksum. Returns (path, error), error is None if it matches."""
+    algorithm, _ = parse_checksum(checksum)
+    try:
+        if archive is None:
+            actual = file_checksum(os.path.join(directory, path), algorithm)
+        else:
+            with ArchiveReader(os.path.join(directory, archive)) as reader:
+                if path not in reader:
+                    return path, f"missing from {archive}"
+                with reader.view(path) as data:
+                    actual = data_checksum(data, algorithm)
+    except FileNotFoundError:
+        return path, "missing"
+    except (OSError, ValueError) as e:
+        return path, str(e)
+    if actual != checksum:
+        return path, f"checksum mismatch, expected {checksum}, found {actual}"
+    return path, None
+
+
+def verify_session(directory, workers=None, report=print):
+    """Check every shot with a recorded checksum. Returns the number of bad shots."""
+    if not os.path.isfile(os.path.join(directory, SessionIndex.FILE_NAME)):
+        raise FileNotFoundError(f"No session index in {directory}")
+    index = SessionIndex(directory)
+    try:
+        # A shot taken again after a resume only counts once, the latest row is the one on disk
+        rows = list({(row["archive"], row["path"]): row for row in index.shots()}.values())
+    finally:
+        index.close()
+    shots = [(row["path"], row["archive"], row["checksum"]) for row in rows if row["checksum"]]
+    unchecked = len(rows) - len(shots)
+
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(verify_shot, directory, *shot) for shot in shots]
+        for future in futures:
+            path, error = future.result()
+            if error is not None:
+                failures += 1
+                report(f"{path}: {error}")
+    report(f"{len(shots) - failures} of {len(shots)} shots verified" + (f", {unchecked} without a checksum" if unchecked else ""))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verify captured images against their recorded checksums.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    verify_parser = subparsers.add_parser("verify", help="re-check every shot in a capture directory's session index")
+    verify_parser.add_argument("directory")
+    verify_parser.add_argument("--workers", type=int, default=None, help="processes to hash with (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    try:
+        return 1 if verify_session(args.directory, args.workers) else 0
+    except FileNotFoundError as e:
+        print(e)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Batch conversions between machine positions (θ, φ, h), motor degrees and motor steps.
+
+Every function takes an N×3 array (one row per pose, columns ordered stage/track/nod)
+and converts all rows in one vectorized call, so a whole capture plan can be converted
+and validated before the first move.
+"""
+
+import numpy as np
+
+# these constants were measured using limit switches
+STAGE_STEPS_PER_REVOLUTION = 708839
+TRACK_MAX_STEPS = 780120 - 2 * (4 * 50)
+NOD_MAX_STEPS = 143117 - 2 * (64 * 10)
+
+# these values were measured using a digital angle gauge
+TRACK_MAX_DEGREES = 90.7 + 16.7
+NOD_MAX_DEGREES = 29.9 + 27.4
+
+STAGE_DEGREE_OFFSET = -1.17369
+TRACK_DEGREE_OFFSET = 16.7
+NOD_DEGREE_OFFSET = 29.9
+H_OFFSET = 457.2 # 18 inches to mm
+
+# these values were taken from CAD
+L1_LENGTH = 1492.08 # in mm
+L2_LENGTH = 105.564 # in mm
+
+THETA_MIN = 0
+THETA_MAX = 360
+PHI_MIN = -80
+PHI_MAX = 90
+H_MIN = 0
+H_MAX = L1_LENGTH * 0.9 + H_OFFSET
+
+# quadratic track model fitted to the angle gauge: degrees = A * steps^2 + B * steps - TRACK_DEGREE_OFFSET
+TRACK_COEFF_A = 3.44e-11
+TRACK_COEFF_B = 1.11e-4
+
+# angle between L1 and the nod arm when the camera is level
+NOD_LINKAGE_ANGLE = np.arccos(L2_LENGTH / L1_LENGTH)
+
+
+def _as_rows(values):
+    return np.atleast_2d(np.asarray(values, dtype=np.float64))
+
+
+def steps_to_degrees(steps):
+    steps = _as_rows(steps)
+    degrees = np.empty_like(steps)
+    degrees[:, 0] = (steps[:, 0] / STAGE_STEPS_PER_REVOLUTION) * 360.0
+    degrees[:, 1] = TRACK_COEFF_A * steps[:, 1] ** 2 + TRACK_COEFF_B * steps[:, 1] - TRACK_DEGREE_OFFSET
+    degrees[:, 2] = ((NOD_MAX_DEGREES / NOD_MAX_STEPS) * steps[:, 2]) - NOD_DEGREE_OFFSET
+    return degrees
+
+
+def degrees_to_steps(degrees):
+    """Convert motor degrees to integer steps. Unreachable track angles come back as -1 so that
+    they fail the bounds check instead of turning into garbage integers."""
+    degrees = _as_rows(degrees)
+    steps = np.empty_like(degrees)
+    steps[:, 0] = STAGE_STEPS_PER_REVOLUTION * degrees[:, 0] / 360.0
+    with np.errstate(invalid="ignore"):
+        discriminant = TRACK_COEFF_B ** 2 + 4 * TRACK_COEFF_A * (TRACK_DEGREE_OFFSET + degrees[:, 1])
+        steps[:, 1] = (-TRACK_COEFF_B + np.sqrt(discriminant)) / (2 * TRACK_COEFF_A)
+    steps[:, 2] = (NOD_MAX_STEPS / NOD_MAX_DEGREES) * (degrees[:, 2] + NOD_DEGREE_OFFSET)
+    steps[~np.isfinite(steps)] = -1
+    # truncate toward zero, matching the int() conversion used for single moves
+    return np.trunc(steps).astype(np.int64)
+
+
+def degrees_to_positions(degrees):
+    degrees = _as_rows(degrees)
+    p_k = np.radians(degrees[:, 1])
+    g_k = np.radians(degrees[:, 2]) + np.pi - NOD_LINKAGE_ANGLE
+
+    theta = degrees[:, 0] % 360
+    h = (L1_LENGTH * np.cos(g_k) + L2_LENGTH) / np.sin(p_k + g_k)
+
+    return np.column_stack((theta, degrees[:, 1], h + H_OFFSET))
+
+
+def positions_to_degrees(positions, current_stage_steps=0):
+    """Convert (θ, φ, h) rows to motor degrees. The stage is unwrapped so that every row takes the
+    shortest way around from the row before it, starting from current_stage_steps."""
+    positions = _as_rows(positions)
+
+    # calculate stage motor degrees
+    current_stage_degrees = (current_stage_steps / STAGE_STEPS_PER_REVOLUTION) * 360.0
+    previous = np.concatenate(([current_stage_degrees], positions[:, 0]))
+    wrapped_deltas = (np.diff(previous) + 180.0) % 360.0 - 180.0
+    stage_motor_degrees = current_stage_degrees + np.cumsum(wrapped_deltas)
+
+    # calculate track motor degrees
+    track_motor_degrees = positions[:, 1]
+
+    # calculate nod motor degrees from the L1/L2 linkage
+    h = positions[:, 2] - H_OFFSET
+    p_k = np.radians(track_motor_degrees)
+    with np.errstate(invalid="ignore"):
+        term1 = np.arctan2(-(h - L1_LENGTH * np.sin(p_k)), L1_LENGTH * np.cos(p_k))
+        term2 = np.arccos(-L2_LENGTH / np.sqrt((L1_LENGTH * np.cos(p_k)) ** 2 + (h - L1_LENGTH * np.sin(p_k)) ** 2))
+    g_k = term1 + term2 - p_k
+    nod_motor_degrees = np.degrees(g_k - np.pi + NOD_LINKAGE_ANGLE)
+
+    return np.column_stack((stage_motor_degrees, track_motor_degrees, nod_motor_degrees))
+
+
+def steps_to_positions(steps):
+    return degrees_to_positions(steps_to_degrees(steps))
+
+
+def positions_to_steps(positions, current_stage_steps=0):
+    return degrees_to_steps(positions_to_degrees(positions, current_stage_steps))
+
+
+def steps_out_of_bounds(steps):
+    """Return a boolean mask of the rows whose track or nod target lies outside the homed range."""
+    steps = np.atleast_2d(np.asarray(steps))
+    track = steps[:, 1]
+    nod = steps[:, 2]
+    return (track < 0) | (track > TRACK_MAX_STEPS) | (nod < 0) | (nod > NOD_MAX_STEPS)
+
+
+def clamp_steps(steps):
+    steps = np.array(np.atleast_2d(steps), dtype=np.int64)
+    np.clip(steps[:, 1], 0, TRACK_MAX_STEPS, out=steps[:, 1])
+    np.clip(steps[:, 2], 0, NOD_MAX_STEPS, out=steps[:, 2])
+    return steps
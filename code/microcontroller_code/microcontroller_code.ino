@@ -7,12 +7,21 @@ Nod motor = motor that nods the camera up and down
 The PC sends serial commands to this program which then parses them and executes them.
 Serial command format: [command type][axis][sign indicator][value]
   command type = 'M' (move to position), 'J' (jog by amount), 'S' (set speed), 'A' (set acceleration), 'H' (home axis), 'F' (force)
+                 'T' (stage a target for a coordinated move), 'G' (start the coordinated move to the staged targets, no axis or value)
   axis = '0' (stage), '1' (track), '2' (nod)
   sign indicator = '+' or '-'
   value = integer with up to MAX_DIGITS digits; for home axis commands the options are +1 or -1 depending on which switch you want to use
 
 The controller also sends codes back to the PC to communicate the status of the machine.
 There are 4 possible codes: 'Hx' (homing completed, x=axis), 'A' (alarm state), 'W' (track is reverse-wound), and 'R...' (motor isRunning and position for each motor)
+In a coordinated move every axis gets its speed and acceleration scaled by its share of the move, so all axes follow one
+straight line in joint space and arrive together. Each axis gets its own rates back when it stops.
+Every commanded move is also reported with 'C axis position' as soon as that motor comes to rest, so the PC doesn't have to poll for it.
+
+'B0+1' switches both directions to binary frames (see protocol.py), 'B0+0' switches back. The reply 'B x' is sent in the old framing.
+Frame: 0xA5, type (command/reply char), sequence number, payload length, payload, checksum (type..checksum sum to 0 mod 256)
+  command payload = axis (uint8) and value (int32)
+  status reply 'P' = isRunning bits 0-2 and needs_homing bits 3-5 (uint8), then the three positions (int32) - replaces 'P' and 'D'
 
 */
 
@@ -64,24 +73,187 @@ LimitSwitch nodBackLimitSwitch = {"NBLS", 10 * nodMicrosteps, -1, 2, &nodMotor,
 // Variables for reading in serial commands
 const int MAX_DIGITS = 10;
 uint8_t incomingBytes[MAX_DIGITS + 3];
-int incomingByte; 
 int byteCounter = 0;
 
+// Binary framing
+const uint8_t FRAME_SYNC = 0xA5;
+const int FRAME_HEADER_SIZE = 4;
+const int MAX_FRAME_PAYLOAD = 24;
+bool binaryMode = false;
+uint8_t txSequence = 0;
+uint8_t rxFrame[FRAME_HEADER_SIZE + MAX_FRAME_PAYLOAD + 1];
+int rxCount = 0;
+
 // Variables to keep track of machine states
 float lastNonzeroTrackMotorSpeed = 0;
 int homing[3];
 bool needs_homing[3];
+bool moveDonePending[3]; // a move was commanded on this axis and its completion hasn't been reported yet
+AccelStepper* motors[3] = {&stageMotor, &trackMotor, &nodMotor};
+
+// Coordinated moves
+long stagedTargets[3];
+bool targetStaged[3];
+bool coordinated[3]; // the axis runs with scaled rates, its own rates are saved below
+float savedMaxSpeed[3];
+float savedAcceleration[3];
+
+float configuredMaxSpeed(int axis) {
+  return coordinated[axis] ? savedMaxSpeed[axis] : motors[axis]->maxSpeed();
+}
+
+float configuredAcceleration(int axis) {
+  return coordinated[axis] ? savedAcceleration[axis] : motors[axis]->acceleration();
+}
+
+void restoreRates(int axis) {
+  if (coordinated[axis]) {
+    coordinated[axis] = false;
+    motors[axis]->setMaxSpeed(savedMaxSpeed[axis]);
+    motors[axis]->setAcceleration(savedAcceleration[axis]);
+  }
+}
+
+void sendFrame(char type, const uint8_t* payload, uint8_t length) {
+  uint8_t header[FRAME_HEADER_SIZE] = {FRAME_SYNC, (uint8_t)type, txSequence++, length};
+  uint8_t sum = header[1] + header[2] + header[3];
+  for (int i = 0; i < length; i++) {
+    sum += payload[i];
+  }
+  Serial.write(header, FRAME_HEADER_SIZE);
+  Serial.write(payload, length);
+  Serial.write((uint8_t)-sum);
+}
+
+// Replies without fields: 'N' and 'E'
+void sendCode(char code) {
+  if (binaryMode) {
+    sendFrame(code, NULL, 0);
+  } else {
+    Serial.println(code);
+  }
+}
+
+// Replies with an axis or framing number: 'H' and 'B'
+void sendAxisCode(char code, uint8_t axis) {
+  if (binaryMode) {
+    sendFrame(code, &axis, 1);
+  } else {
+    Serial.print(code);
+    Serial.print(" ");
+    Serial.println(axis);
+  }
+}
+
+// Replies with a limit switch id: 'L' and 'W'
+void sendSwitchCode(char code, const char* id) {
+  if (binaryMode) {
+    uint8_t payload[4] = {0, 0, 0, 0};
+    memcpy(payload, id, min(strlen(id), sizeof(payload)));
+    sendFrame(code, payload, sizeof(payload));
+  } else {
+    Serial.print(code);
+    Serial.print(" ");
+    Serial.println(id);
+  }
+}
+
+void sendMoveDone(uint8_t axis) {
+  long position = motors[axis]->currentPosition();
+  if (binaryMode) {
+    uint8_t payload[5];
+    payload[0] = axis;
+    memcpy(&payload[1], &position, 4);
+    sendFrame('C', payload, sizeof(payload));
+  } else {
+    Serial.print("C ");
+    Serial.print(axis);
+    Serial.print(" ");
+    Serial.println(position);
+  }
+}
+
+void sendStatus() {
+  if (binaryMode) {
+    uint8_t payload[13];
+    payload[0] = 0;
+    for (int i = 0; i < 3; i++) {
+      long position = motors[i]->currentPosition();
+      payload[0] |= (motors[i]->isRunning() ? 1 : 0) << i;
+      payload[0] |= (needs_homing[i] ? 1 : 0) << (i + 3);
+      memcpy(&payload[1 + 4 * i], &position, 4);
+    }
+    sendFrame('P', payload, sizeof(payload));
+    return;
+  }
+  Serial.print("P");
+  Serial.print(" ");
+  Serial.print(stageMotor.isRunning());
+  Serial.print(" ");
+  Serial.print(stageMotor.currentPosition());
+  Serial.print(" ");
+  Serial.print(trackMotor.isRunning());
+  Serial.print(" ");
+  Serial.print(trackMotor.currentPosition());
+  Serial.print(" ");
+  Serial.print(nodMotor.isRunning());
+  Serial.print(" ");
+  Serial.println(nodMotor.currentPosition());
+  Serial.print("D ");
+  Serial.print(needs_homing[0]);
+  Serial.print(" ");
+  Serial.print(needs_homing[1]);
+  Serial.print(" ");
+  Serial.println(needs_homing[2]);
+}
+
+void sendRates() {
+  if (binaryMode) {
+    float rates[6];
+    for (int i = 0; i < 3; i++) {
+      rates[2 * i] = configuredMaxSpeed(i);
+      rates[2 * i + 1] = configuredAcceleration(i);
+    }
+    sendFrame('R', (const uint8_t*)rates, sizeof(rates));
+    return;
+  }
+  Serial.print("R");
+  Serial.print(" ");
+  Serial.print(configuredMaxSpeed(0));
+  Serial.print(" ");
+  Serial.print(configuredAcceleration(0));
+  Serial.print(" ");
+  Serial.print(configuredMaxSpeed(1));
+  Serial.print(" ");
+  Serial.print(configuredAcceleration(1));
+  Serial.print(" ");
+  Serial.print(configuredMaxSpeed(2));
+  Serial.print(" ");
+  Serial.println(configuredAcceleration(2));
+}
+
+void reportFinishedMoves() {
+  for (int i = 0; i < 3; i++) {
+    if (coordinated[i] && !motors[i]->isRunning()) {
+      restoreRates(i);
+    }
+    if (moveDonePending[i] && !motors[i]->isRunning()) {
+      moveDonePending[i] = false;
+      sendMoveDone(i);
+    }
+  }
+}
 
 void checkAndHandleLimitSwitch(LimitSwitch& ls) {
   if (digitalRead(ls.pin) && digitalRead(ls.pin) && digitalRead(ls.pin)) {
     //long hit_position = ls.motor->currentPosition();
     // Stop the motor immediately and set the position and speed to zero
     ls.motor->setCurrentPosition(0);
+    restoreRates(ls.axis); // back off at the axis' own speed
 
     // Ensure the track isn't reverse-wound
     if ((ls.pin == trackTopLimitPin && lastNonzeroTrackMotorSpeed < 0) || (ls.pin == trackBottomLimitPin && lastNonzeroTrackMotorSpeed > 0)) {
-      Serial.print("W "); // Communicate that the top switch was hit from the wrong direction
-      Serial.println(ls.id);
+      sendSwitchCode('W', ls.id); // Communicate that the top switch was hit from the wrong direction
       homing[1] = 0;
       needs_homing[1] = 1;
       ls.motor->move(ls.direction * ls.backoff);
@@ -98,22 +270,192 @@ void checkAndHandleLimitSwitch(LimitSwitch& ls) {
       needs_homing[ls.axis] = 0;
 
       // Communicate that homing has completed for this axis
-      Serial.print("H "); 
-      Serial.println(ls.axis);
+      sendAxisCode('H', ls.axis);
     } else {
       needs_homing[ls.axis] = 1;
-      Serial.print("L ");
-      Serial.println(ls.id);
+      sendSwitchCode('L', ls.id);
     }
   }
 }
 
+void startCoordinatedMove() {
+  // Speed and acceleration along the path, in path lengths per second (squared), limited by the most constrained axis
+  float distances[3];
+  float pathSpeed = INFINITY;
+  float pathAcceleration = INFINITY;
+  for (int i = 0; i < 3; i++) {
+    distances[i] = 0;
+    if (targetStaged[i] && needs_homing[i] != 1) {
+      distances[i] = abs(stagedTargets[i] - motors[i]->currentPosition());
+    }
+    if (distances[i] > 0) {
+      pathSpeed = min(pathSpeed, configuredMaxSpeed(i) / distances[i]);
+      pathAcceleration = min(pathAcceleration, configuredAcceleration(i) / distances[i]);
+    }
+  }
+
+  for (int i = 0; i < 3; i++) {
+    if (!targetStaged[i]) {
+      continue;
+    }
+    targetStaged[i] = false;
+    if (needs_homing[i] == 1) {
+      sendCode('N');
+      continue;
+    }
+    if (distances[i] > 0) {
+      if (!coordinated[i]) {
+        savedMaxSpeed[i] = motors[i]->maxSpeed();
+        savedAcceleration[i] = motors[i]->acceleration();
+        coordinated[i] = true;
+      }
+      motors[i]->setMaxSpeed(pathSpeed * distances[i]);
+      motors[i]->setAcceleration(pathAcceleration * distances[i]);
+      motors[i]->moveTo(stagedTargets[i]);
+    }
+    moveDonePending[i] = true;
+  }
+}
+
+void handleCommand(char command, int axis, long value) {
+  // Determine which motor will be affected
+  if (axis < 0 || axis > 2) {
+    return;
+  }
+  AccelStepper* motor = motors[axis];
+
+  switch (command) {
+    case 'M': // Move to position
+      if (needs_homing[axis] != 1) {
+        motor->moveTo(value);
+        moveDonePending[axis] = true;
+      } else {
+        sendCode('N');
+      }
+      break;
+    case 'J': // Jog
+      motor->move(value);
+      moveDonePending[axis] = true;
+      break;
+    case 'S': // Set speed
+      if (coordinated[axis]) {
+        savedMaxSpeed[axis] = value; // takes effect when the coordinated move is done
+      } else {
+        motor->setMaxSpeed(value); 
+      }
+      break;
+    case 'A': // Set acceleration
+      if (coordinated[axis]) {
+        savedAcceleration[axis] = value;
+      } else {
+        motor->setAcceleration(value);
+      }
+      break;
+    case 'T': // Stage a target for a coordinated move
+      stagedTargets[axis] = value;
+      targetStaged[axis] = true;
+      break;
+    case 'G': // Start the coordinated move
+      startCoordinatedMove();
+      break;
+    case 'H': // Home axis
+      homing[axis] = 1;
+      motor->move(-1000000);
+      moveDonePending[axis] = true;
+      break;
+    case 'F': // Force move, ignore limit switches
+      motor->move(value);
+      motor->runToPosition();
+      moveDonePending[axis] = true;
+      break;
+    case 'E': // Stop all motors
+      motor->stop();
+      homing[axis] = 0;
+      break;
+    case 'P': // Send motor isRunning and position data
+      sendStatus();
+      break;
+    case 'R': // Send maxSpeed and acceleration for each motor
+      sendRates();
+      break;
+    case 'B': // Select the framing, the reply goes out in the old one
+      sendAxisCode('B', value == 1 ? 1 : 0);
+      binaryMode = value == 1;
+      rxCount = 0;
+      byteCounter = 0;
+      break;
+  }
+}
+
+void readAsciiByte(int incomingByte) {
+  incomingBytes[byteCounter] = incomingByte;
+  byteCounter += 1;
+
+  if (incomingByte == '\n') {
+    // Convert the axis char to an int
+    int axis = incomingBytes[1] - '0';
+
+    // Convert the value at the end of the command to an int
+    long value = 0;
+    for (int i = 3; i < byteCounter - 1; i++){
+      value = value*10 + incomingBytes[i] - '0';
+    }
+    if (incomingBytes[2] == '-') {
+      value = -1 * value;
+    }
+
+    // Status requests are sent without an axis
+    if (axis < 0 || axis > 2) {
+      axis = 0;
+    }
+    handleCommand(incomingBytes[0], axis, value);
+
+    byteCounter = 0;
+    memset(incomingBytes, 0, sizeof(incomingBytes));
+  } else if (byteCounter >= (int)sizeof(incomingBytes)) {
+    byteCounter = 0; // Too long to be a command
+  }
+}
+
+void readBinaryByte(uint8_t incomingByte) {
+  // Wait for the start of a frame
+  if (rxCount == 0 && incomingByte != FRAME_SYNC) {
+    return;
+  }
+  rxFrame[rxCount++] = incomingByte;
+  if (rxCount < FRAME_HEADER_SIZE) {
+    return;
+  }
+  uint8_t length = rxFrame[3];
+  if (length > MAX_FRAME_PAYLOAD) {
+    rxCount = 0;
+    return;
+  }
+  if (rxCount < FRAME_HEADER_SIZE + length + 1) {
+    return;
+  }
+
+  uint8_t sum = 0;
+  for (int i = 1; i < rxCount; i++) {
+    sum += rxFrame[i];
+  }
+  if (sum == 0 && length == 5) {
+    long value;
+    memcpy(&value, &rxFrame[FRAME_HEADER_SIZE + 1], 4);
+    handleCommand(rxFrame[1], rxFrame[FRAME_HEADER_SIZE], value);
+  }
+  rxCount = 0;
+}
+
 void setup() {
   Serial.begin(115200);
 
   for (int i = 0; i < 3; i++) {
     homing[i] = 0;
     needs_homing[i] = 1;
+    moveDonePending[i] = false;
+    targetStaged[i] = false;
+    coordinated[i] = false;
   }
 
   // Enable all the motors
@@ -145,125 +487,33 @@ void setup() {
 void loop() {
   // Check if Emergency Stop is pressed
   if (digitalRead(estopPin)) {
-    Serial.println("E");
+    sendCode('E');
     stageMotor.setCurrentPosition(0);
     trackMotor.setCurrentPosition(0);
     nodMotor.setCurrentPosition(0);
     needs_homing[0] = 1;
     needs_homing[1] = 1;
     needs_homing[2] = 1;
+    moveDonePending[0] = false;
+    moveDonePending[1] = false;
+    moveDonePending[2] = false;
     delay(50);
     return;
   }
 
   // Read incoming command
   while (Serial.available() > 0) {
-    incomingByte = Serial.read();
-    incomingBytes[byteCounter] = incomingByte;
-    byteCounter += 1;
-
-    if (incomingByte == '\n') {
-      // Convert the axis char to an int
-      int axis = incomingBytes[1] - '0';
-
-      // Convert the value at the end of the command to an int
-      long value = 0;
-      for (int i = 3; i < byteCounter - 1; i++){
-        value = value*10 + incomingBytes[i] - '0';
-      }
-      if (incomingBytes[2] == '-') {
-        value = -1 * value;
-      }
-
-      // Determine which motor will be affected
-      AccelStepper* motor = NULL;
-      switch (axis) {
-        case 0:
-          motor = &stageMotor;
-          break;
-        case 1:
-          motor = &trackMotor;
-          break;
-        case 2:
-          motor = &nodMotor;
-          break;
-      }
-
-      switch (incomingBytes[0]) {
-        case 'M': // Move to position
-          if (needs_homing[axis] != 1) {
-            motor->moveTo(value);
-          } else {
-            Serial.println("N");
-          }
-          break;
-        case 'J': // Jog
-          motor->move(value);
-          break;
-        case 'S': // Set speed
-          motor->setMaxSpeed(value); 
-          break;
-        case 'A': // Set acceleration
-          motor->setAcceleration(value);
-          break;
-        case 'H': // Home axis
-          homing[axis] = 1;
-          motor->move(-1000000);
-          break;
-        case 'F': // Force move, ignore limit switches
-          motor->move(value);
-          motor->runToPosition();
-          break;
-        case 'E': // Stop all motors
-          motor->stop();
-          homing[axis] = 0;
-          break;
-        case 'P': // Send motor isRunning and position data
-          Serial.print("P");
-          Serial.print(" ");
-          Serial.print(stageMotor.isRunning());
-          Serial.print(" ");
-          Serial.print(stageMotor.currentPosition());
-          Serial.print(" ");
-          Serial.print(trackMotor.isRunning());
-          Serial.print(" ");
-          Serial.print(trackMotor.currentPosition());
-          Serial.print(" ");
-          Serial.print(nodMotor.isRunning());
-          Serial.print(" ");
-          Serial.println(nodMotor.currentPosition());
-          Serial.print("D ");
-          Serial.print(needs_homing[0]);
-          Serial.print(" ");
-          Serial.print(needs_homing[1]);
-          Serial.print(" ");
-          Serial.println(needs_homing[2]);
-          break;
-        case 'R': // Send maxSpeed and acceleration for each motor
-          Serial.print("R");
-          Serial.print(" ");
-          Serial.print(stageMotor.maxSpeed());
-          Serial.print(" ");
-          Serial.print(stageMotor.acceleration());
-          Serial.print(" ");
-          Serial.print(trackMotor.maxSpeed());
-          Serial.print(" ");
-          Serial.print(trackMotor.acceleration());
-          Serial.print(" ");
-          Serial.print(nodMotor.maxSpeed());
-          Serial.print(" ");
-          Serial.println(nodMotor.acceleration());
-          break;
-      }
-
-      byteCounter = 0;
-      memset(incomingBytes, 0, sizeof(incomingBytes));
+    if (binaryMode) {
+      readBinaryByte(Serial.read());
+    } else {
+      readAsciiByte(Serial.read());
     }
   }
 
   stageMotor.run();
   trackMotor.run();
   nodMotor.run();
+  reportFinishedMoves();
 
   float trackMotorSpeed = trackMotor.speed();
 
@@ -278,14 +528,14 @@ void loop() {
     if (homing[0] == 1) {
       stageMotor.move(-2211);
 
-      Serial.println("L SOLS");
+      sendSwitchCode('L', "SOLS");
 
       stageMotor.runToPosition();
       stageMotor.setCurrentPosition(0);
       homing[0] = 0;
       needs_homing[0] = 0;
 
-      Serial.println("H 0");
+      sendAxisCode('H', 0);
     }
   }
 
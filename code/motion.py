@@ -0,0 +1,270 @@
+"""
+Motion model of the three stepper axes.
+
+AccelStepper is a Python port of the parts of the AccelStepper library that the firmware in
+microcontroller_code.ino uses, stepping exactly like the microcontroller does. It is used by the
+simulator and as the reference for the closed-form trapezoidal estimates below, which are what
+planners and ETA displays use since they convert a whole plan in one vectorized call.
+"""
+
+import math
+import numpy as np
+
+# these values mirror the #defines and setup() in microcontroller_code.ino
+STAGE_MICROSTEPS = 16
+TRACK_MICROSTEPS = 4
+NOD_MICROSTEPS = 64
+
+DEFAULT_MAX_SPEEDS = (250 * STAGE_MICROSTEPS, 1000 * TRACK_MICROSTEPS, 62.5 * NOD_MICROSTEPS) # steps/s
+DEFAULT_ACCELERATIONS = (200.0 * STAGE_MICROSTEPS, 500.0 * TRACK_MICROSTEPS, 50.0 * NOD_MICROSTEPS) # steps/s^2
+
+# The microcontroller can't step any axis faster than this
+MAX_STEP_RATE = 4000.0
+
+# AccelStepper takes the first step of a move right away and its step interval approximation
+# ramps slightly faster than the ideal profile. Together that shortens every move by between
+# 1.17 and 2.02 multiples of sqrt(2 / acceleration), measured against reference_move_time(); where
+# in that range depends on how the step counts round when it switches to braking. Correcting by
+# the middle of the range keeps the estimate within 0.43 * sqrt(2 / acceleration) of the stepped
+# time, which is 14 ms at the default accelerations but 61 ms at 100 steps/s^2.
+RAMP_CORRECTION = 1.6
+
+
+class AccelStepper:
+    """One axis, stepping the way AccelStepper does. Times are in microseconds like micros() on
+    the microcontroller; advance_to() takes every step that is due up to a point in time."""
+
+    def __init__(self, max_speed=1.0, acceleration=1.0):
+        self._current_pos = 0
+        self._target_pos = 0
+        self._speed = 0.0
+        self._max_speed = 0.0
+        self._acceleration = 0.0
+        self._step_interval = 0.0
+        self._last_step_time = 0.0
+        self._n = 0
+        self._c0 = 0.0
+        self._cn = 0.0
+        self._cmin = 1.0
+        self._direction = 1
+        self.set_max_speed(max_speed)
+        self.set_acceleration(acceleration)
+
+    def current_position(self):
+        return self._current_pos
+
+    def target_position(self):
+        return self._target_pos
+
+    def distance_to_go(self):
+        return self._target_pos - self._current_pos
+
+    def speed(self):
+        return self._speed
+
+    def max_speed(self):
+        return self._max_speed
+
+    def acceleration(self):
+        return self._acceleration
+
+    def is_running(self):
+        return not (self._speed == 0.0 and self._target_pos == self._current_pos)
+
+    def move_to(self, absolute):
+        if self._target_pos != absolute:
+            self._target_pos = int(absolute)
+            self._compute_new_speed()
+
+    def move(self, relative):
+        self.move_to(self._current_pos + int(relative))
+
+    def set_max_speed(self, speed):
+        speed = abs(speed)
+        if self._max_speed != speed:
+            self._max_speed = speed
+            self._cmin = 1000000.0 / speed
+            if self._n > 0:
+                self._n = int((self._speed * self._speed) / (2.0 * self._acceleration))
+                self._compute_new_speed()
+
+    def set_acceleration(self, acceleration):
+        if acceleration == 0.0:
+            return
+        acceleration = abs(acceleration)
+        if self._acceleration != acceleration:
+            if self._acceleration:
+                self._n = int(self._n * (self._acceleration / acceleration))
+            self._c0 = 0.676 * math.sqrt(2.0 / acceleration) * 1000000.0
+            self._acceleration = acceleration
+            self._compute_new_speed()
+
+    def set_current_position(self, position):
+        self._target_pos = self._current_pos = int(position)
+        self._n = 0
+        self._step_interval = 0.0
+        self._speed = 0.0
+
+    def stop(self):
+        if self._speed != 0.0:
+            steps_to_stop = int((self._speed * self._speed) / (2.0 * self._acceleration)) + 1
+            self.move(steps_to_stop if self._speed > 0 else -steps_to_stop)
+
+    def next_step_time(self):
+        """Time of the next step, or None if the axis is idle."""
+        if not self._step_interval:
+            return None
+        return self._last_step_time + self._step_interval
+
+    def start_due_step(self, now):
+        """On the microcontroller run() is called continuously, so a move commanded on an idle
+        axis takes its first step right away rather than one interval after its last step."""
+        if self._step_interval and self._last_step_time + self._step_interval < now:
+            self._last_step_time = now - self._step_interval
+
+    def run(self, now):
+        """One call of run() from the firmware loop at time now."""
+        if self._run_speed(now):
+            self._compute_new_speed()
+        return self._speed != 0.0 or self.distance_to_go() != 0
+
+    def advance_to(self, now):
+        """Take every step that falls due up to now, as if run() was called continuously."""
+        while self._step_interval:
+            due = self._last_step_time + self._step_interval
+            if due > now:
+                break
+            skipped = self._cruise_steps(now)
+            if skipped:
+                self._current_pos += skipped * self._direction
+                self._last_step_time += skipped * self._step_interval
+                self._n += skipped
+                continue
+            self._step(due)
+            self._compute_new_speed()
+
+    def _cruise_steps(self, now):
+        # While cruising at max speed every step has the same interval and leaves the speed
+        # unchanged, so the steps up to the start of braking can be taken in one go
+        if self._n <= 0 or self._cn != self._cmin:
+            return 0
+        distance = abs(self.distance_to_go())
+        steps_to_stop = int((self._speed * self._speed) / (2.0 * self._acceleration))
+        due_steps = int((now - self._last_step_time) // self._step_interval)
+        return max(0, min(due_steps, distance - steps_to_stop - 1) - 1)
+
+    def _run_speed(self, now):
+        if not self._step_interval:
+            return False
+        if now - self._last_step_time >= self._step_interval:
+            self._step(now)
+            return True
+        return False
+
+    def _step(self, now):
+        self._current_pos += self._direction
+        self._last_step_time = now
+
+    def _compute_new_speed(self):
+        distance_to = self.distance_to_go()
+        steps_to_stop = int((self._speed * self._speed) / (2.0 * self._acceleration))
+
+        if distance_to == 0 and steps_to_stop <= 1:
+            # We are at the target and it's time to stop
+            self._step_interval = 0.0
+            self._speed = 0.0
+            self._n = 0
+            return
+
+        if distance_to > 0:
+            if self._n > 0:
+                # Either we are about to reach the target or we are heading the wrong way
+                if steps_to_stop >= distance_to or self._direction == -1:
+                    self._n = -steps_to_stop
+            elif self._n < 0:
+                # Currently decelerating, accelerate again if there is room
+                if steps_to_stop < distance_to and self._direction == 1:
+                    self._n = -self._n
+        elif distance_to < 0:
+            if self._n > 0:
+                if steps_to_stop >= -distance_to or self._direction == 1:
+                    self._n = -steps_to_stop
+            elif self._n < 0:
+                if steps_to_stop < -distance_to and self._direction == -1:
+                    self._n = -self._n
+
+        if self._n == 0:
+            # First step from stopped
+            self._cn = self._c0
+            self._direction = 1 if distance_to > 0 else -1
+        else:
+            # Subsequent step, works for both acceleration and deceleration
+            self._cn = self._cn - ((2.0 * self._cn) / ((4.0 * self._n) + 1))
+            self._cn = max(self._cn, self._cmin)
+        self._n += 1
+        self._step_interval = self._cn
+        self._speed = 1000000.0 / self._cn
+        if self._direction == -1:
+            self._speed = -self._speed
+
+
+def reference_move_time(distance, max_speed, acceleration):
+    """Time in seconds AccelStepper takes to move a distance from standstill, stepped exactly."""
+    stepper = AccelStepper(min(max_speed, MAX_STEP_RATE), acceleration)
+    stepper.move(distance)
+    # The first step is taken on the first run() call, so the move starts at t=0
+    stepper._last_step_time = -stepper._step_interval
+    stepper.advance_to(1e18)
+    return max(stepper._last_step_time, 0.0) / 1000000.0
+
+
+def axis_move_times(distances, max_speeds=DEFAULT_MAX_SPEEDS, accelerations=DEFAULT_ACCELERATIONS):
+    """Time for each axis to cover a distance (in steps) from standstill to standstill with a
+    trapezoidal speed profile. distances is an array whose last dimension is the axis."""
+    distances = np.abs(np.asarray(distances, dtype=np.float64))
+    max_speeds = np.minimum(np.asarray(max_speeds, dtype=np.float64), MAX_STEP_RATE)
+    accelerations = np.asarray(accelerations, dtype=np.float64)
+
+    # distance needed to reach max speed and brake again
+    ramp_distances = max_speeds ** 2 / accelerations
+    triangular = distances < ramp_distances
+    times = np.where(
+        triangular,
+        2 * np.sqrt(distances / accelerations),
+        distances / max_speeds + max_speeds / accelerations,
+    )
+    times -= RAMP_CORRECTION * np.sqrt(2.0 / accelerations)
+    return np.where(distances > 1, np.maximum(times, 0.0), 0.0)
+
+
+def coordinated_rates(distances, max_speeds=DEFAULT_MAX_SPEEDS, accelerations=DEFAULT_ACCELERATIONS):
+    """Per-axis max speed and acceleration for a coordinated move (the firmware's G command).
+    Every axis runs the same trapezoid scaled by its distance, so all of them arrive together
+    along a straight line in joint space. The path is as fast as the most constrained axis
+    allows; axes that don't move keep their own rates."""
+    distances = np.abs(np.asarray(distances, dtype=np.float64))
+    max_speeds = np.broadcast_to(np.minimum(np.asarray(max_speeds, dtype=np.float64), MAX_STEP_RATE), distances.shape)
+    accelerations = np.broadcast_to(np.asarray(accelerations, dtype=np.float64), distances.shape)
+    moving = distances > 0
+    safe_distances = np.where(moving, distances, 1.0)
+    # speed and acceleration along the path, in path lengths per second (squared)
+    path_speeds = np.where(moving, max_speeds / safe_distances, np.inf).min(axis=-1, keepdims=True)
+    path_accelerations = np.where(moving, accelerations / safe_distances, np.inf).min(axis=-1, keepdims=True)
+    return (np.where(moving, path_speeds * safe_distances, max_speeds),
+            np.where(moving, path_accelerations * safe_distances, accelerations))
+
+
+def move_times(distances, max_speeds=DEFAULT_MAX_SPEEDS, accelerations=DEFAULT_ACCELERATIONS, coordinated=False):
+    """Time until the slowest axis of each move arrives. distances is an array whose last
+    dimension is the axis."""
+    if coordinated:
+        max_speeds, accelerations = coordinated_rates(distances, max_speeds, accelerations)
+    return axis_move_times(distances, max_speeds, accelerations).max(axis=-1)
+
+
+def move_durations(step_targets, start_steps, max_speeds=DEFAULT_MAX_SPEEDS, accelerations=DEFAULT_ACCELERATIONS, coordinated=False):
+    """Estimate how long each move of a sequence takes. With independent moves every axis runs
+    at its own rates and a move is done when the slowest axis arrives."""
+    step_targets = np.atleast_2d(np.asarray(step_targets, dtype=np.float64))
+    previous = np.vstack((np.asarray(start_steps, dtype=np.float64), step_targets[:-1]))
+    return move_times(step_targets - previous, max_speeds, accelerations, coordinated)
@@ -0,0 +1,212 @@
+"""
+Background offload of finished shots.
+
+Replicator copies files from the capture folder to a second folder (a NAS mount, or any other
+path) while the sequence keeps running. It runs a few copy threads with a shared bandwidth limit,
+and it holds back while should_yield() returns True, so the capture writer keeps the disk to
+itself when it needs it. Every copy is hashed as it is read and compared with the checksum
+recorded at capture time before it replaces the target; a copy that doesn't match is deleted.
+
+Finished copies are logged in offload.progress in the target folder, so a replicator started
+again on the same folders skips what is already there.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import integrity
+
+
+class Throttle:
+    """Token bucket shared by the copy threads."""
+
+    # Up to this many seconds of unused bandwidth can be spent in one burst
+    BURST = 0.5
+
+    def __init__(self, bytes_per_second=None):
+        self.bytes_per_second = bytes_per_second # None for no limit
+        self.lock = threading.Lock()
+        self.available = 0.0
+        self.last_time = time.monotonic()
+
+    def consume(self, count):
+        if not self.bytes_per_second:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.available + (now - self.last_time) * self.bytes_per_second,
+                                 self.bytes_per_second * self.BURST)
+            self.last_time = now
+            self.available -= count
+            delay = -self.available / self.bytes_per_second
+        if delay > 0:
+            time.sleep(delay)
+
+
+class OffloadItem:
+    def __init__(self, name, checksum=None, kind="file"):
+        self.name = name # path relative to the source and target folders
+        self.checksum = checksum # recorded at capture time, None to check the size only
+        self.kind = kind # "file", or "index" for a live session index
+        self.error = None
+        self.size = None
+        self.skipped = False # already in the target folder
+
+
+class Replicator:
+    PROGRESS_FILE_NAME = "offload.progress"
+    # Small chunks keep the throttle smooth and let the copy give way to the capture writer quickly
+    CHUNK_SIZE = 4 * 1024 * 1024
+    YIELD_INTERVAL = 0.05
+
+    def __init__(self, source_directory, target_directory, workers=2, max_bytes_per_second=None,
+                 should_yield=None, on_copied=None, on_error=None):
+        self.source_directory = source_directory
+        self.target_directory = target_directory
+        self.throttle = Throttle(max_bytes_per_second)
+        self.should_yield = should_yield
+        self.on_copied = on_copied
+        self.on_error = on_error
+
+        os.makedirs(target_directory, exist_ok=True)
+        self.progress_path = os.path.join(target_directory, self.PROGRESS_FILE_NAME)
+        self.progress_lock = threading.Lock()
+        self.copied = self._load_progress()
+
+        self.idle = threading.Condition()
+        self.unfinished = 0
+        self.stopping = False
+        self.queue = queue.Queue()
+        self.threads = [threading.Thread(target=self._copy_loop, name="offload", daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, name, checksum=None):
+        """Copy a file, given relative to the source folder. Files already copied are skipped."""
+        self._put(OffloadItem(name, checksum))
+
+    def submit_index(self, name):
+        """Copy a session index that may still be written to, as a consistent snapshot. It is
+        copied every time, since it grows."""
+        self._put(OffloadItem(name, kind="index"))
+
+    def pending(self):
+        with self.idle:
+            return self.unfinished
+
+    def wait_until_idle(self, timeout=None):
+        with self.idle:
+            return self.idle.wait_for(lambda: self.unfinished == 0, timeout)
+
+    def finish(self):
+        """Let the threads copy what is queued and exit, without waiting for them."""
+        for _ in self.threads:
+            self.queue.put(None)
+
+    def stop(self):
+        """Drop the queued copies, abandon the running ones and wait for the threads. What is
+        left is copied the next time the folders are replicated."""
+        self.stopping = True
+        self.finish()
+        for thread in self.threads:
+            thread.join()
+
+    def _put(self, item):
+        with self.idle:
+            self.unfinished += 1
+        self.queue.put(item)
+
+    def _load_progress(self):
+        copied = set()
+        try:
+            with open(self.progress_path) as f:
+                for line in f:
+                    name, _, checksum = line.rstrip("\n").partition("\t")
+                    copied.add((name, checksum))
+        except FileNotFoundError:
+            pass
+        return copied
+
+    def _record_progress(self, item, key):
+        with self.progress_lock:
+            self.copied.add((item.name, key))
+            with open(self.progress_path, "a") as f:
+                f.write(f"{item.name}\t{key}\n")
+
+    def _already_copied(self, item, key):
+        with self.progress_lock:
+            return (item.name, key) in self.copied and os.path.isfile(os.path.join(self.target_directory, item.name))
+
+    def _copy_loop(self):
+        while (item := self.queue.get()) is not None:
+            if not self.stopping:
+                try:
+                    if item.kind == "index":
+                        self._copy_index(item)
+                    else:
+                        self._copy_file(item)
+                except Exception as e:
+                    item.error = e
+                if not self.stopping:
+                    self._notify(self.on_error if item.error is not None else self.on_copied, item)
+            with self.idle:
+                self.unfinished -= 1
+                self.idle.notify_all()
+
+    def _copy_file(self, item):
+        source = os.path.join(self.source_directory, item.name)
+        # Files without a checksum count as changed when their size or modification time did
+        status = os.stat(source)
+        key = item.checksum or f"{status.st_size}:{status.st_mtime_ns}"
+        if self._already_copied(item, key):
+            item.skipped = True
+            return
+        target = os.path.join(self.target_directory, item.name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        algorithm = integrity.parse_checksum(item.checksum)[0] if item.checksum else None
+        hasher = integrity.new_hasher(algorithm) if algorithm else None
+
+        buffer = bytearray(self.CHUNK_SIZE)
+        view = memoryview(buffer)
+        item.size = 0
+        with open(source, "rb", buffering=0) as src, open(target + ".part", "wb") as dst:
+            while count := src.readinto(buffer):
+                while self.should_yield is not None and self.should_yield() and not self.stopping:
+                    time.sleep(self.YIELD_INTERVAL)
+                if self.stopping:
+                    return
+                self.throttle.consume(count)
+                dst.write(view[:count])
+                if hasher is not None:
+                    hasher.update(view[:count])
+                item.size += count
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        if hasher is not None and integrity.format_checksum(algorithm, hasher) != item.checksum:
+            os.remove(target + ".part")
+            raise ValueError(f"{item.name} doesn't match its recorded checksum, it was not copied")
+        os.replace(target + ".part", target)
+        self._record_progress(item, key)
+
+    def _copy_index(self, item):
+        target = os.path.join(self.target_directory, item.name)
+        if os.path.exists(target + ".part"):
+            os.remove(target + ".part")
+        source_connection = sqlite3.connect(os.path.join(self.source_directory, item.name))
+        try:
+            target_connection = sqlite3.connect(target + ".part")
+            try:
+                source_connection.backup(target_connection)
+            finally:
+                target_connection.close()
+        finally:
+            source_connection.close()
+        os.replace(target + ".part", target)
+
+    def _notify(self, callback, item):
+        if callback is not None:
+            callback(item)
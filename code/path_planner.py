@@ -0,0 +1,138 @@
+"""
+Reorders the capture points of a plan to cut the total motion time.
+
+Shots don't depend on each other, so any visiting order yields the same images. The planners
+here only need the plan's poses and the per-axis speed/acceleration reported by the controller.
+"""
+
+import numpy as np
+
+import kinematics
+import motion
+
+# The full cost matrix is N×N, beyond this many points only the serpentine order is used
+MAX_TSP_POINTS = 3000
+MAX_TWO_OPT_PASSES = 20
+# Rows of the cost matrix worked out at a time, which bounds the N×3 distance temporaries
+COST_BLOCK_ROWS = 256
+# Costs are float32, smaller 2-opt gains than this many seconds are rounding noise
+MIN_TWO_OPT_GAIN = 1e-4
+
+
+def serpentine_order(grid_indices):
+    """Visit the rows in order, alternating the column direction on every other row so the
+    stage never has to swing back to the first column."""
+    grid_indices = np.asarray(grid_indices)
+    rows = grid_indices[:, 0]
+    cols = grid_indices[:, 1]
+    row_rank = np.unique(rows, return_inverse=True)[1]
+    col_key = np.where(row_rank % 2 == 1, -cols, cols)
+    return np.lexsort((col_key, row_rank))
+
+
+def _axis_distances(from_positions, from_steps, to_positions, to_steps):
+    """Per-axis step distances from every point of one set to every point of another. The stage
+    distance goes the short way around since every move is unwrapped relative to the previous one."""
+    distances = np.empty((len(from_positions), len(to_positions), 3))
+    stage = distances[..., 0]
+    np.subtract(from_positions[:, None, 0], to_positions[None, :, 0], out=stage)
+    stage += 180.0
+    np.mod(stage, 360.0, out=stage)
+    stage -= 180.0
+    np.abs(stage, out=stage)
+    stage *= kinematics.STAGE_STEPS_PER_REVOLUTION / 360.0
+    for axis in (1, 2):
+        np.subtract(from_steps[:, None, axis], to_steps[None, :, axis], out=distances[..., axis])
+        np.abs(distances[..., axis], out=distances[..., axis])
+    return distances
+
+
+def move_time_matrix(positions, steps, start_steps, max_speeds, accelerations, coordinated=False):
+    """Estimated move time between every pair of points, as float32. Row/column 0 is the start
+    position, point i of the plan is row/column i + 1. The matrix is filled a block of rows at a
+    time so the temporaries stay small next to it."""
+    start_steps = np.asarray(start_steps, dtype=np.float64)
+    start_position = kinematics.steps_to_positions(start_steps)[0]
+    all_positions = np.vstack((start_position, positions))
+    all_steps = np.vstack((start_steps, steps)).astype(np.float64)
+    costs = np.empty((len(all_steps), len(all_steps)), dtype=np.float32)
+    for start in range(0, len(all_steps), COST_BLOCK_ROWS):
+        rows = slice(start, start + COST_BLOCK_ROWS)
+        distances = _axis_distances(all_positions[rows], all_steps[rows], all_positions, all_steps)
+        costs[rows] = motion.move_times(distances, max_speeds, accelerations, coordinated)
+    return costs
+
+
+def _nearest_neighbour_path(costs):
+    n = len(costs)
+    path = np.empty(n, dtype=np.int64)
+    path[0] = 0
+    visited = np.zeros(n, dtype=bool)
+    visited[0] = True
+    for i in range(1, n):
+        row = np.where(visited, np.inf, costs[path[i - 1]])
+        path[i] = np.argmin(row)
+        visited[path[i]] = True
+    return path
+
+
+def _two_opt(costs, path):
+    """Improve an open path that starts at a fixed node by reversing segments while that
+    shortens it. Costs are symmetric, so a reversed segment keeps its internal cost."""
+    n = len(path)
+    for _ in range(MAX_TWO_OPT_PASSES):
+        improved = False
+        for i in range(n - 2):
+            a, b = path[i], path[i + 1]
+            j = np.arange(i + 2, n)
+            c = path[j]
+            # the last node has no successor, so breaking after it costs nothing
+            d = np.append(path[i + 3:], -1)
+            after = np.where(d >= 0, costs[c, np.maximum(d, 0)], 0.0)
+            delta = costs[a, c] + np.where(d >= 0, costs[b, np.maximum(d, 0)], 0.0) - costs[a, b] - after
+            best = np.argmin(delta)
+            if delta[best] < -MIN_TWO_OPT_GAIN:
+                k = j[best]
+                path[i + 1:k + 1] = path[i + 1:k + 1][::-1]
+                improved = True
+        if not improved:
+            break
+    return path
+
+
+def shortest_time_order(positions, steps, start_steps, max_speeds, accelerations, coordinated=False):
+    """Nearest-neighbour tour refined with 2-opt over the estimated move times."""
+    costs = move_time_matrix(positions, steps, start_steps, max_speeds, accelerations, coordinated)
+    path = _two_opt(costs, _nearest_neighbour_path(costs))
+    return path[1:] - 1
+
+
+def plan_duration(plan, order, start_steps, max_speeds, accelerations, coordinated=False):
+    """Total estimated motion time of the plan when visited in the given order."""
+    positions = plan.positions[order]
+    steps = kinematics.positions_to_steps(positions, start_steps[0])
+    return float(motion.move_durations(steps, start_steps, max_speeds, accelerations, coordinated).sum())
+
+
+def optimize_order(plan, start_steps, max_speeds, accelerations, method="shortest", coordinated=False):
+    """Reorder the plan in place. Returns the estimated motion time before and after so the
+    saving can be reported. The shortest-time method falls back to the serpentine order for plans
+    of more than MAX_TSP_POINTS points, too large for a full cost matrix."""
+    original_order = np.arange(len(plan))
+    original_duration = plan_duration(plan, original_order, start_steps, max_speeds, accelerations, coordinated)
+    if method == "serpentine" or (method == "shortest" and len(plan) > MAX_TSP_POINTS):
+        order = serpentine_order(plan.grid_indices)
+    elif method == "shortest":
+        serpentine = serpentine_order(plan.grid_indices)
+        shortest = shortest_time_order(plan.positions, plan.steps, start_steps, max_speeds, accelerations, coordinated)
+        # 2-opt only finds a local optimum, keep the serpentine order if it happens to be better
+        if plan_duration(plan, shortest, start_steps, max_speeds, accelerations, coordinated) < \
+                plan_duration(plan, serpentine, start_steps, max_speeds, accelerations, coordinated):
+            order = shortest
+        else:
+            order = serpentine
+    else:
+        order = original_order
+
+    plan.reorder(order, start_steps, max_speeds, accelerations, coordinated)
+    return original_duration, plan.remaining_duration()
@@ -0,0 +1,192 @@
+"""
+Pre-flight estimate of a capture session.
+
+Before the first move, estimate_session() works out how many shots a plan will take, how much disk
+they need against what is free, and how long the session will run. Motion time comes from the
+plan, which already knows every move's duration at the current axis speeds and accelerations.
+Exposure and transfer times and the size of a shot come from the latest shots in the capture
+folder's session index, or from conservative defaults for a folder that has none. Transfers overlap
+the next move, so a position takes the longer of its move and its transfers, plus the exposures.
+
+ControlUI refuses to start a plan that doesn't fit on the disk and asks before starting one that
+would leave it nearly full.
+
+    python preflight.py [positions.csv] [--rows N] [--cols N] [--shots N] [--directory DIR]
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+
+import numpy as np
+
+import motion
+import path_planner
+from capture_plan import CapturePlan, read_spin_positions
+from session_index import SessionIndex
+
+MEGABYTE = 1024 * 1024
+GIGABYTE = 1024 * MEGABYTE
+
+# Used until the capture folder has shots to measure, on the high side of the IQ back's numbers
+DEFAULT_BYTES_PER_SHOT = 150 * MEGABYTE
+DEFAULT_EXPOSURE_TIME = 0.5
+DEFAULT_TRANSFER_TIME = 0.75
+RECENT_SHOTS = 50
+
+# A session may not leave less than this free
+MIN_FREE_BYTES = 2 * GIGABYTE
+# and it is worth a warning when it leaves less than this share of the disk
+LOW_SPACE_FRACTION = 0.1
+
+
+class ShotStatistics:
+    def __init__(self, bytes_per_shot=DEFAULT_BYTES_PER_SHOT, exposure_time=DEFAULT_EXPOSURE_TIME,
+                 transfer_time=DEFAULT_TRANSFER_TIME, source="defaults"):
+        self.bytes_per_shot = bytes_per_shot
+        self.exposure_time = exposure_time
+        self.transfer_time = transfer_time
+        self.source = source # where the numbers came from, for the report
+
+
+class SessionEstimate:
+    def __init__(self, positions, shots, statistics, required_bytes, free_bytes, disk_bytes, motion_time, total_time):
+        self.positions = positions
+        self.shots = shots
+        self.statistics = statistics
+        self.required_bytes = required_bytes
+        self.free_bytes = free_bytes
+        self.disk_bytes = disk_bytes
+        self.motion_time = motion_time
+        self.total_time = total_time
+        self.errors = []
+        self.warnings = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __str__(self):
+        lines = [
+            f"{self.positions} positions, {self.shots} shots of {self.statistics.bytes_per_shot / MEGABYTE:.0f} MB "
+            f"({self.statistics.source})",
+            f"Disk: {self.required_bytes / GIGABYTE:.1f} GB needed, {self.free_bytes / GIGABYTE:.1f} GB free",
+            f"Time: {self.total_time / 60:.0f} min, of which {self.motion_time / 60:.0f} min moving",
+        ]
+        lines += [f"Warning: {warning}" for warning in self.warnings]
+        lines += [f"Error: {error}" for error in self.errors]
+        return "\n".join(lines)
+
+
+def existing_directory(path):
+    """The path itself or its nearest parent that exists, for asking about the disk it will be on."""
+    path = os.path.abspath(path)
+    while not os.path.isdir(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+def host_storage_megabytes(directory):
+    """Free space for images in a folder, for the camera's host storage capacity."""
+    return int(shutil.disk_usage(existing_directory(directory)).free // MEGABYTE)
+
+
+def recent_shot_statistics(directory):
+    """Average size, exposure and transfer time of the latest shots in a capture folder."""
+    if os.path.isfile(os.path.join(directory, SessionIndex.FILE_NAME)):
+        index = SessionIndex(directory)
+        try:
+            rows = index.recent_shots(RECENT_SHOTS)
+        finally:
+            index.close()
+        sizes = [row["size"] for row in rows if row["size"]]
+        if sizes:
+            exposure_times = [row["exposure_time"] for row in rows if row["exposure_time"] is not None]
+            transfer_times = [row["transfer_time"] for row in rows if row["transfer_time"] is not None]
+            return ShotStatistics(
+                bytes_per_shot=int(np.mean(sizes)),
+                exposure_time=float(np.mean(exposure_times)) if exposure_times else DEFAULT_EXPOSURE_TIME,
+                transfer_time=float(np.mean(transfer_times)) if transfer_times else DEFAULT_TRANSFER_TIME,
+                source=f"average of the last {len(sizes)} shots",
+            )
+
+    # Images without an index still tell the size
+    files = sorted(glob.glob(os.path.join(directory, "*.iiq")), key=os.path.getmtime)[-RECENT_SHOTS:]
+    if files:
+        return ShotStatistics(bytes_per_shot=int(np.mean([os.path.getsize(f) for f in files])),
+                              source=f"size of the last {len(files)} images")
+    return ShotStatistics()
+
+
+def estimate_session(plan, directory, statistics=None, offload_directory=None):
+    """Estimate the rest of a plan, with errors for what would stop it and warnings for what is risky."""
+    statistics = statistics or recent_shot_statistics(directory)
+    remaining = plan.remaining()
+    positions = len(remaining)
+    shots_per_position = plan.shots_per_position
+    shots = positions * shots_per_position
+
+    durations = plan.durations[remaining]
+    transfer_time = shots_per_position * statistics.transfer_time
+    motion_time = float(durations.sum())
+    total_time = float(np.maximum(durations, transfer_time).sum()) + shots * statistics.exposure_time
+
+    disk = shutil.disk_usage(existing_directory(directory))
+    required_bytes = shots * statistics.bytes_per_shot
+    estimate = SessionEstimate(positions, shots, statistics, required_bytes, disk.free, disk.total, motion_time, total_time)
+
+    if required_bytes + MIN_FREE_BYTES > disk.free:
+        estimate.errors.append(f"the session needs {required_bytes / GIGABYTE:.1f} GB but only "
+                               f"{max(disk.free - MIN_FREE_BYTES, 0) / GIGABYTE:.1f} GB can be used in {directory}")
+    elif disk.free - required_bytes < LOW_SPACE_FRACTION * disk.total:
+        estimate.warnings.append(f"the disk will be {100 * (1 - (disk.free - required_bytes) / disk.total):.0f}% full after the session")
+
+    if offload_directory is not None:
+        offload_free = shutil.disk_usage(existing_directory(offload_directory)).free
+        if required_bytes > offload_free:
+            estimate.warnings.append(f"the offload folder only has {offload_free / GIGABYTE:.1f} GB free")
+    return estimate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Estimate the disk space and time a spin set will take.")
+    parser.add_argument("positions", nargs="?", help="spin_positions CSV file, instead of --rows")
+    parser.add_argument("--rows", type=int, default=4, help="evenly spaced rows from φ=0 to 90")
+    parser.add_argument("--cols", type=int, default=16, help="evenly spaced columns, unless the CSV file lists them")
+    parser.add_argument("--height", type=float, default=0.0, help="h of evenly spaced rows")
+    parser.add_argument("--shots", type=int, default=1, help="shots per position")
+    parser.add_argument("--directory", default=os.path.join(os.path.dirname(os.getcwd()), "captures", "default"),
+                        help="capture folder to check the disk and recent shots of")
+    parser.add_argument("--coordinated", action="store_true", help="move all axes together")
+    args = parser.parse_args(argv)
+
+    row_values, col_values = [], []
+    if args.positions:
+        try:
+            row_values, col_values = read_spin_positions(args.positions)
+        except (OSError, ValueError) as e:
+            print(e)
+            return 1
+    if not row_values:
+        row_values = [[phi, args.height] for phi in np.linspace(0, 90, num=args.rows, endpoint=False)]
+    if not col_values:
+        col_values = np.linspace(0, 360, num=args.cols, endpoint=False)
+
+    # Planned from the homed position at the default rates
+    plan = CapturePlan.from_spin_set(row_values, col_values, [0, 0, 0], motion.DEFAULT_MAX_SPEEDS, motion.DEFAULT_ACCELERATIONS,
+                                     coordinated=args.coordinated, shots_per_position=args.shots)
+    path_planner.optimize_order(plan, [0, 0, 0], motion.DEFAULT_MAX_SPEEDS, motion.DEFAULT_ACCELERATIONS, coordinated=args.coordinated)
+    try:
+        plan.validate()
+    except ValueError as e:
+        print(e)
+        return 1
+    estimate = estimate_session(plan, args.directory)
+    print(estimate)
+    return 0 if estimate.ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
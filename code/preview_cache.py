@@ -0,0 +1,215 @@
+"""
+Preview cache for captured images.
+
+Decoding a 100+ MB capture for the "Latest Captured Image" tab is too slow for the GUI thread and
+too heavy for a thread that shares the GIL with the capture. PreviewCache renders downscaled
+previews in a worker process instead: it reads the preview embedded in the file that best fits
+(see embedded_preview.py) straight from a memory map, and only has PIL decode the full image when
+there is none. Rendered previews are
+saved as JPEG files in a previews folder beside the captures, so they are only rendered once,
+and the latest ones are kept in memory as RGB pixels.
+
+Gallery thumbnails are kept the same way in previews/thumbnails. render_thumbnail() is cheap
+enough for a worker thread when the preview has been rendered already, since it only reads the
+preview JPEG at reduced size.
+
+Callbacks are called from a worker thread of the cache.
+"""
+
+import io
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import embedded_preview
+from session_archive import ArchiveReader, EntryFile
+
+PREVIEW_FOLDER = "previews"
+PREVIEW_QUALITY = 85
+THUMBNAIL_FOLDER = "thumbnails"
+THUMBNAIL_SIZE = 192
+
+
+class Preview:
+    """Pixels of a preview, 8-bit RGB rows."""
+
+    def __init__(self, width, height, data):
+        self.width = width
+        self.height = height
+        self.data = data
+
+    @classmethod
+    def from_image(cls, img):
+        img = img.convert("RGB")
+        return cls(img.width, img.height, img.tobytes())
+
+
+def preview_path(path, archive_path=None):
+    """Where the preview of a capture (or of an archived shot) is kept."""
+    directory = os.path.dirname(archive_path if archive_path is not None else path)
+    return os.path.join(directory, PREVIEW_FOLDER, os.path.basename(path) + ".jpg")
+
+
+def thumbnail_path(path, archive_path=None):
+    directory = os.path.dirname(archive_path if archive_path is not None else path)
+    return os.path.join(directory, PREVIEW_FOLDER, THUMBNAIL_FOLDER, os.path.basename(path) + ".jpg")
+
+
+def embedded_frame(img, max_size):
+    """Select the smallest image in the file that still covers max_size; the full image if none does."""
+    best = None
+    for frame in range(getattr(img, "n_frames", 1)):
+        img.seek(frame)
+        size = max(img.size)
+        if size >= max_size and (best is None or size < best[1]):
+            best = (frame, size)
+    img.seek(best[0] if best is not None else 0)
+    return img
+
+
+def decode_capture(path, max_size, archive_path=None):
+    """RGB image of a capture scaled down to max_size, from its embedded preview if it has one."""
+    reader = ArchiveReader(archive_path) if archive_path is not None else None
+    f = data = None
+    try:
+        if reader is not None:
+            data = reader.view(os.path.basename(path))
+        else:
+            f = open(path, "rb")
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        img = embedded_preview.load_preview(data, max_size)
+        if img is not None:
+            return img
+        # No preview to use, the whole file has to be decoded
+        with io.BufferedReader(EntryFile(memoryview(data))) as entry, Image.open(entry) as img:
+            if img.format == "JPEG":
+                img.draft("RGB", (max_size, max_size))
+            img = embedded_frame(img, max_size)
+            img.thumbnail((max_size, max_size))
+            return img.convert("RGB")
+    finally:
+        if f is not None:
+            if data is not None:
+                data.close()
+            f.close()
+        elif data is not None:
+            data.release()
+        if reader is not None:
+            reader.close()
+
+
+def render_preview(path, target, max_size, archive_path=None):
+    """Render (or reload) the preview of a capture. Runs in the worker process."""
+    source_time = os.path.getmtime(archive_path if archive_path is not None else path)
+    # Archived shots never change, the archive's time only says when the last one was added
+    if os.path.isfile(target) and (archive_path is not None or os.path.getmtime(target) >= source_time):
+        with Image.open(target) as img:
+            return Preview.from_image(img)
+
+    img = decode_capture(path, max_size, archive_path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    img.save(target + ".tmp", "JPEG", quality=PREVIEW_QUALITY)
+    os.replace(target + ".tmp", target)
+    return Preview.from_image(img)
+
+
+def render_thumbnail(path, size=THUMBNAIL_SIZE, archive_path=None):
+    """Render (or reload) the gallery thumbnail of a capture, from its preview if there is one."""
+    target = thumbnail_path(path, archive_path)
+    source_time = os.path.getmtime(archive_path if archive_path is not None else path)
+    if os.path.isfile(target) and (archive_path is not None or os.path.getmtime(target) >= source_time):
+        with Image.open(target) as img:
+            return Preview.from_image(img)
+
+    preview = preview_path(path, archive_path)
+    if os.path.isfile(preview) and (archive_path is not None or os.path.getmtime(preview) >= source_time):
+        with Image.open(preview) as img:
+            img.draft("RGB", (size, size))
+            img.thumbnail((size, size))
+            img = img.convert("RGB")
+    else:
+        img = decode_capture(path, size, archive_path)
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    img.save(target + ".tmp", "JPEG", quality=PREVIEW_QUALITY)
+    os.replace(target + ".tmp", target)
+    return Preview.from_image(img)
+
+
+class PreviewCache:
+    MAX_SIZE = 1600 # pixels along the long edge
+    MEMORY_ITEMS = 32
+
+    def __init__(self, max_size=MAX_SIZE, memory_items=MEMORY_ITEMS, workers=1):
+        self.max_size = max_size
+        self.memory_items = memory_items
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def request(self, path, archive_path=None, callback=None, on_error=None):
+        """Get a preview without waiting: callback(preview) right away if it is in memory,
+        otherwise once it has been rendered. on_error(exception) if it can't be."""
+        key = (archive_path, path)
+        with self.lock:
+            preview = self.memory.get(key)
+            if preview is not None:
+                self.memory.move_to_end(key)
+        if preview is not None:
+            if callback is not None:
+                callback(preview)
+            return
+
+        try:
+            future = self.executor.submit(render_preview, path, preview_path(path, archive_path), self.max_size, archive_path)
+        except RuntimeError as e:
+            # The worker process died (BrokenProcessPool) or the cache has been closed
+            if on_error is not None:
+                on_error(e)
+            return
+
+        def on_done(future):
+            try:
+                preview = future.result()
+            except Exception as e:
+                if on_error is not None:
+                    on_error(e)
+                return
+            self._remember(key, preview)
+            if callback is not None:
+                callback(preview)
+
+        future.add_done_callback(on_done)
+
+    def load(self, path, archive_path=None):
+        """The preview of a capture, waiting for it to be rendered if need be."""
+        result = {}
+        done = threading.Event()
+
+        def on_preview(preview):
+            result["preview"] = preview
+            done.set()
+
+        def on_error(e):
+            result["error"] = e
+            done.set()
+
+        self.request(path, archive_path, on_preview, on_error)
+        done.wait()
+        if "error" in result:
+            raise result["error"]
+        return result["preview"]
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _remember(self, key, preview):
+        with self.lock:
+            self.memory[key] = preview
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_items:
+                self.memory.popitem(last=False)
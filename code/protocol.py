@@ -0,0 +1,148 @@
+"""
+Binary framing of the controller protocol.
+
+The ASCII protocol stays the default. Sending "B0+1" switches the controller to binary frames in
+both directions; it answers "B 1" as the last ASCII line. Firmware that doesn't know the command
+ignores it, so the PC keeps talking ASCII.
+
+Every frame is
+
+    sync (0xA5) | type | sequence | payload length | payload | checksum
+
+with little-endian packed payloads. The type is the ASCII command or reply character, the
+sequence number counts the frames each side has sent (modulo 256) so lost frames can be
+detected, and the checksum makes the bytes from type to checksum sum to zero modulo 256.
+Decoded replies are (code, fields) pairs with the same fields as the ASCII replies.
+"""
+
+import struct
+
+SYNC = 0xA5
+HEADER = struct.Struct("<BBBB") # sync, type, sequence, payload length
+MAX_PAYLOAD = 24
+
+COMMAND = struct.Struct("<Bl") # axis, value
+
+# Status frames carry what the P and D replies do: is_running of each axis in bits 0-2,
+# needs_homing in bits 3-5, then the positions
+STATUS = struct.Struct("<B3l")
+REPLY_FORMATS = {
+    "P": STATUS,
+    "R": struct.Struct("<6f"),   # max speed and acceleration of each axis
+    "C": struct.Struct("<Bl"),   # axis, position
+    "H": struct.Struct("<B"),    # axis
+    "B": struct.Struct("<B"),    # framing now in use, 0 for ASCII
+    "L": struct.Struct("<4s"),   # limit switch id
+    "W": struct.Struct("<4s"),
+    "N": struct.Struct("<"),
+    "E": struct.Struct("<"),
+}
+
+
+def checksum(data):
+    return -sum(data) & 0xFF
+
+
+def encode_frame(frame_type, sequence, payload=b""):
+    header = HEADER.pack(SYNC, ord(frame_type), sequence & 0xFF, len(payload))
+    return header + payload + bytes([checksum(header[1:] + payload)])
+
+
+def parse_command(line):
+    """Split an ASCII command like "M1-2000" into ("M", 1, -2000). Status requests are sent
+    without an axis or value, those default to 0."""
+    line = line.strip()
+    axis = int(line[1]) if len(line) > 1 and line[1] in "012" else 0
+    value = 0
+    if len(line) > 3 and line[3:].isdigit():
+        value = int(line[3:])
+        if line[2] == "-":
+            value = -value
+    return line[0], axis, value
+
+
+def encode_command(command, sequence):
+    """Binary frame of an ASCII command line."""
+    code, axis, value = parse_command(command)
+    return encode_frame(code, sequence, COMMAND.pack(axis, value))
+
+
+def decode_command(frame_type, payload):
+    """(code, axis, value) of a binary command frame."""
+    axis, value = COMMAND.unpack(payload)
+    return frame_type, axis, value
+
+
+def encode_reply(code, fields, sequence):
+    """Binary frame of a reply, given the fields of its ASCII form. A status frame takes the
+    fields of the P reply followed by those of the D reply."""
+    if code == "P":
+        flags = 0
+        for axis in range(3):
+            flags |= (1 << axis) if fields[axis * 2] else 0
+            flags |= (1 << (axis + 3)) if fields[6 + axis] else 0
+        payload = STATUS.pack(flags, *(int(fields[axis * 2 + 1]) for axis in range(3)))
+    elif code in ("L", "W"):
+        payload = REPLY_FORMATS[code].pack(fields[0].encode())
+    else:
+        payload = REPLY_FORMATS[code].pack(*fields)
+    return encode_frame(code, sequence, payload)
+
+
+def decode_reply(frame_type, payload):
+    """The (code, fields) messages carried by a reply frame."""
+    values = REPLY_FORMATS[frame_type].unpack(payload)
+    match frame_type:
+        case "P":
+            flags, stage, track, nod = values
+            status = [flags & 1, stage, (flags >> 1) & 1, track, (flags >> 2) & 1, nod]
+            return [("P", status), ("D", [(flags >> 3) & 1, (flags >> 4) & 1, (flags >> 5) & 1])]
+        case "L" | "W":
+            return [(frame_type, [values[0].rstrip(b"\x00").decode(errors="replace")])]
+        case _:
+            return [(frame_type, list(values))]
+
+
+class FrameDecoder:
+    """Splits a byte stream into frames, skipping anything that doesn't check out."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.expected_sequence = None
+        self.checksum_errors = 0
+        self.lost_frames = 0
+
+    def feed(self, data):
+        """Add received bytes and return the complete frames as (type, sequence, payload)."""
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        position = 0
+        while True:
+            start = buffer.find(SYNC, position)
+            if start < 0:
+                position = len(buffer)
+                break
+            position = start
+            if len(buffer) - start < HEADER.size:
+                break
+            _, frame_type, sequence, length = HEADER.unpack_from(buffer, start)
+            end = start + HEADER.size + length + 1
+            if length > MAX_PAYLOAD:
+                # Not a real frame start, look for the next one
+                position = start + 1
+                continue
+            if len(buffer) < end:
+                break
+            if sum(buffer[start + 1:end]) & 0xFF:
+                self.checksum_errors += 1
+                position = start + 1
+                continue
+
+            if self.expected_sequence is not None and sequence != self.expected_sequence:
+                self.lost_frames += (sequence - self.expected_sequence) & 0xFF
+            self.expected_sequence = (sequence + 1) & 0xFF
+            frames.append((chr(frame_type), sequence, bytes(buffer[start + HEADER.size:end - 1])))
+            position = end
+        del buffer[:position]
+        return frames
@@ -0,0 +1,213 @@
+"""
+Serial I/O thread for the stepper controller.
+
+SerialWorker owns the port: it reads continuously, parses the controller's replies and emits one
+typed Qt signal per reply, so the GUI thread never blocks on the port. The firmware reports
+every finished move on its own with a C reply, so status requests are only needed to keep the
+position readout current and are sent a few times a second.
+
+On start the worker asks the controller for binary framing (see protocol.py). Commands are still
+written as ASCII strings and replies come out as the same signals either way; if the firmware
+doesn't answer, the ASCII protocol is kept. A late answer, e.g. from a controller that was still
+booting after the port was opened, still switches over, and the commands the controller dropped
+while it was framed and the worker wasn't are sent again.
+"""
+
+import struct
+import threading
+import time
+
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
+
+import protocol
+
+
+def parse_line(line):
+    """Split a reply into its code and fields, e.g. "H 1" -> ("H", ["1"])."""
+    fields = line.split()
+    if not fields:
+        return None, []
+    return fields[0], fields[1:]
+
+
+class SerialWorker(QObject):
+    # The firmware repeats "E" every 50 ms while the e-stop is pressed
+    ESTOP_RELEASE_TIMEOUT = 0.15
+    READ_TIMEOUT = 0.002
+    NEGOTIATION_TIMEOUT = 0.5
+    # Binary status frames are small enough to keep the position readout live
+    BINARY_POLL_INTERVAL = 0.05
+
+    status_received = pyqtSignal(list, list)   # is_running and steps of each axis
+    homing_status_received = pyqtSignal(list)  # needs_homing of each axis
+    move_complete = pyqtSignal(int, int)       # axis and its final position
+    rates_received = pyqtSignal(list, list)    # max speed and acceleration of each axis
+    homing_complete = pyqtSignal(int)
+    needs_homing = pyqtSignal()
+    limit_switch_hit = pyqtSignal(str)
+    wrong_direction = pyqtSignal(str)
+    estop_changed = pyqtSignal(bool)
+    invalid_reply = pyqtSignal(str)
+    binary_mode_changed = pyqtSignal(bool)
+
+    def __init__(self, serial_port, poll_interval=0.25, binary=True):
+        super().__init__(None)
+        self.serial = serial_port
+        self.serial.timeout = self.READ_TIMEOUT
+        self.poll_interval = poll_interval
+        self.binary = binary
+        self.binary_mode = False
+        self.decoder = protocol.FrameDecoder()
+        self.sequence = 0
+        self.negotiation_deadline = None
+        self.pending_writes = []
+        # ASCII commands written since the negotiation timed out, until the controller answers in ASCII
+        self.unanswered_writes = None
+        self.running = False
+        self.write_lock = threading.Lock()
+        self.read_buffer = bytearray()
+        self.last_estop_time = None
+
+    def write(self, command):
+        """Send a command; safe to call from any thread."""
+        with self.write_lock:
+            if self.negotiation_deadline is not None:
+                # The controller may already have switched, hold commands until its answer is in
+                self.pending_writes.append(command)
+            else:
+                self._write(command)
+                if self.unanswered_writes is not None and command != "P": # a lost poll needs no resend
+                    self.unanswered_writes.append(command)
+
+    def _write(self, command):
+        if self.binary_mode:
+            self.serial.write(protocol.encode_command(command, self.sequence))
+            self.sequence = (self.sequence + 1) & 0xFF
+        else:
+            self.serial.write((command.strip() + "\n").encode())
+
+    @pyqtSlot()
+    def start(self):
+        self.running = True
+        if self.binary:
+            with self.write_lock:
+                self.serial.write(b"B0+1\n")
+                self.negotiation_deadline = time.monotonic() + self.NEGOTIATION_TIMEOUT
+
+        next_poll_time = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            if self.negotiation_deadline is not None and now > self.negotiation_deadline:
+                self.end_negotiation(timed_out=True)
+            if self.poll_interval and now >= next_poll_time:
+                self.write("P")
+                next_poll_time = now + self.poll_interval
+
+            data = self.serial.read(max(1, self.serial.in_waiting))
+            if data:
+                self.read_buffer += data
+                self.handle_buffer()
+            self.check_estop_released()
+
+    @pyqtSlot()
+    def stop(self):
+        self.running = False
+
+    def end_negotiation(self, binary_mode=False, timed_out=False):
+        with self.write_lock:
+            self.negotiation_deadline = None
+            self.binary_mode = binary_mode
+            for command in self.pending_writes:
+                self._write(command)
+            self.unanswered_writes = self.pending_writes if timed_out else None
+            self.pending_writes = []
+        if binary_mode:
+            self.poll_interval = min(self.poll_interval, self.BINARY_POLL_INTERVAL)
+        self.binary_mode_changed.emit(binary_mode)
+
+    def on_framing_reply(self, binary_mode):
+        if self.negotiation_deadline is not None:
+            self.end_negotiation(binary_mode)
+            return
+        with self.write_lock:
+            if self.unanswered_writes is None:
+                return
+            commands, self.unanswered_writes = self.unanswered_writes, None
+            if not binary_mode:
+                return
+            # The controller switched when it read the request, so it dropped every ASCII command since
+            self.binary_mode = True
+            for command in commands:
+                self._write(command)
+        self.poll_interval = min(self.poll_interval, self.BINARY_POLL_INTERVAL)
+        self.binary_mode_changed.emit(True)
+
+    def handle_buffer(self):
+        while not self.binary_mode:
+            end = self.read_buffer.find(b"\n")
+            if end < 0:
+                return
+            line = self.read_buffer[:end].decode(errors="replace").strip()
+            del self.read_buffer[:end + 1]
+            self.handle_line(line)
+
+        # Everything after the B reply is framed
+        data = bytes(self.read_buffer)
+        self.read_buffer.clear()
+        for frame_type, _, payload in self.decoder.feed(data):
+            try:
+                messages = protocol.decode_reply(frame_type, payload)
+            except (KeyError, struct.error):
+                self.invalid_reply.emit(f"{frame_type} frame {payload.hex()}")
+                continue
+            for code, fields in messages:
+                self.handle_message(code, fields, f"{code} {fields}")
+
+    def handle_line(self, line):
+        code, fields = parse_line(line)
+        self.handle_message(code, fields, line)
+
+    def handle_message(self, code, fields, line):
+        try:
+            match code:
+                case None:
+                    pass
+                case "P":
+                    is_running = [int(fields[axis * 2]) for axis in range(3)]
+                    steps = [int(fields[axis * 2 + 1]) for axis in range(3)]
+                    if self.unanswered_writes is not None:
+                        # A status reply in ASCII means the controller read the request and stayed in ASCII
+                        with self.write_lock:
+                            self.unanswered_writes = None
+                    self.status_received.emit(is_running, steps)
+                case "C":
+                    self.move_complete.emit(int(fields[0]), int(fields[1]))
+                case "D":
+                    self.homing_status_received.emit([int(f) for f in fields[:3]])
+                case "R":
+                    speeds = [float(fields[axis * 2]) for axis in range(3)]
+                    accelerations = [float(fields[axis * 2 + 1]) for axis in range(3)]
+                    self.rates_received.emit(speeds, accelerations)
+                case "H":
+                    self.homing_complete.emit(int(fields[0]))
+                case "N":
+                    self.needs_homing.emit()
+                case "L":
+                    self.limit_switch_hit.emit(fields[0] if fields else "")
+                case "W":
+                    self.wrong_direction.emit(fields[0] if fields else "")
+                case "E":
+                    if self.last_estop_time is None:
+                        self.estop_changed.emit(True)
+                    self.last_estop_time = time.monotonic()
+                case "B":
+                    self.on_framing_reply(int(fields[0]) == 1)
+                case _:
+                    self.invalid_reply.emit(line)
+        except (IndexError, ValueError):
+            self.invalid_reply.emit(line)
+
+    def check_estop_released(self):
+        if self.last_estop_time is not None and time.monotonic() - self.last_estop_time > self.ESTOP_RELEASE_TIMEOUT:
+            self.last_estop_time = None
+            self.estop_changed.emit(False)
@@ -0,0 +1,247 @@
+"""
+Single-file session archives.
+
+Instead of one file per shot, a capture sequence can append its images to one archive file per
+session. That saves the filesystem hundreds of 100 MB files in one folder and lets a session be
+copied off the capture PC as one sequential stream.
+
+Layout (little-endian):
+
+    header   magic "SHOTARCH", version, padded to ALIGNMENT
+    entry    "SHOT", name length, data size, name, padding, data      (repeated)
+    index    JSON list of [name, data offset, data size]
+    trailer  magic "SHOTINDX", index offset, index size
+
+Entry data starts on an ALIGNMENT boundary so it can be mapped and read in place. The index and
+trailer are written when the archive is closed and replaced when more shots are appended, e.g.
+when a session is resumed. An archive that was never closed (a crash, or one still being written)
+is read by walking the entry headers instead. When a name appears twice the later entry wins.
+
+    python session_archive.py list <archive>
+    python session_archive.py extract <archive> <directory> [name ...]
+"""
+
+import argparse
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+
+MAGIC = b"SHOTARCH"
+VERSION = 1
+ALIGNMENT = 4096
+HEADER = struct.Struct("<8sI") # magic, version
+ENTRY_HEADER = struct.Struct("<4sIQ") # "SHOT", name length, data size
+ENTRY_MAGIC = b"SHOT"
+TRAILER = struct.Struct("<8sQQ") # magic, index offset, index size
+TRAILER_MAGIC = b"SHOTINDX"
+EXTRACT_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def padding(offset):
+    return -offset % ALIGNMENT
+
+
+def read_index(f):
+    """Entries of an archive as {name: (data offset, data size)}, and the offset where the next
+    entry goes."""
+    f.seek(0)
+    magic, version = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{getattr(f, 'name', 'file')} is not a session archive")
+    file_size = f.seek(0, os.SEEK_END)
+
+    if file_size >= ALIGNMENT + TRAILER.size:
+        f.seek(file_size - TRAILER.size)
+        trailer_magic, index_offset, index_size = TRAILER.unpack(f.read(TRAILER.size))
+        if trailer_magic == TRAILER_MAGIC and index_offset + index_size + TRAILER.size == file_size:
+            f.seek(index_offset)
+            entries = {name: (offset, size) for name, offset, size in json.loads(f.read(index_size))}
+            return entries, index_offset
+
+    # No index, collect the complete entries
+    entries = {}
+    position = ALIGNMENT
+    while position + ENTRY_HEADER.size <= file_size:
+        f.seek(position)
+        entry_magic, name_length, size = ENTRY_HEADER.unpack(f.read(ENTRY_HEADER.size))
+        if entry_magic != ENTRY_MAGIC:
+            break
+        name = f.read(name_length).decode(errors="replace")
+        offset = position + ENTRY_HEADER.size + name_length
+        offset += padding(offset)
+        if offset + size > file_size:
+            break
+        entries[name] = (offset, size)
+        position = offset + size
+    return entries, position
+
+
+class ArchiveWriter:
+    SUFFIX = ".shots"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            # Append to it, the new index replaces the old one
+            self.file = open(path, "r+b")
+            self.entries, end = read_index(self.file)
+            self.file.seek(end)
+            self.file.truncate()
+        else:
+            self.file = open(path, "wb")
+            self.entries = {}
+            header = HEADER.pack(MAGIC, VERSION)
+            self.file.write(header + bytes(padding(len(header))))
+
+    def add(self, name, image, chunk_size=EXTRACT_CHUNK_SIZE, fsync=False, hasher=None):
+        """Append a CapturedImage. Safe to call from any thread."""
+        encoded_name = name.encode()
+        with self.lock:
+            position = self.file.tell()
+            try:
+                header = ENTRY_HEADER.pack(ENTRY_MAGIC, len(encoded_name), len(image)) + encoded_name
+                self.file.write(header + bytes(padding(position + len(header))))
+                offset = self.file.tell()
+                image.write_to(self.file, chunk_size, hasher)
+                if fsync:
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+            except BaseException:
+                # Drop the partial entry, a header walk after a crash would stop at it and lose
+                # every entry appended after it
+                self.file.seek(position)
+                self.file.truncate()
+                raise
+            self.entries[name] = (offset, len(image))
+
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            index_offset = self.file.tell()
+            index = json.dumps([[name, offset, size] for name, (offset, size) in self.entries.items()]).encode()
+            self.file.write(index + TRAILER.pack(TRAILER_MAGIC, index_offset, len(index)))
+            self.file.close()
+
+
+class EntryFile(io.RawIOBase):
+    """Read-only file object over the data of one entry."""
+
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = max(min(len(buffer), len(self.view) - self.position), 0)
+        buffer[:count] = self.view[self.position:self.position + count]
+        self.position += count
+        return count
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: len(self.view)}[whence]
+        self.position = max(base + offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+        super().close()
+
+
+class ArchiveReader:
+    """Memory-mapped view of an archive. Entries are only read when they are asked for; views and
+    entry files handed out have to be released before the reader is closed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.entries, _ = read_index(self.file)
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self):
+        return list(self.entries)
+
+    def size(self, name):
+        return self.entries[name][1]
+
+    def view(self, name):
+        """memoryview of an entry's data, straight from the mapping."""
+        offset, size = self.entries[name]
+        return memoryview(self.map)[offset:offset + size]
+
+    def open(self, name):
+        return io.BufferedReader(EntryFile(self.view(name)))
+
+    def extract(self, name, directory):
+        """Write an entry to a file of the same name in directory. Raises a ValueError for a name
+        that would put it anywhere else."""
+        # basename() also catches a Windows drive prefix
+        if name in ("", ".", "..") or "/" in name or "\\" in name or os.path.basename(name) != name:
+            raise ValueError(f"Refusing to extract {name!r} outside of {directory}")
+        path = os.path.join(directory, name)
+        with self.view(name) as data, open(path, "wb") as f:
+            for offset in range(0, len(data), EXTRACT_CHUNK_SIZE):
+                f.write(data[offset:offset + EXTRACT_CHUNK_SIZE])
+        return path
+
+    def extract_all(self, directory):
+        return [self.extract(name, directory) for name in self.entries]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List or extract the shots in a session archive.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    list_parser = subparsers.add_parser("list")
+    list_parser.add_argument("archive")
+    extract_parser = subparsers.add_parser("extract")
+    extract_parser.add_argument("archive")
+    extract_parser.add_argument("directory")
+    extract_parser.add_argument("names", nargs="*", help="shots to extract, all of them if none are given")
+    args = parser.parse_args(argv)
+
+    with ArchiveReader(args.archive) as reader:
+        if args.command == "list":
+            for name in reader.names():
+                print(f"{reader.size(name):>12}  {name}")
+        else:
+            os.makedirs(args.directory, exist_ok=True)
+            for name in args.names or reader.names():
+                print(reader.extract(name, args.directory))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""
+Per-session shot index.
+
+Every shot of a capture sequence gets a row in session_index.sqlite next to the images: where in
+the plan it was taken, the commanded and reported motor steps, the pose, the camera settings,
+the file and how long each stage of the shot took. Processing jobs query it by pose instead of
+scanning the folder and parsing filenames.
+
+Rows are only ever added. A resumed session appends to the same index, so a position can have
+rows from both attempts; the latest one is the one on disk.
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+
+class ShotRecord:
+    def __init__(self, session_id, plan_index, shot, path, position, commanded_steps, actual_steps,
+                 camera_settings=None):
+        self.session_id = session_id
+        self.plan_index = plan_index
+        self.shot = shot # number within the position's burst
+        self.path = path
+        self.position = position # θ, φ, h
+        self.commanded_steps = commanded_steps
+        self.actual_steps = actual_steps # from the last status reply before the trigger
+        self.camera_settings = camera_settings or {}
+        self.move_time = None # seconds the motors took to reach the position, None if they didn't move
+        self.archive = None # name of the session archive holding the shot, None for a file of its own
+
+
+class SessionIndex:
+    FILE_NAME = "session_index.sqlite"
+
+    COLUMNS = (
+        ("session_id", "TEXT NOT NULL"),
+        ("plan_index", "INTEGER"),
+        ("shot", "INTEGER"),
+        ("path", "TEXT NOT NULL"),
+        ("archive", "TEXT"),
+        ("size", "INTEGER"),
+        ("checksum", "TEXT"),
+        ("theta", "REAL"),
+        ("phi", "REAL"),
+        ("h", "REAL"),
+        ("commanded_stage", "INTEGER"),
+        ("commanded_track", "INTEGER"),
+        ("commanded_nod", "INTEGER"),
+        ("actual_stage", "INTEGER"),
+        ("actual_track", "INTEGER"),
+        ("actual_nod", "INTEGER"),
+        ("camera_settings", "TEXT"), # JSON object
+        ("captured_at", "REAL"), # Unix time the shot was written
+        ("move_time", "REAL"),
+        ("exposure_time", "REAL"), # trigger until the shutter closed
+        ("transfer_time", "REAL"), # shutter closed until the image was off the camera
+        ("write_time", "REAL"), # off the camera until it was on disk
+        ("error", "TEXT"),
+    )
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, self.FILE_NAME)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.row_factory = sqlite3.Row
+        # One transaction per shot, the write-ahead log keeps those cheap
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        columns = ", ".join(f"{name} {definition}" for name, definition in self.COLUMNS)
+        with self.connection:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS shots (id INTEGER PRIMARY KEY, {columns})")
+            # Indexes written by an older version are missing the newer columns
+            existing = {row["name"] for row in self.connection.execute("PRAGMA table_info(shots)")}
+            for name, definition in self.COLUMNS:
+                if name not in existing:
+                    self.connection.execute(f"ALTER TABLE shots ADD COLUMN {name} {definition.replace(' NOT NULL', '')}")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS shots_by_pose ON shots (phi, theta, h)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS shots_by_plan_index ON shots (session_id, plan_index, shot)")
+
+    def add_shot(self, record, job=None, size=None, checksum=None, error=None):
+        """Append a row for a shot. job is the CaptureJob it was taken with, for the timings."""
+        exposure_time = transfer_time = write_time = None
+        if job is not None:
+            exposure_time = difference(job.trigger_time, job.exposed_time)
+            transfer_time = difference(job.exposed_time, job.transferred_time)
+            write_time = difference(job.transferred_time, job.saved_time)
+            error = error if error is not None else job.error
+        row = {
+            "session_id": record.session_id,
+            "plan_index": record.plan_index,
+            "shot": record.shot,
+            "path": record.path,
+            "archive": record.archive,
+            "size": size,
+            "checksum": checksum,
+            "theta": record.position[0],
+            "phi": record.position[1],
+            "h": record.position[2],
+            "commanded_stage": record.commanded_steps[0],
+            "commanded_track": record.commanded_steps[1],
+            "commanded_nod": record.commanded_steps[2],
+            "actual_stage": record.actual_steps[0],
+            "actual_track": record.actual_steps[1],
+            "actual_nod": record.actual_steps[2],
+            "camera_settings": json.dumps(record.camera_settings),
+            "captured_at": time.time(),
+            "move_time": record.move_time,
+            "exposure_time": exposure_time,
+            "transfer_time": transfer_time,
+            "write_time": write_time,
+            "error": None if error is None else str(error),
+        }
+        names = ", ".join(row)
+        placeholders = ", ".join(f":{name}" for name in row)
+        with self.connection:
+            self.connection.execute(f"INSERT INTO shots ({names}) VALUES ({placeholders})", row)
+
+    def shots(self, session_id=None, include_failed=False):
+        """Every shot in the order it was recorded."""
+        conditions, parameters = [], []
+        if session_id is not None:
+            conditions.append("session_id = ?")
+            parameters.append(session_id)
+        if not include_failed:
+            conditions.append("error IS NULL")
+        return self._select(conditions, parameters, "id")
+
+    def recent_shots(self, count):
+        """The last count successful shots, newest first."""
+        return self._select(["error IS NULL"], [], f"id DESC LIMIT {int(count)}")
+
+    def shots_at(self, theta=None, phi=None, h=None, tolerance=1e-3):
+        """Successful shots at a pose. Leave a coordinate out to match any value of it."""
+        conditions, parameters = ["error IS NULL"], []
+        for name, value in (("phi", phi), ("theta", theta), ("h", h)):
+            if value is not None:
+                conditions.append(f"{name} BETWEEN ? AND ?")
+                parameters += [value - tolerance, value + tolerance]
+        return self._select(conditions, parameters, "phi, theta, h, shot, id")
+
+    def shot(self, session_id, plan_index, shot=0):
+        """The latest row of a shot, or None."""
+        rows = self._select(["session_id = ?", "plan_index = ?", "shot = ?"], [session_id, plan_index, shot], "id DESC LIMIT 1")
+        return rows[0] if rows else None
+
+    def close(self):
+        self.connection.close()
+
+    def _select(self, conditions, parameters, order):
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self.connection.execute(f"SELECT * FROM shots {where} ORDER BY {order}", parameters).fetchall()
+
+
+def difference(start, end):
+    if start is None or end is None:
+        return None
+    return end - start
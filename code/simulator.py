@@ -0,0 +1,397 @@
+"""
+In-process stand-in for the stepper controller.
+
+SimulatedController implements the serial protocol of microcontroller_code.ino on top of the
+AccelStepper port in motion.py, and exposes the parts of the pyserial API that ControlUI uses, so
+it can be dropped in for serial.Serial. Simulated time runs time_scale times faster than the
+wall clock, which lets whole capture sequences run in seconds.
+"""
+
+import threading
+import time
+
+import kinematics
+import motion
+import protocol
+
+# Physical travel between the limit switches, in steps (the homed range plus the backoff at both ends)
+TRACK_BACKOFF = 50 * motion.TRACK_MICROSTEPS
+NOD_BACKOFF = 10 * motion.NOD_MICROSTEPS
+TRACK_TRAVEL = kinematics.TRACK_MAX_STEPS + 2 * TRACK_BACKOFF
+NOD_TRAVEL = kinematics.NOD_MAX_STEPS + 2 * NOD_BACKOFF
+STAGE_HOMING_BACKOFF = 2211
+
+ESTOP_REPORT_INTERVAL = 50000 # µs, the delay in the firmware's e-stop branch
+MIN_TIME_SLICE = 1000 # µs
+
+
+class LimitSwitch:
+    def __init__(self, id, backoff, direction, axis, position):
+        self.id = id
+        self.backoff = backoff
+        self.direction = direction
+        self.axis = axis
+        self.position = position # physical position of the switch, in steps
+
+    def pressed(self, physical_position):
+        if self.direction > 0:
+            return physical_position >= self.position
+        return physical_position <= self.position
+
+
+class SimulatedController:
+    def __init__(self, time_scale=1.0, track_reverse_wound=False, initial_positions=None, clock=time.monotonic):
+        self.time_scale = time_scale
+        self.timeout = None
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.output_available = threading.Condition(self.lock)
+
+        self.motors = [motion.AccelStepper(motion.DEFAULT_MAX_SPEEDS[i], motion.DEFAULT_ACCELERATIONS[i]) for i in range(3)]
+        # Maps controller positions to where the axis physically is. A reverse-wound track moves
+        # the opposite way from what the controller expects.
+        self.directions = [1, -1 if track_reverse_wound else 1, 1]
+        if initial_positions is None:
+            initial_positions = [kinematics.STAGE_STEPS_PER_REVOLUTION // 3, TRACK_TRAVEL // 2, NOD_TRAVEL // 2]
+        self.offsets = list(initial_positions)
+
+        self.limit_switches = [
+            LimitSwitch("TTLS", TRACK_BACKOFF, 1, 1, TRACK_TRAVEL),
+            LimitSwitch("TBLS", TRACK_BACKOFF, -1, 1, 0),
+            LimitSwitch("NFLS", NOD_BACKOFF, 1, 2, NOD_TRAVEL),
+            LimitSwitch("NBLS", NOD_BACKOFF, -1, 2, 0),
+        ]
+        self.homing = [0, 0, 0]
+        self.needs_homing = [1, 1, 1]
+        self.move_done_pending = [False, False, False]
+        self.staged_targets = [None, None, None]
+        self.saved_rates = [None, None, None] # (max speed, acceleration) of axes in a coordinated move
+        self.last_nonzero_track_speed = 0.0
+        self.estop_pressed = False
+        self.last_estop_report = None
+
+        self.input_buffer = bytearray()
+        self.output_buffer = bytearray()
+        self.binary_mode = False
+        self.command_decoder = protocol.FrameDecoder()
+        self.sequence = 0
+        self.start_time = self.clock()
+        self.sim_time = 0.0 # µs
+
+    ### pyserial API ###
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            self._update()
+            return len(self.output_buffer)
+
+    def write(self, data):
+        with self.lock:
+            self._update()
+            self.input_buffer += data
+            while self.input_buffer:
+                if self.binary_mode:
+                    received, self.input_buffer = bytes(self.input_buffer), bytearray()
+                    for frame_type, _, payload in self.command_decoder.feed(received):
+                        if len(payload) == protocol.COMMAND.size:
+                            self._handle_command(*protocol.decode_command(frame_type, payload))
+                elif b"\n" in self.input_buffer:
+                    line, _, rest = self.input_buffer.partition(b"\n")
+                    self.input_buffer = bytearray(rest)
+                    line = line.decode(errors="replace").strip()
+                    if line:
+                        self._handle_command(*protocol.parse_command(line))
+                else:
+                    break
+            self._start_pending_moves()
+            self._report_finished_moves()
+            return len(data)
+
+    def readline(self):
+        return self._read_until(lambda buffer: buffer.find(b"\n") + 1)
+
+    def read(self, size=1):
+        return self._read_until(lambda buffer: size if len(buffer) >= size else 0, size)
+
+    def flushInput(self):
+        with self.lock:
+            self.output_buffer.clear()
+
+    reset_input_buffer = flushInput
+
+    def close(self):
+        pass
+
+    def _read_until(self, frame_length, max_length=None):
+        # Block like pyserial does, up to self.timeout seconds of wall clock time
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        if max_length is None:
+            max_length = float("inf")
+        with self.lock:
+            while True:
+                self._update()
+                length = frame_length(self.output_buffer)
+                if length:
+                    data = bytes(self.output_buffer[:length])
+                    del self.output_buffer[:length]
+                    return data
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    # Like pyserial, return whatever has arrived when the timeout expires
+                    length = min(len(self.output_buffer), max_length)
+                    data = bytes(self.output_buffer[:length])
+                    del self.output_buffer[:length]
+                    return data
+                # Motion replies depend on time passing, so wake up regularly to advance it
+                self.output_available.wait(0.001 if remaining is None else min(remaining, 0.001))
+
+    ### Test hooks ###
+
+    def press_estop(self):
+        with self.lock:
+            self._update()
+            self.estop_pressed = True
+
+    def release_estop(self):
+        with self.lock:
+            self._update()
+            self.estop_pressed = False
+            self.last_estop_report = None
+
+    def physical_positions(self):
+        with self.lock:
+            self._update()
+            return [self._physical_position(axis) for axis in range(3)]
+
+    def now(self):
+        """Current simulated time in seconds."""
+        with self.lock:
+            self._update()
+            return self.sim_time / 1000000.0
+
+    ### Simulation ###
+
+    def _println(self, line):
+        self.output_buffer += (line + "\r\n").encode()
+        self.output_available.notify_all()
+
+    def _send(self, code, *fields):
+        if self.binary_mode:
+            self.output_buffer += protocol.encode_reply(code, fields, self.sequence)
+            self.sequence = (self.sequence + 1) & 0xFF
+            self.output_available.notify_all()
+        else:
+            # Serial.print() shows floats with two decimals
+            self._println(" ".join([code] + [f"{field:.2f}" if isinstance(field, float) else str(field) for field in fields]))
+
+    def _physical_position(self, axis):
+        return self.offsets[axis] + self.directions[axis] * self.motors[axis].current_position()
+
+    def _set_current_position(self, axis, position):
+        physical = self._physical_position(axis)
+        self.motors[axis].set_current_position(position)
+        self.offsets[axis] = physical - self.directions[axis] * position
+
+    def _run_to_position(self, motor):
+        # runToPosition() blocks the firmware loop; the move is taken in one go here
+        self._start_pending_moves()
+        while motor.next_step_time() is not None:
+            motor.advance_to(motor.next_step_time())
+
+    def _start_pending_moves(self):
+        for motor in self.motors:
+            motor.start_due_step(self.sim_time)
+
+    def _update(self):
+        target_time = (self.clock() - self.start_time) * self.time_scale * 1000000.0
+        while self.sim_time < target_time:
+            if self.estop_pressed:
+                self._estop_loop(target_time)
+                return
+            # Advance in slices short enough that no axis can run far past a limit switch
+            slice_end = min(target_time, self.sim_time + self._safe_time_slice())
+            for motor in self.motors:
+                motor.advance_to(slice_end)
+            self.sim_time = slice_end
+            self._report_finished_moves()
+            self._check_switches()
+
+    def _safe_time_slice(self):
+        slice_length = float("inf")
+        for switch in self.limit_switches:
+            if self.motors[switch.axis].is_running():
+                margin = abs(switch.position - self._physical_position(switch.axis))
+                slice_length = min(slice_length, margin / motion.MAX_STEP_RATE * 1000000.0)
+        if self.homing[0] and self.motors[0].is_running():
+            stage_position = self._physical_position(0) % kinematics.STAGE_STEPS_PER_REVOLUTION
+            slice_length = min(slice_length, stage_position / motion.MAX_STEP_RATE * 1000000.0)
+        return max(slice_length, MIN_TIME_SLICE)
+
+    def _estop_loop(self, target_time):
+        if self.last_estop_report is None:
+            self.last_estop_report = self.sim_time - ESTOP_REPORT_INTERVAL
+        # Don't flood the buffer when running much faster than real time
+        reports = int((target_time - self.last_estop_report) // ESTOP_REPORT_INTERVAL)
+        for _ in range(min(reports, 10)):
+            self._send("E")
+        if reports:
+            self.last_estop_report += reports * ESTOP_REPORT_INTERVAL
+        for axis in range(3):
+            self._set_current_position(axis, 0)
+            self.needs_homing[axis] = 1
+            self.move_done_pending[axis] = False
+        self.sim_time = target_time
+
+    def _configured_rates(self, axis):
+        if self.saved_rates[axis] is not None:
+            return self.saved_rates[axis]
+        return self.motors[axis].max_speed(), self.motors[axis].acceleration()
+
+    def _restore_rates(self, axis):
+        if self.saved_rates[axis] is not None:
+            max_speed, acceleration = self.saved_rates[axis]
+            self.saved_rates[axis] = None
+            self.motors[axis].set_max_speed(max_speed)
+            self.motors[axis].set_acceleration(acceleration)
+
+    def _start_coordinated_move(self):
+        distances = [0, 0, 0]
+        for axis, target in enumerate(self.staged_targets):
+            if target is not None and self.needs_homing[axis] != 1:
+                distances[axis] = abs(target - self.motors[axis].current_position())
+        rates = [self._configured_rates(axis) for axis in range(3)]
+        # The firmware computes this in floats on the microcontroller, this is the same formula
+        max_speeds, accelerations = motion.coordinated_rates(distances, [r[0] for r in rates], [r[1] for r in rates])
+
+        for axis, target in enumerate(self.staged_targets):
+            if target is None:
+                continue
+            self.staged_targets[axis] = None
+            if self.needs_homing[axis] == 1:
+                self._send("N")
+                continue
+            if distances[axis] > 0:
+                if self.saved_rates[axis] is None:
+                    self.saved_rates[axis] = rates[axis]
+                self.motors[axis].set_max_speed(float(max_speeds[axis]))
+                self.motors[axis].set_acceleration(float(accelerations[axis]))
+                self.motors[axis].move_to(target)
+            self.move_done_pending[axis] = True
+
+    def _report_finished_moves(self):
+        for axis, motor in enumerate(self.motors):
+            if self.saved_rates[axis] is not None and not motor.is_running():
+                self._restore_rates(axis)
+            if self.move_done_pending[axis] and not motor.is_running():
+                self.move_done_pending[axis] = False
+                self._send("C", axis, motor.current_position())
+
+    def _check_switches(self):
+        track_speed = self.motors[1].speed()
+        for switch in self.limit_switches:
+            if switch.pressed(self._physical_position(switch.axis)):
+                self._handle_limit_switch(switch)
+
+        # Check stage limit switch separately, it is only acted on while homing
+        if self.homing[0] == 1 and self.motors[0].is_running():
+            if self._physical_position(0) <= 0:
+                self.offsets[0] += kinematics.STAGE_STEPS_PER_REVOLUTION
+                self.motors[0].move(-STAGE_HOMING_BACKOFF)
+                self._send("L", "SOLS")
+                self._run_to_position(self.motors[0])
+                self._set_current_position(0, 0)
+                self.homing[0] = 0
+                self.needs_homing[0] = 0
+                self._send("H", 0)
+
+        if track_speed != 0:
+            self.last_nonzero_track_speed = track_speed
+
+    def _handle_limit_switch(self, switch):
+        motor = self.motors[switch.axis]
+        self._set_current_position(switch.axis, 0)
+        self._restore_rates(switch.axis) # back off at the axis' own speed
+
+        # Ensure the track isn't reverse-wound
+        if (switch.id == "TTLS" and self.last_nonzero_track_speed < 0) or (switch.id == "TBLS" and self.last_nonzero_track_speed > 0):
+            self._send("W", switch.id)
+            self.homing[1] = 0
+            self.needs_homing[1] = 1
+            motor.move(switch.direction * switch.backoff)
+            self._run_to_position(motor)
+            self._back_off_physically(switch)
+            return
+
+        # Back off of the limit switch so it's no longer pressed
+        motor.move(-1 * switch.direction * switch.backoff)
+        self._run_to_position(motor)
+        self._back_off_physically(switch)
+
+        if self.homing[switch.axis] == 1 and switch.direction == -1:
+            self.homing[switch.axis] = 0
+            self.needs_homing[switch.axis] = 0
+            self._send("H", switch.axis)
+        else:
+            self.needs_homing[switch.axis] = 1
+            self._send("L", switch.id)
+
+    def _back_off_physically(self, switch):
+        # However the axis is wound, the real switch lets go once the carriage moves off it
+        while switch.pressed(self._physical_position(switch.axis)):
+            self.offsets[switch.axis] -= switch.direction
+
+    def _handle_command(self, command, axis, value):
+        if axis > 2:
+            return
+        motor = self.motors[axis]
+
+        match command:
+            case "M": # Move to position
+                if self.needs_homing[axis] != 1:
+                    motor.move_to(value)
+                    self.move_done_pending[axis] = True
+                else:
+                    self._send("N")
+            case "J": # Jog
+                motor.move(value)
+                self.move_done_pending[axis] = True
+            case "S": # Set speed
+                if self.saved_rates[axis] is not None:
+                    # takes effect when the coordinated move is done
+                    self.saved_rates[axis] = (value, self.saved_rates[axis][1])
+                else:
+                    motor.set_max_speed(value)
+            case "A": # Set acceleration
+                if self.saved_rates[axis] is not None:
+                    self.saved_rates[axis] = (self.saved_rates[axis][0], value)
+                else:
+                    motor.set_acceleration(value)
+            case "T": # Stage a target for a coordinated move
+                self.staged_targets[axis] = value
+            case "G": # Start the coordinated move
+                self._start_coordinated_move()
+            case "H": # Home axis
+                self.homing[axis] = 1
+                motor.move(-1000000)
+                self.move_done_pending[axis] = True
+            case "F": # Force move, ignore limit switches
+                motor.move(value)
+                self._run_to_position(motor)
+                self.move_done_pending[axis] = True
+            case "E": # Stop motor
+                motor.stop()
+                self.homing[axis] = 0
+            case "P": # Send motor isRunning and position data
+                status = [field for m in self.motors for field in (int(m.is_running()), m.current_position())]
+                if self.binary_mode:
+                    self._send("P", *status, *self.needs_homing)
+                else:
+                    self._send("P", *status)
+                    self._send("D", *self.needs_homing)
+            case "R": # Send maxSpeed and acceleration for each motor
+                self._send("R", *(float(rate) for axis in range(3) for rate in self._configured_rates(axis)))
+            case "B": # Select the framing, 1 for binary and 0 for ASCII
+                # The reply goes out in the old framing
+                self._send("B", 1 if value == 1 else 0)
+                self.binary_mode = value == 1
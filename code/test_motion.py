@@ -0,0 +1,62 @@
+"""
+Tests of the closed-form move time estimates in motion.py against the step-exact AccelStepper
+reference. Run with pytest from this folder.
+"""
+
+import math
+
+import numpy as np
+import pytest
+
+import motion
+
+# The estimate is meant to stay within this many multiples of sqrt(2 / acceleration) of the
+# stepped time, see RAMP_CORRECTION
+RAMP_TOLERANCE = 0.45
+
+SPEEDS = [100.0, 400.0, 1000.0, 2500.0, 4000.0]
+ACCELERATIONS = [20.0, 100.0, 500.0, 2000.0, 3200.0, 10000.0]
+DISTANCES = [2, 3, 5, 8, 13, 30, 75, 200, 640, 2000, 7500, 20000, 60000]
+
+
+@pytest.mark.parametrize("max_speed", SPEEDS)
+@pytest.mark.parametrize("acceleration", ACCELERATIONS)
+def test_axis_move_times_match_stepper(max_speed, acceleration):
+    estimates = motion.axis_move_times(np.array(DISTANCES, dtype=np.float64)[:, None], [max_speed], [acceleration])[:, 0]
+    tolerance = RAMP_TOLERANCE * math.sqrt(2.0 / acceleration)
+    for distance, estimate in zip(DISTANCES, estimates):
+        reference = motion.reference_move_time(distance, max_speed, acceleration)
+        assert abs(estimate - reference) <= tolerance, (distance, estimate, reference)
+
+
+@pytest.mark.parametrize("distance", [1000, 20000])
+def test_speeds_are_limited_to_step_rate(distance):
+    reference = motion.reference_move_time(distance, 2 * motion.MAX_STEP_RATE, 2000.0)
+    assert reference == motion.reference_move_time(distance, motion.MAX_STEP_RATE, 2000.0)
+    estimate = motion.axis_move_times([[distance]], [2 * motion.MAX_STEP_RATE], [2000.0])[0, 0]
+    assert abs(estimate - reference) <= RAMP_TOLERANCE * math.sqrt(2.0 / 2000.0)
+
+
+def test_short_moves():
+    times = motion.axis_move_times([[0, 1, -1]])[0]
+    assert list(times) == [0.0, 0.0, 0.0]
+    assert motion.reference_move_time(1, 4000.0, 2000.0) == 0.0
+
+
+def test_move_durations_follow_slowest_axis():
+    targets = [[8000, 0, 0], [8000, 40000, 0], [0, 40000, 3000]]
+    durations = motion.move_durations(targets, [0, 0, 0])
+    distances = np.abs(np.diff(np.vstack(([0, 0, 0], targets)), axis=0))
+    for duration, move in zip(durations, distances):
+        slowest = max(motion.reference_move_time(int(d), s, a)
+                      for d, s, a in zip(move, motion.DEFAULT_MAX_SPEEDS, motion.DEFAULT_ACCELERATIONS))
+        assert abs(duration - slowest) <= RAMP_TOLERANCE * math.sqrt(2.0 / min(motion.DEFAULT_ACCELERATIONS))
+
+
+def test_coordinated_axes_arrive_together():
+    distances = np.array([[6000.0, 30000.0, 1500.0]])
+    max_speeds, accelerations = motion.coordinated_rates(distances)
+    times = motion.axis_move_times(distances, max_speeds, accelerations)[0]
+    # The ideal profiles coincide, only the per-axis ramp corrections differ
+    assert np.ptp(times + motion.RAMP_CORRECTION * np.sqrt(2.0 / accelerations[0])) < 1e-9
+    assert times.max() >= motion.axis_move_times(distances)[0].max()